@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+
+from httpserver import HttpError
+from submission import queue_submission
+
+logger = logging.getLogger(__name__)
+
+_JSON = "application/json"
+# One JSON object per line
+_NDJSON = "application/x-ndjson"
+
+
+def _json(status, value):
+    return status, _JSON, (json.dumps(value) + "\n").encode("UTF-8")
+
+
+def _int_param(request, name, default=None, maximum=None):
+    value = request.query.get(name)
+    if value is None:
+        if default is None:
+            raise HttpError(400, "missing parameter {}".format(name))
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise HttpError(400, "parameter {} is no integer".format(name))
+    if value < 0:
+        raise HttpError(400, "parameter {} is negative".format(name))
+    return value if maximum is None else min(value, maximum)
+
+
+def _addr_param(request, name):
+    """
+    Reads a BaseStation address given as HOST:PORT.
+    """
+    value = request.query.get(name)
+    if value is None:
+        return None
+    host, _, port = value.rpartition(":")
+    try:
+        return (host, int(port))
+    except ValueError:
+        raise HttpError(400, "parameter {} is not HOST:PORT".format(name))
+
+
+def _format_addr(addr):
+    return "{}:{}".format(*addr[:2])
+
+
+def _presence_record(presence):
+    return {
+        "extension": presence.number,
+        "base": _format_addr(presence.addr),
+        "last_seen": presence.last_seen,
+        "rssi": presence.rssi,
+    }
+
+
+def _message_record(message):
+    return {
+        "id": message.internal_ext_id,
+        "to": message.to_ext,
+        "from": message.from_ext,
+        "from_name": message.from_name,
+        "text": message.message,
+        "priority": message.priority,
+        "created": message.created,
+        "last_send_try": message.last_send_try or None,
+        "next_try": message.next_try if message.outbox_seq is not None else None,
+        "outcome": message.outcome,
+        "broadcast": message.broadcast.id if message.broadcast is not None else None,
+    }
+
+
+def _stream(items, record, batch=100):
+    """
+    Yields the records of items as JSON lines, `batch` lines per chunk.
+    """
+    for start in range(0, len(items), batch):
+        yield "".join(json.dumps(record(item)) + "\n" for item in items[start : start + batch]).encode("UTF-8")
+
+
+class AdminApi:
+    """
+    This class serves the admin API on an HttpServer:
+    | GET  /roaming?extension=E&base=HOST:PORT&offset=0&limit=100
+    | GET  /outbox?extension=E&offset=0&limit=100
+    | GET  /outbox/message?id=ID
+    | POST /outbox/cancel?id=ID
+    | POST /outbox/requeue?id=ID
+    | POST /messages           {"to": "102" or ["102", "group"], "text": "...", "from": "server", "from_name": "System", "priority": 0}
+    | GET  /broadcast?id=ID
+    | GET  /events?extension=E&status=delivered,expired
+
+    Lists are paginated with offset and limit (at most max_limit) and
+    streamed as one JSON object per line, everything else is answered
+    with a single JSON object. The filters are optional.
+    /events streams the status events of the messages (see events.py) as
+    one JSON object per line until the client disconnects. It needs an EventBus.
+    """
+
+    max_limit = 10000
+
+    def __init__(self, message_system, roaming_monitor, event_bus=None):
+        self._message_system = message_system
+        self._roaming_monitor = roaming_monitor
+        self._event_bus = event_bus
+
+    def register(self, http_server):
+        http_server.route("GET", "/roaming", self.get_roaming)
+        http_server.route("GET", "/outbox", self.get_outbox)
+        http_server.route("GET", "/outbox/message", self.get_message)
+        http_server.route("POST", "/outbox/cancel", self.cancel)
+        http_server.route("POST", "/outbox/requeue", self.requeue)
+        http_server.route("POST", "/messages", self.post_message)
+        http_server.route("GET", "/broadcast", self.get_broadcast)
+        if self._event_bus is not None:
+            http_server.route("GET", "/events", self.get_events)
+
+    def _page(self, request):
+        return _int_param(request, "offset", 0), _int_param(request, "limit", 100, self.max_limit)
+
+    def get_roaming(self, request):
+        offset, limit = self._page(request)
+        presences = self._roaming_monitor.query(request.query.get("extension"), _addr_param(request, "base"), offset, limit)
+        return 200, _NDJSON, _stream(presences, _presence_record)
+
+    def get_outbox(self, request):
+        offset, limit = self._page(request)
+        messages = self._message_system.query_outbox(request.query.get("extension"), offset, limit)
+        return 200, _NDJSON, _stream(messages, _message_record)
+
+    def _queued_message(self, request, action):
+        message = action(_int_param(request, "id"))
+        if message is None:
+            raise HttpError(404, "no queued message with this id")
+        return _json(200, _message_record(message))
+
+    def get_message(self, request):
+        return self._queued_message(request, self._message_system.get_message)
+
+    def cancel(self, request):
+        return self._queued_message(request, self._message_system.cancel)
+
+    def requeue(self, request):
+        return self._queued_message(request, self._message_system.requeue)
+
+    async def post_message(self, request):
+        """
+        Queues a message. Answers once it is queued (and in the journal) with
+        its id, or with the id of the broadcast if it has several recipients.
+        """
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            raise HttpError(400, "body is no JSON")
+
+        done = asyncio.get_running_loop().create_future()
+
+        def committed():
+            if not done.done():
+                done.set_result(None)
+
+        try:
+            result = queue_submission(self._message_system, data, committed)
+        except ValueError as exp:
+            raise HttpError(400, str(exp))
+        await done
+        return _json(200, result)
+
+    def get_broadcast(self, request):
+        broadcast = self._message_system.get_broadcast(request.query.get("id"))
+        if broadcast is None:
+            raise HttpError(404, "no broadcast in progress with this id")
+        return _json(200, {"broadcast": broadcast.id, "created": broadcast.created, "status": broadcast.summary()})
+
+    def get_events(self, request):
+        extension = request.query.get("extension")
+        statuses = request.query.get("status")
+        subscription = self._event_bus.subscribe(
+            "http", extensions=[extension] if extension else None, statuses=statuses.split(",") if statuses else None
+        )
+
+        async def stream():
+            try:
+                async for events in subscription:
+                    yield "".join(json.dumps(event) + "\n" for event in events).encode("UTF-8")
+            finally:
+                subscription.close()
+
+        return 200, _NDJSON, stream()
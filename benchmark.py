@@ -0,0 +1,1606 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the messaging server.
+Every subcommand measures one part of the server and prints the results.
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+from capture import CaptureWriter, read_capture
+from consumer import ConsumerDriver
+from events import EventBus, Webhook
+from frame import Frame
+from httpserver import HttpServer
+from journal import Journal
+from logsetup import setup_logging
+from messagesystem import _MESSAGE_TEMPLATE, Message, MessageSystem
+from pipeline import LoopLag, ParsePipeline
+from ratelimit import RateController
+from replay import print_stats, replay_direct
+from retry import RetryPolicies, RetryPolicy
+from roaming import RoamingMonitor
+from rssi import RssiMonitor
+from send_message import MessageSender, create_message_xml
+from simulatedbase import SimulatedBaseStation
+from snom_messaging import UdpServer
+from submission import SubmissionClient, SubmissionServer
+
+
+def _systeminfo(handsets):
+    return (
+        """<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="systeminfo">
+<externalid>3485367639</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>2019-12-29 22:05:44</datetime>
+<timestamp>5e091528</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<senderdata>
+"""
+        + "".join("<address>{0}</address>\n<name>no{0}</name>\n".format(handset) for handset in handsets)
+        + """</senderdata>
+</request>
+\0"""
+    ).encode("UTF-8")
+
+
+# Frames as they were recorded from a M700 (see consumer.py).
+SAMPLE_FRAMES = {
+    "systeminfo": _systeminfo(["23", "34", "42"]),
+    "systeminfo-large": _systeminfo([str(100 + i) for i in range(100)]),
+    "login": b"""<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="login">
+<externalid>3725663668</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>2019-12-29 22:04:48</datetime>
+<timestamp>5e0914f0</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<logindata>
+<status>1</status>
+</logindata>
+<senderdata>
+<address>42</address>
+<name>no42</name>
+<location>M700</location>
+</senderdata>
+</request>
+\0""",
+    "alarm": b"""<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="alarm">
+<externalid>0595015157</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>2019-12-29 23:40:32</datetime>
+<timestamp>5e092b60</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<alarmdata>
+<type>16</type>
+</alarmdata>
+<rssidata>
+<rfpi>1333a39f00</rfpi>
+<rssi>204</rssi>
+</rssidata>
+<senderdata>
+<address>99</address>
+<name>no99</name>
+<location>M700</location>
+</senderdata>
+</request>
+\0""",
+    "job": b"""<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="job">
+<externalid>1234567890</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>27.06.2025 17:08:41</datetime>
+<timestamp>1751036921</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<jobdata>
+<priority>0</priority>
+<messages>
+<message1></message1>
+<message2></message2>
+<messageuui>Meeting at 3 PM in room A</messageuui>
+</messages>
+<status>0</status>
+<statusinfo></statusinfo>
+</jobdata>
+<senderdata>
+<address>23</address>
+<name>no23</name>
+<location>M700</location>
+</senderdata>
+<persondata>
+<address>42</address>
+</persondata>
+</request>
+\0""",
+    "status": b"""<?xml version="1.0" encoding="UTF-8"?>
+<response version="19.11.12.1403" type="job">
+<externalid>0012345678</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>27.06.2025 17:08:42</datetime>
+<timestamp>1751036922</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<jobdata>
+<status>1</status>
+<statusinfo></statusinfo>
+</jobdata>
+</response>
+\0""",
+}
+
+# Mix of frames on a typical site: mostly keep-alives.
+SAMPLE_TRAFFIC = ["systeminfo"] * 14 + ["systeminfo-large", "login", "alarm", "job", "status", "status"]
+
+
+def sample_message(internal_ext_id, to_ext="102"):
+    """
+    Creates a Message as it would have been received from a handset.
+    """
+    return Message.from_record(
+        [
+            internal_ext_id,
+            time.time(),
+            "1234567890",
+            "Meeting at 3 PM in room A",
+            "Alice",
+            "101",
+            "M700",
+            to_ext,
+            "27.06.2025 17:08:41",
+            "1751036921",
+        ]
+    )
+
+
+async def _journal_enqueue(path, count, group_commit):
+    """
+    Queues `count` messages to a new journal and waits until all of them are committed.
+    Returns the achieved rate in messages per second.
+    """
+    journal = Journal(path, group_commit=group_commit)
+    done = asyncio.Event()
+    committed = 0
+
+    def on_commit():
+        nonlocal committed
+        committed += 1
+        if committed == count:
+            done.set()
+
+    start = time.perf_counter()
+    for i in range(count):
+        journal.queued(sample_message(i).to_record(), on_commit)
+        if i % 100 == 0:
+            # give the event loop a chance to run, like between two datagrams
+            await asyncio.sleep(0)
+    await done.wait()
+    elapsed = time.perf_counter() - start
+    journal.close()
+    return count / elapsed
+
+
+async def _journal_recover(path, count):
+    """
+    Writes a journal containing `count` queued messages (plus attempts and
+    some delivered messages) and measures how long a MessageSystem needs to recover it.
+    """
+    journal = Journal(path)
+    for i in range(count):
+        journal.queued(sample_message(i).to_record())
+        journal.attempted(i, time.time())
+    for i in range(count, count + count // 10):
+        journal.queued(sample_message(i).to_record())
+        journal.done(i, "delivered")
+    journal.close()
+
+    start = time.perf_counter()
+    journal = Journal(path)
+    message_system = MessageSystem(UdpServer(), RoamingMonitor(UdpServer()), journal)
+    elapsed = time.perf_counter() - start
+    recovered = len(message_system._outbox)
+    message_system.close()
+    return recovered, elapsed
+
+
+def bench_journal(args):
+    """
+    Enqueue throughput of the journal with and without group commit and
+    the time needed to recover a large journal on startup.
+    """
+
+    async def run():
+        with tempfile.TemporaryDirectory() as tmp:
+            rate = await _journal_enqueue(os.path.join(tmp, "group.journal"), args.count, True)
+            print(f"enqueue, group commit:    {rate:12.0f} messages/s")
+            count = max(1, args.count // 20)
+            rate = await _journal_enqueue(os.path.join(tmp, "sync.journal"), count, False)
+            print(f"enqueue, fsync per record:{rate:12.0f} messages/s")
+
+            recovered, elapsed = await _journal_recover(os.path.join(tmp, "recover.journal"), args.recover_count)
+            print(f"recovery of {recovered} messages: {elapsed * 1000:.1f} ms")
+
+    asyncio.run(run())
+
+
+def _legacy_get_message(message):
+    """
+    The str.replace() based implementation Message.get_message() used before
+    the precompiled templates, including the encoding done by send_dgram().
+    """
+    template = _MESSAGE_TEMPLATE_TEXT
+    template = template.replace("{{eid}}", "{:010}".format(message.internal_ext_id))
+    template = template.replace("{{from_ext}}", message.from_ext)
+    template = template.replace("{{from_name}}", message.from_name)
+    template = template.replace("{{from_loc}}", message.from_loc)
+    template = template.replace("{{to_ext}}", message.to_ext)
+    template = template.replace("{{dt}}", message.sysdata_datetime)
+    template = template.replace("{{ts}}", message.sysdata_ts)
+    template = template.replace("{{msg}}", message.message)
+    return template.encode("UTF-8")
+
+
+_MESSAGE_TEMPLATE_TEXT = """<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="job">
+<externalid>{{eid}}</externalid>
+<systemdata>
+<name>server</name>
+<datetime>{{dt}}</datetime>
+<timestamp>{{ts}}</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<jobdata>
+<priority>0</priority>
+<messages>
+<message1></message1>
+<message2></message2>
+<messageuui>{{msg}}</messageuui>
+</messages>
+<status>0</status>
+<statusinfo></statusinfo>
+</jobdata>
+<senderdata>
+<address>{{from_ext}}</address>
+<name>{{from_name}}</name>
+<location>{{from_loc}}</location>
+</senderdata>
+<persondata>
+<address>{{to_ext}}</address>
+</persondata>
+</request>
+\0"""
+
+
+def _rate(func, count):
+    """
+    Calls func `count` times and returns the calls per second.
+    """
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+
+def bench_templates(args):
+    """
+    Rendering of outgoing messages: str.replace() chain vs. precompiled templates.
+    """
+    message = sample_message(1234567890)
+    fields = {
+        "eid": "{:010}".format(message.internal_ext_id),
+        "from_ext": message.from_ext,
+        "from_name": message.from_name,
+        "from_loc": message.from_loc,
+        "to_ext": message.to_ext,
+        "dt": message.sysdata_datetime,
+        "ts": message.sysdata_ts,
+        "msg": message.message,
+        "priority": message.priority,
+    }
+
+    rate = _rate(lambda: _legacy_get_message(message), args.count)
+    print(f"str.replace chain + encode:  {rate:12.0f} messages/s")
+    rate = _rate(lambda: _MESSAGE_TEMPLATE.render(**fields), args.count)
+    print(f"template render:             {rate:12.0f} messages/s")
+    rate = _rate(message.get_message, args.count)
+    print(f"cached get_message (retry):  {rate:12.0f} messages/s")
+
+
+def _parse_elementtree(data):
+    """
+    Parses a datagram like UdpServer did before Frames and reads the fields the drivers use.
+    """
+    for message in data.decode("UTF-8").split("\0"):
+        if not message:
+            continue
+        root = ET.fromstring(message)
+        msg_type = root.attrib["type"]
+        if msg_type == "systeminfo":
+            [element.text for element in root.find("senderdata").findall("address")]
+        elif msg_type == "login":
+            root.find("logindata").find("status").text
+            root.find("senderdata").find("address").text
+        elif msg_type == "job" and root.tag == "request":
+            for path in _JOB_FIELDS:
+                root.find("./" + path).text
+        elif msg_type == "job" and root.find("./jobdata"):
+            int(root.find("./externalid").text)
+            int(root.find("./jobdata/status").text)
+
+
+def _parse_frame(data):
+    """
+    Parses a datagram into Frames and reads the fields the drivers use.
+    """
+    for message in data.split(b"\0"):
+        if not message.strip():
+            continue
+        frame = Frame(message)
+        msg_type = frame.type
+        if msg_type == "systeminfo":
+            frame.getall("senderdata/address")
+        elif msg_type == "login":
+            frame.get("logindata/status")
+            frame.get("senderdata/address")
+        elif msg_type == "job" and frame.tag == "request":
+            for path in _JOB_FIELDS:
+                frame.get(path)
+        elif msg_type == "job":
+            frame.get_int("jobdata/status")
+            frame.get_int("externalid")
+
+
+_JOB_FIELDS = [
+    "externalid",
+    "jobdata/messages/messageuui",
+    "senderdata/name",
+    "senderdata/address",
+    "senderdata/location",
+    "persondata/address",
+    "systemdata/datetime",
+    "systemdata/timestamp",
+]
+
+
+def _replay_rate(func, frames, count):
+    """
+    Feeds `count` datagrams from `frames` (round-robin) into func.
+    Returns datagrams per second.
+    """
+    start = time.perf_counter()
+    for i in range(count):
+        func(frames[i % len(frames)])
+    return count / (time.perf_counter() - start)
+
+
+def bench_parser(args):
+    """
+    Parsing of incoming datagrams: ElementTree vs. lazily parsed Frames.
+    """
+    traffic = [SAMPLE_FRAMES[name] for name in SAMPLE_TRAFFIC]
+
+    for name in list(SAMPLE_FRAMES) + ["mixed"]:
+        frames = traffic if name == "mixed" else [SAMPLE_FRAMES[name]]
+        # best of three, alternating, as single runs are quite noisy
+        old = new = 0
+        for _ in range(3):
+            old = max(old, _replay_rate(_parse_elementtree, frames, args.count))
+            new = max(new, _replay_rate(_parse_frame, frames, args.count))
+        print(f"{name:18} ElementTree: {old:9.0f}/s   Frame: {new:9.0f}/s   speedup: {new / old:4.1f}x")
+
+
+class _NullTransport:
+    """
+    Stands in for the UDP socket, outgoing datagrams are dropped.
+    """
+
+    def sendto(self, data, addr=None):
+        pass
+
+
+async def _feed_datagrams(server, traffic, rate, duration):
+    """
+    Feeds datagrams from `traffic` into server.datagram_received() at `rate`
+    datagrams per second for `duration` seconds, in batches once per millisecond.
+    Returns the number of datagrams, the CPU time the event loop spent
+    processing them and the time it took.
+    """
+    addr = ("192.168.1.10", 1300)
+    count = 0
+    busy = 0.0
+    start = time.perf_counter()
+    while True:
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+        # never catch up with more than 100 ms of traffic at once, so an overloaded run still ends in time
+        target = min(int(elapsed * rate), count + rate // 10)
+        begin = time.thread_time()
+        while count < target:
+            server.datagram_received(traffic[count % len(traffic)], addr)
+            count += 1
+        busy += time.thread_time() - begin
+        await asyncio.sleep(0.001)
+    return count, busy, time.perf_counter() - start
+
+
+def bench_datagrams(args):
+    """
+    Processing of incoming datagrams by the whole server at a fixed rate, with logging to a file.
+    """
+    traffic = [SAMPLE_FRAMES[name] for name in SAMPLE_TRAFFIC]
+
+    async def run():
+        server = UdpServer()
+        server.connection_made(_NullTransport())
+        roaming_monitor = RoamingMonitor(server)
+        message_system = MessageSystem(server, roaming_monitor)
+        await message_system.start()
+        ConsumerDriver(server)
+        result = await _feed_datagrams(server, traffic, args.rate, args.duration)
+        message_system.close()
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, "server.log")
+        log_listener = setup_logging(args.log_level, log_path, args.log_queue)
+        try:
+            count, busy, elapsed = asyncio.run(run())
+        finally:
+            if log_listener is not None:
+                log_listener.stop()
+            logging.shutdown()
+        log_size = os.path.getsize(log_path)
+
+    mode = "background thread" if args.log_queue else "event loop"
+    print(f"{count} datagrams in {elapsed:.1f} s at {args.rate} datagrams/s, log level {args.log_level} written by {mode}:")
+    print(f"  CPU time per datagram: {busy / count * 1e6:8.1f} us")
+    print(f"  event loop busy:       {busy / elapsed * 100:8.1f} %")
+    print(f"  log written:           {log_size / 1024:8.0f} KiB")
+
+
+def _send_bursts(port, frames, bursts, interval, stop):
+    """
+    Sends `frames` to the server in bursts every `interval` seconds from a
+    background thread. Every frame is sent from its own socket like from
+    its own BaseStation. Returns the thread, the number of datagrams sent is
+    in its attribute `sent`.
+    """
+
+    def run():
+        sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in frames]
+        try:
+            for _ in range(bursts):
+                if stop.is_set():
+                    break
+                for sock, frame in zip(sockets, frames):
+                    sock.sendto(frame, ("127.0.0.1", port))
+                    thread.sent += 1
+                stop.wait(interval)
+        finally:
+            for sock in sockets:
+                sock.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.sent = 0
+    thread.start()
+    return thread
+
+
+def bench_pipeline(args):
+    """
+    Event loop lag during bursts of large systeminfo frames, parsed on the loop or in a pool.
+    """
+    handsets = [str(10000 + i) for i in range(args.bases * args.handsets)]
+    frames = []
+    for base in range(args.bases):
+        frames.append(_systeminfo(handsets[base * args.handsets : (base + 1) * args.handsets]))
+        # Some phones send messages in between.
+        xml, _ = create_message_xml(handsets[base], "Message during a burst")
+        frames.append(xml.encode("UTF-8"))
+
+    async def run(pool):
+        loop = asyncio.get_running_loop()
+        transport, server = await loop.create_datagram_endpoint(UdpServer, local_addr=("127.0.0.1", 0))
+        transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        roaming_monitor = RoamingMonitor(server)
+        message_system = MessageSystem(server, roaming_monitor)
+        ConsumerDriver(server)
+        if pool:
+            server.pipeline = ParsePipeline(server, pool, args.pool_workers, args.queue)
+        await message_system.start()
+        lag = LoopLag(0.005)
+        lag.start()
+
+        stop = threading.Event()
+        sender = _send_bursts(transport.get_extra_info("sockname")[1], frames, args.bursts, args.interval, stop)
+        await loop.run_in_executor(None, sender.join)
+        await asyncio.sleep(0.5)
+        lag.stop()
+
+        jobs = sum(stats["calls"] for stats in server.driver_stats() if (stats["tag"], stats["type"]) == ("request", "job"))
+        result = (lag.stats(), sender.sent, jobs, server.pipeline.stats() if pool else None)
+        await message_system.stop(0)
+        if pool:
+            server.pipeline.close()
+        transport.close()
+        return result
+
+    for logger_name in ("roaming", "messagesystem", "pipeline"):
+        logging.getLogger(logger_name).setLevel(logging.ERROR)
+    size = sum(len(frame) for frame in frames) / len(frames)
+    print(f"{args.bursts} bursts of {len(frames)} datagrams ({size / 1024:.1f} KiB on average) every {args.interval * 1000:.0f} ms:")
+    for pool in (None, "thread", "process"):
+        lag, sent, jobs, stats = asyncio.run(run(pool))
+        shed = f", {stats['shed']} keep-alives shed, {stats['dropped']} dropped" if stats else ""
+        print(
+            f"  {pool or 'event loop':10}  lag mean {lag['mean'] * 1000:6.2f} ms  p99 {lag['p99'] * 1000:6.2f} ms  max {lag['max'] * 1000:6.2f} ms"
+            f"  {jobs}/{sent // 2} jobs{shed}"
+        )
+
+
+def bench_roaming(args):
+    """
+    Processing of systeminfo keep-alives by the RoamingMonitor: first contact, steady state and roaming handsets.
+    """
+    handsets = [str(10000 + i) for i in range(args.bases * args.handsets)]
+    bases = [("192.168.1.{}".format(i + 1), 1300) for i in range(args.bases)]
+    lists = [handsets[i * args.handsets : (i + 1) * args.handsets] for i in range(args.bases)]
+
+    logging.getLogger("roaming").setLevel(logging.WARNING)
+
+    # Memory of the table including the extension numbers, without the frames.
+    frames = [_systeminfo(numbers) for numbers in lists]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    roaming_monitor = RoamingMonitor(UdpServer())
+    for base, frame in zip(bases, frames):
+        roaming_monitor.process_systeminfo(Frame(frame), base)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del frames, roaming_monitor
+
+    roaming_monitor = RoamingMonitor(UdpServer())
+
+    def keepalives(rounds):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for base, numbers in zip(bases, lists):
+                roaming_monitor.process_systeminfo(Frame(_systeminfo(numbers)), base)
+        return (time.perf_counter() - start) / rounds / len(bases)
+
+    print(f"{args.bases} BaseStations with {args.handsets} handsets each:")
+    print(f"  roaming table:   {size / 1024 / 1024:9.1f} MiB ({size / len(handsets):.0f} bytes per handset)")
+    print(f"  first contact:   {keepalives(1) * 1e6:9.1f} us per systeminfo")
+    print(f"  steady state:    {keepalives(args.rounds) * 1e6:9.1f} us per systeminfo")
+
+    # Move 1 % of the handsets to the next BaseStation every round.
+    moving = max(1, args.handsets // 100)
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        for i in range(args.bases):
+            moved = lists[i][:moving]
+            del lists[i][:moving]
+            lists[(i + 1) % args.bases].extend(moved)
+        for base, numbers in zip(bases, lists):
+            roaming_monitor.process_systeminfo(Frame(_systeminfo(numbers)), base)
+    elapsed = (time.perf_counter() - start) / args.rounds / args.bases
+    print(f"  1 % roaming:     {elapsed * 1e6:9.1f} us per systeminfo")
+    # Only the systeminfo frames themselves, for comparison.
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        for numbers in lists:
+            Frame(_systeminfo(numbers)).getall("senderdata/address")
+    elapsed = (time.perf_counter() - start) / args.rounds / args.bases
+    print(f"  (frame only:     {elapsed * 1e6:9.1f} us per systeminfo)")
+
+
+def _alarm(number, rfpi, rssi):
+    """
+    The recorded alarm frame with another handset, RFPI and RSSI.
+    """
+    frame = SAMPLE_FRAMES["alarm"]
+    frame = frame.replace(b"<rfpi>1333a39f00</rfpi>", b"<rfpi>%s</rfpi>" % rfpi.encode("UTF-8"))
+    frame = frame.replace(b"<rssi>204</rssi>", b"<rssi>%d</rssi>" % rssi)
+    return frame.replace(b"<address>99</address>", b"<address>%s</address>" % number.encode("UTF-8"))
+
+
+def _login(number):
+    return SAMPLE_FRAMES["login"].replace(b"<address>42</address>", b"<address>%s</address>" % number.encode("UTF-8"))
+
+
+def bench_rssi(args):
+    """
+    Routing by RSSI vs. by registration: replays simulated alarm, login and systeminfo frames of walking handsets.
+    """
+    rng = random.Random(args.seed)
+    bases = [("192.168.1.{}".format(i + 1), 1300) for i in range(args.bases)]
+    rfpis = ["1333a39f{:02x}".format(i) for i in range(args.bases)]
+    handsets = [str(100 + i) for i in range(args.handsets)]
+
+    # Handsets walk along a corridor with a BaseStation every 1.0. The signal
+    # drops with the distance; deliveries fail more often at weak signal.
+    position = {number: rng.uniform(0, args.bases - 1) for number in handsets}
+    registered = {number: round(position[number]) for number in handsets}
+
+    def signal(number, base):
+        return 220 - 60 * abs(position[number] - base) + rng.gauss(0, 8)
+
+    def delivered(rssi):
+        return rng.random() < 1 / (1 + math.exp(-(rssi - 120) / 10))
+
+    stacks = {}
+    for name in ("registration", "rssi"):
+        server = UdpServer()
+        roaming_monitor = RoamingMonitor(server)
+        if name == "rssi":
+            RssiMonitor(server, roaming_monitor)
+        ConsumerDriver(server)
+        stacks[name] = (server, roaming_monitor)
+    logging.getLogger("roaming").setLevel(logging.WARNING)
+
+    def replay(frame, addr):
+        for server, _ in stacks.values():
+            server.datagram_received(frame, addr)
+
+    attempts = {name: 0 for name in stacks}
+    successes = {name: 0 for name in stacks}
+    for _ in range(args.rounds):
+        for number in handsets:
+            position[number] = min(args.bases - 1, max(0, position[number] + rng.gauss(0, args.speed)))
+
+            # Every BaseStation in range reports what it receives.
+            for base, addr in enumerate(bases):
+                rssi = signal(number, base)
+                if rssi > 60 and rng.random() < args.report:
+                    replay(_alarm(number, rfpis[base], int(rssi)), addr)
+
+            # DECT handover only happens once the signal got quite bad.
+            old = registered[number]
+            best = max(range(args.bases), key=lambda base: signal(number, base))
+            if best != old and signal(number, old) < 110 and signal(number, best) > signal(number, old) + 20:
+                registered[number] = best
+                replay(_login(number), bases[best])
+
+        for base, addr in enumerate(bases):
+            replay(_systeminfo([number for number in handsets if registered[number] == base]), addr)
+
+        for name, (_, roaming_monitor) in stacks.items():
+            for number in handsets:
+                addr = roaming_monitor.get_addr(number)
+                if addr is None:
+                    continue
+                attempts[name] += 1
+                successes[name] += delivered(signal(number, bases.index(addr)))
+
+    print(f"{args.handsets} handsets walking past {args.bases} BaseStations, {args.rounds} rounds:")
+    for name in stacks:
+        rate = successes[name] / attempts[name]
+        print(f"  routing by {name:13} first attempts delivered: {rate * 100:5.1f} %   retries per message: {1 / rate - 1:.3f}")
+
+
+class _StandInServer:
+    """
+    Runs the messaging server on a free port of the loopback interface in a
+    background thread, so the senders can be benchmarked from the main thread.
+    """
+
+    def __init__(self, journal_path=None, submit_path=None):
+        self.addr = None
+        self._journal_path = journal_path
+        self._submit_path = submit_path
+        self._loop = None
+        self._stop = None
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._loop.call_soon_threadsafe(self._stop.set_result, None)
+        self._thread.join()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = self._loop.create_future()
+        transport, server = await self._loop.create_datagram_endpoint(UdpServer, local_addr=("127.0.0.1", 0))
+        journal = Journal(self._journal_path) if self._journal_path else None
+        message_system = MessageSystem(server, RoamingMonitor(server), journal)
+        await message_system.start()
+        submission_server = None
+        if self._submit_path:
+            submission_server = SubmissionServer(message_system, self._submit_path)
+            await submission_server.start()
+        self.addr = transport.get_extra_info("sockname")
+        self._started.set()
+        await self._stop
+        if submission_server is not None:
+            await submission_server.stop()
+        transport.close()
+        message_system.close()
+
+
+def _legacy_send(addr, to_ext, text):
+    """
+    Sends a message like MessageSender did before AsyncMessageSender:
+    A new socket per message and a blocking wait for the reply.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(10)
+    try:
+        xml_message, _ = create_message_xml(to_ext, text)
+        sock.sendto(xml_message.encode("utf-8"), addr)
+        sock.recvfrom(4096)
+    finally:
+        sock.close()
+
+
+def bench_sender(args):
+    """
+    Sending messages to a server on the loopback interface: a socket per message vs. AsyncMessageSender.
+    """
+    # The stand-in server does not know the recipients and would warn about every message.
+    logging.getLogger().setLevel(logging.ERROR)
+    messages = [dict(to_ext=str(1000 + i), message_text=f"Broadcast message {i}") for i in range(args.count)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for journal_path in (None, os.path.join(tmp, "outbox.journal")):
+            print("server with journal (confirms after group commit):" if journal_path else "server without journal:")
+            with _StandInServer(journal_path) as server:
+                count = max(1, args.count // 10)
+                start = time.perf_counter()
+                for message in messages[:count]:
+                    _legacy_send(server.addr, message["to_ext"], message["message_text"])
+                elapsed = time.perf_counter() - start
+                print(
+                    f"  socket per message, sequential: {count / elapsed:9.0f} messages/s "
+                    f"({args.count} would take {args.count * elapsed / count:.2f} s)"
+                )
+
+                for max_in_flight in (1, 8, args.max_in_flight):
+                    sender = MessageSender(*server.addr, max_in_flight=max_in_flight)
+                    start = time.perf_counter()
+                    results = sender.send_messages(messages)
+                    elapsed = time.perf_counter() - start
+                    failed = sum(1 for success, _, _ in results if not success)
+                    print(
+                        f"  AsyncMessageSender, {max_in_flight:3} in flight: {args.count / elapsed:9.0f} messages/s "
+                        f"({args.count} took {elapsed:.2f} s, {failed} failed)"
+                    )
+
+
+async def _submit_batches(path, messages, batch, connections):
+    """
+    Submits messages over the submission socket in batches, spread over several connections.
+    Returns the number of messages the server did not queue.
+    """
+    chunks = [messages[start : start + batch] for start in range(0, len(messages), batch)]
+
+    async def submit(share):
+        failed = 0
+        async with SubmissionClient(path) as client:
+            for chunk in share:
+                failed += sum(1 for result in await client.submit(chunk) if "error" in result)
+        return failed
+
+    return sum(await asyncio.gather(*[submit(chunks[index::connections]) for index in range(connections)]))
+
+
+def bench_submit(args):
+    """
+    Queueing messages through the submission socket vs. job datagrams over UDP.
+    """
+    logging.getLogger().setLevel(logging.ERROR)
+    udp_messages = [dict(to_ext=str(1000 + i), message_text=f"Broadcast message {i}") for i in range(args.count)]
+    messages = [{"to": message["to_ext"], "text": message["message_text"]} for message in udp_messages]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for journal_path in (None, os.path.join(tmp, "outbox.journal")):
+            print("server with journal (answers after group commit):" if journal_path else "server without journal:")
+            submit_path = os.path.join(tmp, "submit.sock")
+            with _StandInServer(journal_path, submit_path) as server:
+                sender = MessageSender(*server.addr, max_in_flight=args.max_in_flight)
+                start = time.perf_counter()
+                results = sender.send_messages(udp_messages)
+                elapsed = time.perf_counter() - start
+                failed = sum(1 for success, _, _ in results if not success)
+                print(
+                    f"  UDP, {args.max_in_flight:3} in flight:              {args.count / elapsed:9.0f} messages/s "
+                    f"({args.count} took {elapsed:.2f} s, {failed} failed)"
+                )
+
+                for batch in (1, 10, 100, 1000):
+                    for connections in (1, args.connections):
+                        start = time.perf_counter()
+                        failed = asyncio.run(_submit_batches(submit_path, messages, batch, connections))
+                        elapsed = time.perf_counter() - start
+                        print(
+                            f"  socket, batches of {batch:4}, {connections:2} connections: {args.count / elapsed:9.0f} messages/s "
+                            f"({args.count} took {elapsed:.2f} s, {failed} failed)"
+                        )
+
+
+class _StatusSource:
+    """
+    Stands in for the MessageSystem of an EventBus and reports made up status changes.
+    """
+
+    class Message:
+        def __init__(self, internal_ext_id, to_ext):
+            self.internal_ext_id = internal_ext_id
+            self.to_ext = to_ext
+            self.broadcast = None
+
+    def __init__(self):
+        self.listeners = []
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def publish(self, message, status):
+        for callback in self.listeners:
+            callback(message, status)
+
+
+async def _publish_events(source, rate, duration):
+    """
+    Publishes the lifecycle queued, sent, delivered of rate / 3 messages per
+    second in steps of 10 ms. Returns the events published and the seconds spent publishing.
+    """
+    messages = [_StatusSource.Message(i, str(1000 + i % 2000)) for i in range(max(1, rate // 300))]
+    published = 0
+    busy = 0.0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        for status in ("queued", "sent", "delivered"):
+            for message in messages:
+                source.publish(message, status)
+        busy += time.perf_counter() - start
+        published += 3 * len(messages)
+        await asyncio.sleep(0.01)
+    return published, busy
+
+
+async def _events(args, subscribers):
+    source = _StatusSource()
+    bus = EventBus(source)
+    received = {}
+    batches = {}
+    tasks = []
+
+    async def consume(name, delay):
+        subscription = bus.subscribe(name, size=args.buffer)
+        received[name] = 0
+        batches[name] = 0
+        async for events in subscription:
+            received[name] += len(events)
+            batches[name] += 1
+            if delay:
+                await asyncio.sleep(delay)
+        return subscription
+
+    hook_server = webhook = None
+    if "webhook" in subscribers:
+
+        async def hook(request):
+            # A slow receiver
+            await asyncio.sleep(args.slow)
+            return 200, "text/plain", b"ok\n"
+
+        hook_server = HttpServer("127.0.0.1", 0)
+        hook_server.route("POST", "/hook", hook)
+        await hook_server.start()
+        webhook = Webhook(bus, "http://127.0.0.1:{}/hook".format(hook_server.port), size=args.buffer)
+        webhook.start()
+    if "fast" in subscribers:
+        tasks.append(asyncio.create_task(consume("fast", 0)))
+    if "slow" in subscribers:
+        tasks.append(asyncio.create_task(consume("slow", args.slow)))
+    await asyncio.sleep(0)
+
+    loop_lag = LoopLag(interval=0.001)
+    loop_lag.start()
+    published, busy = await _publish_events(source, args.rate, args.duration)
+    loop_lag.stop()
+    lag = loop_lag.stats()
+
+    bus.close()
+    subscriptions = await asyncio.gather(*tasks)
+    if webhook is not None:
+        await webhook.stop()
+        received["webhook"] = webhook.posted
+        subscriptions.append(webhook._subscription)
+        await hook_server.stop()
+    dropped = {subscription.name: subscription.dropped for subscription in subscriptions}
+
+    print(
+        f"  {', '.join(subscribers) or 'no subscribers':19} {published / args.duration:7.0f} events/s, "
+        f"{busy / published * 1e6:5.2f} µs per event, loop lag p99 {lag['p99'] * 1000:5.2f} ms max {lag['max'] * 1000:5.2f} ms"
+    )
+    for name in received:
+        batch = f", {received[name] / batches[name]:5.1f} per batch" if batches.get(name) else ""
+        print(f"    {name:8} received {received[name]:8} dropped {dropped.get(name, 0):8}{batch}")
+
+
+def bench_events(args):
+    """
+    Publishing status events to fast, slow and webhook subscribers with bounded buffers.
+    """
+    logging.getLogger().setLevel(logging.ERROR)
+    print(
+        f"{args.rate} events/s for {args.duration} s, buffers of {args.buffer} events, "
+        f"slow subscribers take {args.slow * 1000:g} ms per batch:"
+    )
+    for subscribers in ((), ("fast",), ("fast", "slow"), ("fast", "slow", "webhook")):
+        asyncio.run(_events(args, subscribers))
+
+
+class _RecordingTransport:
+    """
+    Stands in for the UDP socket and records when datagrams were sent to which address.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr=None):
+        self.sent.append((time.perf_counter(), addr))
+
+
+def bench_broadcast(args):
+    """
+    Broadcasting a message to many handsets spread over several BaseStations.
+    """
+    handsets = [str(1000 + i) for i in range(args.handsets)]
+    bases = [("192.168.1.{}".format(10 + i), 1300) for i in range(args.bases)]
+
+    async def run():
+        server = UdpServer()
+        transport = _RecordingTransport()
+        server.connection_made(transport)
+        roaming_monitor = RoamingMonitor(server)
+        message_system = MessageSystem(server, roaming_monitor, groups={"everybody": handsets})
+        await message_system.start()
+        for i, base in enumerate(bases):
+            roaming_monitor.process_systeminfo(Frame(_systeminfo(handsets[i :: len(bases)])), base)
+
+        start = time.perf_counter()
+        message_system.broadcast(["everybody"], "Evacuate the building now", "911", "Security", "central")
+        for message in message_system._outbox:
+            message.get_message()
+        queued = time.perf_counter() - start
+
+        while len(transport.sent) < len(handsets):
+            await asyncio.sleep(0.01)
+        message_system.close()
+        return queued, start, transport.sent
+
+    logging.getLogger("roaming").setLevel(logging.WARNING)
+    queued, start, sent = asyncio.run(run())
+    print(f"queueing and rendering the broadcast to {args.handsets} handsets: {queued * 1000:.1f} ms")
+    last = {}
+    for when, addr in sent:
+        last[addr] = when - start
+    print(
+        f"all messages sent after {max(last.values()):.2f} s, "
+        f"{args.handsets // args.bases} handsets per BaseStation"
+    )
+
+
+def bench_ratelimit(args):
+    """
+    Sending queued messages to a BaseStation that just came back, with and without rate control.
+    """
+    handsets = [str(1000 + i) for i in range(args.messages)]
+    controllers = {
+        "unpaced": lambda: RateController(initial_rate=1e6, max_rate=1e6, burst=10**6),
+        "fixed 50/s": lambda: RateController(initial_rate=50, increase=0, decrease=1),
+        "adaptive (AIMD)": lambda: RateController(ack_timeout=1),
+    }
+
+    async def run(controller):
+        server = UdpServer()
+        roaming_monitor = RoamingMonitor(server)
+        message_system = MessageSystem(server, roaming_monitor, rate_controller=controller)
+        await message_system.start()
+        base = SimulatedBaseStation(server, ("192.168.1.10", 1300), args.capacity, args.buffer)
+        server.connection_made(base)
+        roaming_monitor.process_systeminfo(Frame(_systeminfo(handsets)), base.addr)
+
+        start = time.perf_counter()
+        cpu = time.process_time()
+        message_system.broadcast(handsets, "Queued while the BaseStation was down")
+        while time.perf_counter() - start < args.duration and len(base.delivered) < args.messages:
+            await asyncio.sleep(0.05)
+        cpu = time.process_time() - cpu
+
+        base.close()
+        message_system.close()
+        return base, start, cpu
+
+    logging.getLogger("roaming").setLevel(logging.WARNING)
+    logging.getLogger("messagesystem").setLevel(logging.WARNING)
+    logging.getLogger("ratelimit").setLevel(logging.ERROR)
+    print(
+        f"{args.messages} messages, BaseStation takes {args.capacity} messages/s and buffers {args.buffer}, "
+        f"retries after {RetryPolicies().get('no_response').delay(1):.0f} s:"
+    )
+    for name, factory in controllers.items():
+        controller = factory()
+        base, start, cpu = asyncio.run(run(controller))
+        stats = controller.stats()[0]
+        if len(base.delivered) == args.messages:
+            done = f"all delivered after {max(base.delivered.values()) - start:5.2f} s"
+        else:
+            done = f"{len(base.delivered)} delivered within {args.duration:.0f} s"
+        print(f"  {name:16} {done}, {base.received} sent, {base.dropped} dropped, final rate {stats['rate']:.0f}/s, {cpu:.2f} s CPU")
+
+
+def bench_priority(args):
+    """
+    Latency of urgent messages queued behind a backlog of routine messages to a busy BaseStation.
+    """
+    handsets = [str(1000 + i) for i in range(args.backlog)]
+    scenarios = {
+        "urgent as priority 0": (0, None),
+        "urgent as priority 2": (2, None),
+        "priority 2, budget 0=0.8": (2, {0: 0.8}),
+    }
+
+    async def run(priority, budgets):
+        server = UdpServer()
+        roaming_monitor = RoamingMonitor(server)
+        message_system = MessageSystem(server, roaming_monitor, rate_controller=RateController(budgets=budgets))
+        await message_system.start()
+        base = SimulatedBaseStation(server, ("192.168.1.10", 1300), args.capacity, args.buffer)
+        server.connection_made(base)
+        roaming_monitor.process_systeminfo(Frame(_systeminfo(handsets)), base.addr)
+
+        message_system.broadcast(handsets, "Routine message")
+        # Let the backlog fill the BaseStation first
+        await asyncio.sleep(1)
+        routine = len(base.delivered)
+        queued = {}
+        start = time.perf_counter()
+        rng = random.Random(1)
+        while time.perf_counter() - start < args.duration:
+            message = message_system.queue_message(rng.choice(handsets), "Urgent message", priority=priority)
+            queued["{:010}".format(message.internal_ext_id)] = time.perf_counter()
+            await asyncio.sleep(args.interval)
+        await asyncio.sleep(2)
+        elapsed = time.perf_counter() - start
+
+        base.close()
+        message_system.close()
+        latencies = sorted(base.delivered[ext_id] - queued_at for ext_id, queued_at in queued.items() if ext_id in base.delivered)
+        routine = len(base.delivered) - routine - len(latencies)
+        return latencies, len(queued), routine / elapsed
+
+    logging.getLogger("roaming").setLevel(logging.WARNING)
+    logging.getLogger("messagesystem").setLevel(logging.WARNING)
+    logging.getLogger("ratelimit").setLevel(logging.ERROR)
+    print(
+        f"{args.backlog} routine messages queued, an urgent one every {args.interval:g} s for {args.duration:g} s, "
+        f"BaseStation takes {args.capacity} messages/s and buffers {args.buffer}:"
+    )
+    for name, (priority, budgets) in scenarios.items():
+        latencies, count, routine_rate = asyncio.run(run(priority, budgets))
+        if latencies:
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            urgent = f"p50 {p50 * 1000:7.1f} ms, p99 {p99 * 1000:7.1f} ms"
+        else:
+            urgent = "none delivered"
+        print(f"  {name:26} urgent {len(latencies):3}/{count} delivered, {urgent}, routine {routine_rate:5.1f} messages/s")
+
+
+def _simulate_retries(policies, absences, presence_noticed, max_age):
+    """
+    Simulates the send attempts of messages to handsets that are absent when
+    the message is queued at time 0 and come back after `absences` seconds.
+    Every attempt while the handset is absent is answered with status 11.
+    The return of a handset is noticed by the server with the probability presence_noticed.
+
+    Returns the number of datagrams sent and the delays between the return
+    of the handsets and the delivery of the messages delivered within max_age.
+    """
+    datagrams = 0
+    latencies = []
+    for absence in absences:
+        noticed = random.random() < presence_noticed
+        now = 0.0
+        retry = 0
+        while now < max_age:
+            datagrams += 1
+            if now >= absence:
+                latencies.append(now - absence)
+                break
+            retry += 1
+            policy = policies.get("absent")
+            delay = policy.delay(retry)
+            if delay is None:
+                break
+            if policy.wake_on_presence and noticed and now < absence < now + delay:
+                now = absence
+            else:
+                now += delay
+    return datagrams, latencies
+
+
+def bench_retry(args):
+    """
+    Simulated retries to absent handsets: datagrams sent vs. delivery latency per retry policy.
+    """
+    random.seed(args.seed)
+    max_age = MessageSystem._max_age
+    absences = [random.expovariate(1 / (args.mean_absence * 3600)) for _ in range(args.messages)]
+
+    scenarios = [
+        ("every 60 s", RetryPolicies({"absent": RetryPolicy(initial=60)}), 1.0),
+        ("backoff", RetryPolicies(), 1.0),
+        ("every 60 s, presence missed", RetryPolicies({"absent": RetryPolicy(initial=60)}), 0.0),
+        ("backoff, presence missed", RetryPolicies(), 0.0),
+    ]
+    print(f"{args.messages} messages to handsets absent for {args.mean_absence} h on average (up to {max_age / 86400:.0f} days):")
+    for name, policies, presence_noticed in scenarios:
+        datagrams, latencies = _simulate_retries(policies, absences, presence_noticed, max_age)
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(
+            f"  {name:28} {datagrams / args.messages:8.1f} datagrams/message, "
+            f"latency after return p50 {p50:7.1f} s, p99 {p99:7.1f} s, {len(latencies)} delivered"
+        )
+
+
+def bench_lifecycle(args):
+    """
+    Startup and graceful shutdown of the MessageSystem, including a restart in the middle of a broadcast.
+    """
+    handsets = [str(1000 + i) for i in range(args.messages)]
+    addr = ("192.168.1.10", 1300)
+
+    async def start(path):
+        server = UdpServer()
+        roaming_monitor = RoamingMonitor(server)
+        begin = time.perf_counter()
+        message_system = MessageSystem(server, roaming_monitor, Journal(path) if path else None)
+        await message_system.start()
+        return server, roaming_monitor, message_system, time.perf_counter() - begin
+
+    async def stop(message_system):
+        begin = time.perf_counter()
+        await message_system.stop(args.drain_timeout)
+        return time.perf_counter() - begin
+
+    async def run(tmp):
+        path = os.path.join(tmp, "outbox.journal")
+
+        _, _, message_system, started = await start(None)
+        stopped = await stop(message_system)
+        print(f"empty, no journal:        start {started * 1000:6.2f} ms, stop {stopped * 1000:6.2f} ms")
+
+        server, roaming_monitor, message_system, started = await start(path)
+        base = SimulatedBaseStation(server, addr, args.capacity)
+        server.connection_made(base)
+        roaming_monitor.process_systeminfo(Frame(_systeminfo(handsets)), addr)
+        message_system.broadcast(handsets, "Restart in the middle of this broadcast")
+        await asyncio.sleep(args.messages / args.capacity / 2)
+        stopped = await stop(message_system)
+        acknowledged = args.messages - len(message_system._outbox)
+        base.close()
+        print(f"broadcast, with journal:  start {started * 1000:6.2f} ms, stop {stopped * 1000:6.2f} ms (drained messages in flight)")
+
+        _, _, message_system, started = await start(path)
+        queued = len(message_system._outbox)
+        stopped = await stop(message_system)
+        print(f"restart with {queued:5} queued: start {started * 1000:6.2f} ms, stop {stopped * 1000:6.2f} ms")
+        print(
+            f"{args.messages} messages: {acknowledged} acknowledged before the restart, {queued} queued after it, "
+            f"{args.messages - acknowledged - queued} lost"
+        )
+
+    logging.getLogger("roaming").setLevel(logging.WARNING)
+    logging.getLogger("messagesystem").setLevel(logging.WARNING)
+    logging.getLogger("journal").setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(tmp))
+
+
+class _LoadClient(asyncio.DatagramProtocol):
+    """
+    Keeps `window` jobs in flight on its own socket: Every confirmation
+    triggers the next job.
+    """
+
+    def __init__(self, job, window, end):
+        self._job = job
+        self._window = window
+        self._end = end
+        self._sent = 0
+        self.replies = 0
+        self.last_reply = 0
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self.refill()
+
+    def _send(self):
+        self._sent += 1
+        self._transport.sendto(self._job % (self._sent % 10000000000))
+
+    def refill(self):
+        # Lost datagrams would shrink the window for good.
+        for _ in range(self._window):
+            self._send()
+
+    def datagram_received(self, data, addr):
+        self.replies += 1
+        self.last_reply = time.monotonic()
+        if self.last_reply < self._end:
+            self._send()
+
+
+def _generate_load(port, sockets, window, duration):
+    """
+    Sends jobs from `sockets` sockets (and thus source ports) to the server
+    on the loopback interface. Returns the number of confirmations received.
+    """
+
+    async def run():
+        xml, _ = create_message_xml("999", "Load test", "100", "Load", "Benchmark", external_id="EXTERNALID")
+        job = xml.encode("UTF-8").replace(b"%", b"%%").replace(b"EXTERNALID", b"%010d")
+        loop = asyncio.get_running_loop()
+        end = time.monotonic() + duration
+        clients = []
+        for _ in range(sockets):
+            _, client = await loop.create_datagram_endpoint(
+                lambda: _LoadClient(job, window, end), remote_addr=("127.0.0.1", port)
+            )
+            clients.append(client)
+        while time.monotonic() < end:
+            await asyncio.sleep(0.25)
+            now = time.monotonic()
+            for client in clients:
+                if now - client.last_reply > 0.5:
+                    client.refill()
+        await asyncio.sleep(0.1)
+        return sum(client.replies for client in clients)
+
+    return asyncio.run(run())
+
+
+def _generate_keepalives(port, bases, handsets, rate, duration):
+    """
+    Sends systeminfo keep-alives of `bases` BaseStations with `handsets`
+    handsets each, every one from its own socket, `rate` per second in total.
+    Returns the number sent.
+    """
+    sockets = []
+    frames = []
+    for base in range(bases):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(("127.0.0.1", port))
+        sockets.append(sock)
+        frames.append(_systeminfo([str(10000 + base * handsets + i) for i in range(handsets)]))
+
+    sent = 0
+    start = time.monotonic()
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= duration:
+            break
+        while sent < elapsed * rate:
+            sockets[sent % bases].send(frames[sent % bases])
+            sent += 1
+        time.sleep(0.005)
+    for sock in sockets:
+        sock.close()
+    return sent
+
+
+def _process_cpu(pid):
+    """
+    Returns the CPU seconds used by a process and its children that are
+    still running (Linux only).
+    """
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0.0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry)) as f:
+                # The name of the process may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(entry) == pid or int(fields[1]) == pid:
+            total += (int(fields[11]) + int(fields[12])) / ticks
+    return total
+
+
+def _wait_for_server(port, timeout=10):
+    """
+    Sends jobs until the server confirms one.
+    """
+    xml, _ = create_message_xml("999", "Are you there?")
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        while time.monotonic() < deadline:
+            sock.sendto(xml.encode("UTF-8"), ("127.0.0.1", port))
+            try:
+                sock.recv(65536)
+                return
+            except socket.timeout:
+                pass
+    raise RuntimeError("The server did not start within {} seconds".format(timeout))
+
+
+def _write_sample_capture(path, count, rate, bases):
+    """
+    Writes a capture of `count` datagrams of SAMPLE_TRAFFIC at `rate` datagrams
+    per second. Every one of the `bases` BaseStations has its own handsets, so
+    they do not roam, and every job has its own externalid.
+    """
+
+    def handset(base, i):
+        return str(1000 + 100 * base + i).encode("ascii")
+
+    frames = []
+    for base in range(bases):
+        frames.append(
+            {
+                "systeminfo": _systeminfo([handset(base, i).decode() for i in range(3)]),
+                "systeminfo-large": _systeminfo([handset(base, i).decode() for i in range(100)]),
+                "login": SAMPLE_FRAMES["login"].replace(b"<address>42<", b"<address>" + handset(base, 0) + b"<"),
+                "alarm": SAMPLE_FRAMES["alarm"].replace(b"<address>99<", b"<address>" + handset(base, 1) + b"<"),
+                "job": SAMPLE_FRAMES["job"]
+                .replace(b"<address>23<", b"<address>" + handset(base, 2) + b"<")
+                .replace(b"<address>42<", b"<address>" + handset((base + 1) % bases, 2) + b"<"),
+                "status": SAMPLE_FRAMES["status"],
+            }
+        )
+
+    writer = CaptureWriter(path)
+    start = time.time()
+    for i in range(count):
+        base = i % bases
+        name = SAMPLE_TRAFFIC[i // bases % len(SAMPLE_TRAFFIC)]
+        data = frames[base][name]
+        if name == "job":
+            data = data.replace(b"1234567890", b"%010d" % i)
+        writer.write(data, ("192.168.1.{}".format(10 + base), 1300), start + i / rate)
+    writer.close()
+
+
+def bench_replay(args):
+    """
+    Replay of a capture into the whole server: the regression benchmark for parsing, dispatch and the outbox.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.capture
+        if path is None:
+            path = os.path.join(tmp, "sample.cap")
+            _write_sample_capture(path, args.count, args.rate, args.bases)
+        logging.getLogger().setLevel(args.log_level)
+        speed = "max" if args.speed is None else "{:g}x".format(args.speed)
+        print(f"Replaying {path if args.capture else 'sample traffic'} at {speed}:")
+        # Read while replaying, so the capture does not count towards the memory.
+        print_stats(asyncio.run(replay_direct(read_capture(path), args.speed)))
+
+
+def bench_workers(args):
+    """
+    Throughput of the server with several worker processes, driven by clients on the loopback interface.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    print(f"{os.cpu_count()} CPUs, {args.clients} client processes with {args.sockets} sockets and {args.window} jobs in flight each")
+    if args.keepalives:
+        print(f"plus {args.keepalives} systeminfo keep-alives/s from {args.bases} BaseStations with {args.handsets} handsets each")
+    baseline = None
+    for workers in args.workers:
+        server = subprocess.Popen(
+            [sys.executable, "snom_messaging.py", "--port", str(port), "--workers", str(workers), "--log-level", "ERROR"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        try:
+            _wait_for_server(port)
+            cpu = _process_cpu(server.pid)
+            with multiprocessing.Pool(args.clients + 1) as pool:
+                keepalives = None
+                if args.keepalives:
+                    keepalives = pool.apply_async(
+                        _generate_keepalives, (port, args.bases, args.handsets, args.keepalives, args.duration)
+                    )
+                replies = sum(pool.starmap(_generate_load, [(port, args.sockets, args.window, args.duration)] * args.clients))
+                keepalives = keepalives.get() if keepalives is not None else 0
+            cpu = _process_cpu(server.pid) - cpu
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+
+        line = f"{workers} workers: server CPU {cpu / args.duration * 100:4.0f}%"
+        if args.clients:
+            rate = replies / args.duration
+            baseline = baseline or rate
+            line += f", {rate:8.0f} jobs/s ({rate / baseline:.2f}x)"
+        if keepalives:
+            line += f", {keepalives / args.duration:.0f} keep-alives/s"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the Snom messaging server")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    journal_parser = subparsers.add_parser("journal", help=bench_journal.__doc__.strip().split("\n")[0])
+    journal_parser.add_argument("--count", type=int, default=20000, help="Messages to enqueue (default: 20000)")
+    journal_parser.add_argument("--recover-count", type=int, default=100000, help="Messages to recover (default: 100000)")
+    journal_parser.set_defaults(func=bench_journal)
+
+    templates_parser = subparsers.add_parser("templates", help=bench_templates.__doc__.strip().split("\n")[0])
+    templates_parser.add_argument("--count", type=int, default=200000, help="Messages to render (default: 200000)")
+    templates_parser.set_defaults(func=bench_templates)
+
+    parser_parser = subparsers.add_parser("parser", help=bench_parser.__doc__.strip().split("\n")[0])
+    parser_parser.add_argument("--count", type=int, default=10000, help="Datagrams per frame type and run (default: 10000)")
+    parser_parser.set_defaults(func=bench_parser)
+
+    datagrams_parser = subparsers.add_parser("datagrams", help=bench_datagrams.__doc__.strip().split("\n")[0])
+    datagrams_parser.add_argument("--rate", type=int, default=5000, help="Datagrams per second (default: 5000)")
+    datagrams_parser.add_argument("--duration", type=float, default=5, help="Seconds to run (default: 5)")
+    datagrams_parser.add_argument("--log-level", default="INFO", help="Level of the server log (default: INFO)")
+    datagrams_parser.add_argument("--log-queue", action="store_true", help="Write the log from a background thread")
+    datagrams_parser.set_defaults(func=bench_datagrams)
+
+    sender_parser = subparsers.add_parser("sender", help=bench_sender.__doc__.strip().split("\n")[0])
+    sender_parser.add_argument("--count", type=int, default=1000, help="Messages to send (default: 1000)")
+    sender_parser.add_argument("--max-in-flight", type=int, default=32, help="Messages in flight at once (default: 32)")
+    sender_parser.set_defaults(func=bench_sender)
+
+    submit_parser = subparsers.add_parser("submit", help=bench_submit.__doc__.strip().split("\n")[0])
+    submit_parser.add_argument("--count", type=int, default=10000, help="Messages to queue (default: 10000)")
+    submit_parser.add_argument("--max-in-flight", type=int, default=32, help="UDP messages in flight at once (default: 32)")
+    submit_parser.add_argument("--connections", type=int, default=4, help="Concurrent connections to the socket (default: 4)")
+    submit_parser.set_defaults(func=bench_submit)
+
+    events_parser = subparsers.add_parser("events", help=bench_events.__doc__.strip().split("\n")[0])
+    events_parser.add_argument("--rate", type=int, default=30000, help="Status events per second (default: 30000)")
+    events_parser.add_argument("--duration", type=float, default=5, help="Seconds to publish (default: 5)")
+    events_parser.add_argument("--buffer", type=int, default=10000, help="Events buffered per subscriber (default: 10000)")
+    events_parser.add_argument("--slow", type=float, default=0.05, help="Seconds a slow subscriber takes per batch (default: 0.05)")
+    events_parser.set_defaults(func=bench_events)
+
+    broadcast_parser = subparsers.add_parser("broadcast", help=bench_broadcast.__doc__.strip().split("\n")[0])
+    broadcast_parser.add_argument("--handsets", type=int, default=500, help="Recipients of the broadcast (default: 500)")
+    broadcast_parser.add_argument("--bases", type=int, default=5, help="BaseStations the handsets are spread over (default: 5)")
+    broadcast_parser.set_defaults(func=bench_broadcast)
+
+    ratelimit_parser = subparsers.add_parser("ratelimit", help=bench_ratelimit.__doc__.strip().split("\n")[0])
+    ratelimit_parser.add_argument("--messages", type=int, default=500, help="Messages queued for the BaseStation (default: 500)")
+    ratelimit_parser.add_argument("--capacity", type=int, default=100, help="Messages per second the BaseStation takes (default: 100)")
+    ratelimit_parser.add_argument("--buffer", type=int, default=20, help="Messages the BaseStation buffers (default: 20)")
+    ratelimit_parser.add_argument("--duration", type=float, default=15, help="Seconds to wait for delivery (default: 15)")
+    ratelimit_parser.set_defaults(func=bench_ratelimit)
+
+    priority_parser = subparsers.add_parser("priority", help=bench_priority.__doc__.strip().split("\n")[0])
+    priority_parser.add_argument("--backlog", type=int, default=5000, help="Routine messages queued (default: 5000)")
+    priority_parser.add_argument("--interval", type=float, default=0.1, help="Seconds between urgent messages (default: 0.1)")
+    priority_parser.add_argument("--duration", type=float, default=10, help="Seconds to queue urgent messages (default: 10)")
+    priority_parser.add_argument("--capacity", type=int, default=100, help="Messages per second the BaseStation takes (default: 100)")
+    priority_parser.add_argument("--buffer", type=int, default=20, help="Messages the BaseStation buffers (default: 20)")
+    priority_parser.set_defaults(func=bench_priority)
+
+    retry_parser = subparsers.add_parser("retry", help=bench_retry.__doc__.strip().split("\n")[0])
+    retry_parser.add_argument("--messages", type=int, default=10000, help="Messages to simulate (default: 10000)")
+    retry_parser.add_argument("--mean-absence", type=float, default=8, help="Average absence of a handset in hours (default: 8)")
+    retry_parser.add_argument("--seed", type=int, default=1, help="Seed of the simulation (default: 1)")
+    retry_parser.set_defaults(func=bench_retry)
+
+    lifecycle_parser = subparsers.add_parser("lifecycle", help=bench_lifecycle.__doc__.strip().split("\n")[0])
+    lifecycle_parser.add_argument("--messages", type=int, default=200, help="Recipients of the broadcast (default: 200)")
+    lifecycle_parser.add_argument("--capacity", type=int, default=100, help="Messages per second the BaseStation takes (default: 100)")
+    lifecycle_parser.add_argument("--drain-timeout", type=float, default=5, help="Seconds to drain messages in flight (default: 5)")
+    lifecycle_parser.set_defaults(func=bench_lifecycle)
+
+    workers_parser = subparsers.add_parser("workers", help=bench_workers.__doc__.strip().split("\n")[0])
+    workers_parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Numbers of worker processes to compare (default: 1 2 4 8)"
+    )
+    workers_parser.add_argument("--clients", type=int, default=4, help="Client processes sending jobs, may be 0 (default: 4)")
+    workers_parser.add_argument("--sockets", type=int, default=16, help="Sockets per client process (default: 16)")
+    workers_parser.add_argument("--window", type=int, default=8, help="Jobs in flight per socket (default: 8)")
+    workers_parser.add_argument("--duration", type=float, default=5, help="Seconds per run (default: 5)")
+    workers_parser.add_argument("--keepalives", type=int, default=0, help="Systeminfo keep-alives per second besides the jobs (default: 0)")
+    workers_parser.add_argument("--bases", type=int, default=50, help="BaseStations sending the keep-alives (default: 50)")
+    workers_parser.add_argument("--handsets", type=int, default=100, help="Handsets listed per keep-alive (default: 100)")
+    workers_parser.set_defaults(func=bench_workers)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help=bench_pipeline.__doc__.strip().split("\n")[0])
+    pipeline_parser.add_argument("--bases", type=int, default=10, help="BaseStations sending systeminfo (default: 10)")
+    pipeline_parser.add_argument("--handsets", type=int, default=300, help="Handsets per BaseStation (default: 300)")
+    pipeline_parser.add_argument("--bursts", type=int, default=20, help="Number of bursts (default: 20)")
+    pipeline_parser.add_argument("--interval", type=float, default=0.1, help="Seconds between bursts (default: 0.1)")
+    pipeline_parser.add_argument("--pool-workers", type=int, default=2, help="Threads or processes of the pool (default: 2)")
+    pipeline_parser.add_argument("--queue", type=int, default=10000, help="Datagrams queued for the pool at most (default: 10000)")
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    roaming_parser = subparsers.add_parser("roaming", help=bench_roaming.__doc__.strip().split("\n")[0])
+    roaming_parser.add_argument("--bases", type=int, default=100, help="BaseStations (default: 100)")
+    roaming_parser.add_argument("--handsets", type=int, default=200, help="Handsets per BaseStation (default: 200)")
+    roaming_parser.add_argument("--rounds", type=int, default=20, help="Keep-alives per BaseStation (default: 20)")
+    roaming_parser.set_defaults(func=bench_roaming)
+
+    rssi_parser = subparsers.add_parser("rssi", help=bench_rssi.__doc__.strip().split("\n")[0])
+    rssi_parser.add_argument("--bases", type=int, default=6, help="BaseStations along the corridor (default: 6)")
+    rssi_parser.add_argument("--handsets", type=int, default=200, help="Walking handsets (default: 200)")
+    rssi_parser.add_argument("--rounds", type=int, default=50, help="Rounds of reports and deliveries (default: 50)")
+    rssi_parser.add_argument("--speed", type=float, default=0.3, help="Standard deviation of a step between rounds (default: 0.3)")
+    rssi_parser.add_argument("--report", type=float, default=0.5, help="Chance a BaseStation reports the RSSI each round (default: 0.5)")
+    rssi_parser.add_argument("--seed", type=int, default=1, help="Seed of the simulation (default: 1)")
+    rssi_parser.set_defaults(func=bench_rssi)
+
+    replay_parser = subparsers.add_parser("replay", help=bench_replay.__doc__.strip().split("\n")[0])
+    replay_parser.add_argument("--capture", help="Capture file to replay (default: generated sample traffic)")
+    replay_parser.add_argument("--count", type=int, default=100000, help="Datagrams of sample traffic (default: 100000)")
+    replay_parser.add_argument("--rate", type=int, default=1000, help="Datagrams per second of sample traffic (default: 1000)")
+    replay_parser.add_argument("--bases", type=int, default=10, help="BaseStations sending the sample traffic (default: 10)")
+    replay_parser.add_argument(
+        "--speed",
+        default=None,
+        type=lambda value: None if value == "max" else float(value),
+        help="Speed relative to the capture, e.g. 1, 10 or max (default: max)",
+    )
+    replay_parser.add_argument("--log-level", default="ERROR", help="Log level of the server (default: ERROR)")
+    replay_parser.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import logging
+import socket
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+# A capture file starts with MAGIC, followed by one record per datagram:
+# The record header (_RECORD), the packed IP address of the sender
+# (4 bytes for IPv4, 16 bytes for IPv6) and the datagram as received.
+MAGIC = b"SNOMCAP\x01"
+
+# time received (seconds since the epoch), port, length of the address, length of the datagram
+_RECORD = struct.Struct("<dHBI")
+
+_FAMILIES = {4: socket.AF_INET, 16: socket.AF_INET6}
+
+
+class CaptureWriter:
+    """
+    This class writes incoming datagrams to a capture file, see UdpServer.recorder.
+
+    Records are buffered, so a crash may lose the last few of them.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, "wb", buffering=1 << 16)
+        self._file.write(MAGIC)
+        self.count = 0
+
+    def write(self, data, addr, when=None):
+        """
+        Appends a datagram received from addr (a (host, port) tuple) at `when`
+        (default: now).
+        """
+        host, port = addr[:2]
+        try:
+            packed = socket.inet_pton(socket.AF_INET6 if ":" in host else socket.AF_INET, host)
+        except (OSError, TypeError):
+            logger.warning("Not capturing datagram from %s: no IP address", addr)
+            return
+        self._file.write(_RECORD.pack(time.time() if when is None else when, port, len(packed), len(data)))
+        self._file.write(packed)
+        self._file.write(data)
+        self.count += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            logger.info("Captured %s datagrams to %s", self.count, self._path)
+
+
+def read_capture(path):
+    """
+    Yields (time, data, addr) for every datagram in a capture file.
+    Raises ValueError if the file is no capture or is cut off in the middle of a record.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is no capture file".format(path))
+        while True:
+            header = f.read(_RECORD.size)
+            if not header:
+                return
+            if len(header) < _RECORD.size:
+                raise ValueError("{} is truncated".format(path))
+            when, port, addr_length, data_length = _RECORD.unpack(header)
+            packed = f.read(addr_length)
+            data = f.read(data_length)
+            if len(packed) < addr_length or len(data) < data_length or addr_length not in _FAMILIES:
+                raise ValueError("{} is truncated or corrupt".format(path))
+            yield when, data, (socket.inet_ntop(_FAMILIES[addr_length], packed), port)
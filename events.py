@@ -0,0 +1,217 @@
+"""
+Delivery status events of the queued messages.
+
+The EventBus turns the status changes of MessageSystem into events:
+| {"id": 1234567890, "to": "102", "status": "delivered", "time": 1700000000.0}
+
+Events of the copies of a broadcast also have "broadcast". Consumers
+subscribe in the process (EventBus.subscribe()), over HTTP (GET /events
+of the admin API) or get the events posted to a webhook (Webhook).
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import ssl
+import time
+import urllib.parse
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_published = metrics.counter("snom_status_events_total", "Status events of messages", ("status",))
+_dropped = metrics.counter("snom_status_events_dropped_total", "Status events dropped because a subscriber was too slow", ("subscriber",))
+
+
+class Subscription:
+    """
+    The events for one subscriber, an async iterator over batches (lists)
+    of at most `batch` events:
+    | async for events in bus.subscribe("logger"):
+    |     ...
+
+    The buffer holds at most `size` events. If the subscriber falls behind,
+    the oldest events are dropped and counted in dropped, so a slow
+    subscriber never holds up the event loop or the other subscribers.
+    extensions and statuses restrict the events to those recipients and states.
+    """
+
+    def __init__(self, bus, name, extensions=None, statuses=None, size=10000, batch=100):
+        self.name = name
+        self.extensions = set(extensions) if extensions else None
+        self.statuses = set(statuses) if statuses else None
+        self.size = size
+        self.batch = batch
+        self.dropped = 0
+        self._bus = bus
+        self._events = collections.deque()
+        self._waiter = None
+        self._closed = False
+
+    def __repr__(self):
+        return "<Subscription {} {} buffered, {} dropped>".format(self.name, len(self._events), self.dropped)
+
+    def __len__(self):
+        return len(self._events)
+
+    def put(self, event):
+        if self.extensions is not None and event["to"] not in self.extensions:
+            return
+        if self.statuses is not None and event["status"] not in self.statuses:
+            return
+        if len(self._events) >= self.size:
+            self._events.popleft()
+            self.dropped += 1
+            _dropped.inc((self.name,))
+        self._events.append(event)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def get_nowait(self):
+        """
+        Returns the next batch of buffered events, possibly empty.
+        """
+        events = self._events
+        count = min(len(events), self.batch)
+        return [events.popleft() for _ in range(count)]
+
+    def close(self):
+        self._closed = True
+        self._bus.unsubscribe(self)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._events:
+            if self._closed:
+                raise StopAsyncIteration
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self.get_nowait()
+
+
+class EventBus:
+    """
+    This class publishes the status changes of the messages of a
+    MessageSystem to its subscriptions.
+    """
+
+    def __init__(self, message_system):
+        self._message_system = message_system
+        self._subscriptions = []
+        message_system.add_listener(self._status_changed)
+
+    def close(self):
+        self._message_system.remove_listener(self._status_changed)
+        for subscription in list(self._subscriptions):
+            subscription.close()
+
+    def subscribe(self, name, extensions=None, statuses=None, size=10000, batch=100):
+        """
+        Returns a new Subscription, see there. name identifies it in the metrics.
+        """
+        subscription = Subscription(self, name, extensions, statuses, size, batch)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    def _status_changed(self, message, status):
+        _published.inc((status,))
+        if not self._subscriptions:
+            return
+        event = {"id": message.internal_ext_id, "to": message.to_ext, "status": status, "time": time.time()}
+        if message.broadcast is not None:
+            event["broadcast"] = message.broadcast.id
+        for subscription in self._subscriptions:
+            subscription.put(event)
+
+
+class Webhook:
+    """
+    Posts the events of a Subscription to an HTTP(S) URL, one JSON object
+    per line and up to `batch` events per request. Events that arrive while
+    a request is in flight go into the next one.
+
+    If the URL fails, the batch is posted again after `retry` seconds;
+    meanwhile the subscription keeps buffering (and dropping the oldest
+    events when it is full).
+    """
+
+    timeout = 10.0
+    retry = 5.0
+
+    def __init__(self, bus, url, batch=100, size=10000):
+        self.url = url
+        self.posted = 0
+        self._url = urllib.parse.urlsplit(url)
+        if self._url.scheme not in ("http", "https"):
+            raise ValueError("webhook URL {} is not http or https".format(url))
+        if not self._url.hostname:
+            raise ValueError("webhook URL {} has no host".format(url))
+        self._subscription = bus.subscribe("webhook", size=size, batch=batch)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info("Posting status events to %s", self.url)
+
+    async def stop(self):
+        """
+        Posts what is buffered (within timeout) and stops.
+        """
+        self._subscription.close()
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._task, self.timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Dropping %s status events for %s", len(self._subscription), self.url)
+            self._task = None
+
+    async def _run(self):
+        async for events in self._subscription:
+            body = "".join(json.dumps(event) + "\n" for event in events).encode("UTF-8")
+            while True:
+                try:
+                    await asyncio.wait_for(self._post(body), self.timeout)
+                    break
+                except (OSError, asyncio.TimeoutError, ValueError) as exp:
+                    logger.warning("Posting %s status events to %s failed: %s", len(events), self.url, exp)
+                    await asyncio.sleep(self.retry)
+            self.posted += len(events)
+
+    async def _post(self, body):
+        url = self._url
+        secure = url.scheme == "https"
+        port = url.port or (443 if secure else 80)
+        reader, writer = await asyncio.open_connection(url.hostname, port, ssl=ssl.create_default_context() if secure else None)
+        try:
+            path = url.path or "/"
+            if url.query:
+                path += "?" + url.query
+            # Not netloc, that may contain user:password@
+            host = "[{}]".format(url.hostname) if ":" in url.hostname else url.hostname
+            if url.port:
+                host += ":{}".format(url.port)
+            head = "POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/x-ndjson\r\nContent-Length: {}\r\nConnection: close\r\n\r\n"
+            writer.write(head.format(path, host, len(body)).encode("ascii") + body)
+            await writer.drain()
+            status_line = await reader.readline()
+            try:
+                status = int(status_line.split()[1])
+            except (IndexError, ValueError):
+                raise ValueError("malformed response {!r}".format(status_line[:100]))
+            if not 200 <= status < 300:
+                raise ValueError("status {}".format(status))
+        finally:
+            writer.close()
@@ -0,0 +1,314 @@
+import html
+import re
+
+# Matches the start-tag of the root element. The XML declaration does not match.
+_ROOT = re.compile(rb"<([A-Za-z_][\w.-]*)([^>]*)>")
+_TYPE = re.compile(rb"""\btype\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+_ATTRIBUTE = re.compile(rb"""([\w.:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)')""")
+
+# Lookup plans per path, see _plan()
+_PLANS = {}
+
+
+def _plan(path):
+    """
+    Returns how to look up path:
+    A tuple of the path of the parent element (None for the root), the name of
+    the element as bytes, the start of its start-tag ("<name"), its end-tag
+    and two precompiled patterns:
+    * Matches the start-tag of the element. Group 1 is "/" for empty elements.
+    * Matches a whole element containing nothing but text. Group 1 is the text.
+    """
+
+    plan = _PLANS.get(path)
+    if plan is None:
+        names = [name for name in path.strip("/").split("/") if name not in ("", ".")]
+        if not names:
+            raise ValueError("Empty path: {!r}".format(path))
+        name = names[-1].encode("UTF-8")
+        escaped = re.escape(name)
+        plan = (
+            "/".join(names[:-1]) or None,
+            name,
+            b"<" + name,
+            b"</" + name + b">",
+            re.compile(rb"<" + escaped + rb"(?:\s[^>]*?)?(/?)>"),
+            re.compile(rb"<" + escaped + rb"(?:\s[^>]*?)?(?:/>|>([^<]*)</" + escaped + rb"\s*>)"),
+        )
+        _PLANS[path] = plan
+    return plan
+
+
+def classify(data):
+    """
+    Reads the tag and the type-attribute of the root element of a message.
+
+    This only looks at the first few bytes of the message.
+    Returns a (tag, type) tuple of strings or None if this is no XML message.
+    type is None if the root element has no type-attribute.
+    """
+
+    match = _ROOT.search(data)
+    if match is None:
+        return None
+
+    msg_type = _TYPE.search(match.group(2))
+    if msg_type is not None:
+        msg_type = _text(msg_type.group(1) if msg_type.group(1) is not None else msg_type.group(2))
+    return match.group(1).decode("UTF-8"), msg_type
+
+
+class Frame:
+    """
+    This class is a lazily parsed view of a single XML message.
+
+    Only the tag and the type of the root element are read when the Frame is
+    created. Everything else is read from the raw bytes when it is asked for,
+    no tree is built. Every step of a path is looked up with a precompiled
+    regular expression within the content of the element found by the step
+    before. Results are cached. get() first tries a plain search for the
+    start-tag, which finds most elements of the BaseStations' frames.
+
+    Paths are relative to the root element and use '/' as separator,
+    e.g. "senderdata/address". The first element with a matching name inside
+    the parent is used, so elements must not contain descendants with the
+    same name as one of their children. This holds for all frames sent
+    by the BaseStations.
+    """
+
+    __slots__ = ("data", "tag", "type", "_header", "_attrib", "_root", "_cache", "_spans")
+
+    def __init__(self, data):
+        """
+        Creates a Frame from the bytes of one message (without the trailing \\0).
+        Raises ValueError if data does not look like XML.
+        """
+
+        self.data = data
+
+        match = _ROOT.search(data)
+        if match is None:
+            raise ValueError("No XML root element found")
+
+        self.tag = match.group(1).decode("UTF-8")
+        self._header = match.group(2)
+        self._attrib = None
+
+        msg_type = _TYPE.search(self._header)
+        if msg_type is not None:
+            msg_type = _text(msg_type.group(1) if msg_type.group(1) is not None else msg_type.group(2))
+        self.type = msg_type
+
+        if self._header.endswith(b"/"):
+            self._root = (match.end(), match.end())
+        else:
+            end = data.rfind(b"</" + match.group(1))
+            if end < match.end():
+                raise ValueError("Root element {} is not closed".format(self.tag))
+            self._root = (match.end(), end)
+
+        self._cache = {}
+        self._spans = {}
+
+    @classmethod
+    def from_values(cls, tag, msg_type, values):
+        """
+        Creates a Frame without raw bytes from the texts read from another
+        one, e.g. by materialize(): values is a dict of path => list of texts.
+        Other paths are not found.
+        """
+
+        self = cls.__new__(cls)
+        self.data = b""
+        self.tag = tag
+        self.type = msg_type
+        self._header = b""
+        self._attrib = None
+        self._root = (0, 0)
+        self._cache = dict(values)
+        self._spans = {}
+        return self
+
+    def __repr__(self):
+        return "<Frame {} type={}>".format(self.tag, self.type)
+
+    @property
+    def attrib(self):
+        """
+        The attributes of the root element as dict.
+        """
+
+        if self._attrib is None:
+            self._attrib = {}
+            for attribute in _ATTRIBUTE.finditer(self._header):
+                value = attribute.group(2) if attribute.group(2) is not None else attribute.group(3)
+                self._attrib[attribute.group(1).decode("UTF-8")] = _text(value)
+        return self._attrib
+
+    def get(self, path, default=None):
+        """
+        Returns the text of the first element at path.
+        Returns default if there is no such element.
+        Empty elements have the text "".
+        """
+
+        values = self._cache.get(path)
+        if values is None:
+            value = self._first(path)
+            if value is not None:
+                return value
+            values = self._lookup(path)
+        return values[0] if values else default
+
+    def get_int(self, path, default=None):
+        """
+        Returns the text of the first element at path as int.
+        Returns default if there is no such element or it is no number.
+        """
+
+        value = self.get(path)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
+    def getall(self, path):
+        """
+        Returns a list of the texts of all elements at path.
+        """
+
+        values = self._cache.get(path)
+        if values is None:
+            values = self._lookup(path)
+        return values
+
+    def has(self, path):
+        """
+        Returns True if there is at least one element at path.
+        """
+
+        return bool(self.getall(path))
+
+    def materialize(self, paths):
+        """
+        Reads all given paths into the cache, so the raw bytes do not need to be
+        scanned again. Returns the Frame itself.
+        """
+
+        for path in paths:
+            self.getall(path)
+        return self
+
+    def _span(self, path):
+        """
+        Returns the (start, end) span of the content of the first element at path
+        or None if there is no such element.
+        """
+
+        if path is None:
+            return self._root
+        if path in self._spans:
+            return self._spans[path]
+
+        span = None
+        parent, name, tag, _, start_tag, _ = _plan(path)
+        parent_span = self._span(parent)
+        if parent_span is not None:
+            data = self.data
+            start, end = parent_span
+            found = data.find(tag, start, end) + len(tag)
+            if found >= len(tag) and found < end and data[found] == 62:  # ">"
+                # Most elements have no attributes.
+                close = data.find(b"</" + name, found, end)
+                if close >= 0:
+                    span = (found + 1, close)
+                match = None
+            else:
+                match = start_tag.search(data, start, end)
+            if match is not None:
+                if match.group(1):
+                    span = (match.end(), match.end())
+                else:
+                    close = data.find(b"</" + name, match.end(), end)
+                    if close >= 0:
+                        span = (match.end(), close)
+        self._spans[path] = span
+        return span
+
+    def _first(self, path):
+        """
+        Returns the text of the first element at path if it is just <name>text</name>.
+        Returns None otherwise, e.g. if it has attributes, contains more than
+        text or there is no such element. The text is not cached.
+        """
+
+        parent, _, tag, end_tag, _, _ = _PLANS.get(path) or _plan(path)
+        span = self._spans.get(parent) or self._span(parent)
+        if span is None:
+            return None
+        data = self.data
+        start = data.find(tag, span[0], span[1]) + len(tag)
+        if start < len(tag) or start >= span[1] or data[start] != 62:  # ">"
+            return None
+        close = data.find(b"<", start + 1, span[1])
+        if close < 0 or not data.startswith(end_tag, close):
+            return None
+        text = data[start + 1 : close].decode("UTF-8", errors="replace")
+        return html.unescape(text) if "&" in text else text
+
+    def _lookup(self, path):
+        """
+        Reads the texts of all elements at path and puts them into the cache.
+        """
+
+        values = []
+        parent, name, _, _, _, leaf = _plan(path)
+        span = self._span(parent)
+        if span is not None:
+            data = self.data
+            start, end = span
+            values = leaf.findall(data, start, end)
+            if len(values) != data.count(b"<" + name, start, end):
+                # Some elements contain more than text (e.g. CDATA or children).
+                values = self._read_elements(path, start, end)
+            if len(values) == 1:
+                values = [_text(values[0])]
+            elif values:
+                # Decoding everything at once is a lot faster for long lists.
+                values = b"\0".join(values).decode("UTF-8", errors="replace").split("\0")
+                if data.find(b"&", start, end) >= 0:
+                    values = [html.unescape(value) for value in values]
+
+        self._cache[path] = values
+        return values
+
+    def _read_elements(self, path, start, end):
+        """
+        Returns the raw text of all elements at path within data[start:end].
+        Like ElementTree the text is the content before the first child element.
+        """
+
+        data = self.data
+        _, name, _, _, start_tag, _ = _plan(path)
+        values = []
+        for match in start_tag.finditer(data, start, end):
+            if match.group(1):
+                values.append(b"")
+                continue
+            close = data.find(b"</" + name, match.end(), end)
+            if close < 0:
+                break
+            raw = data[match.end() : close]
+            if raw.startswith(b"<![CDATA["):
+                raw = raw[9 : raw.find(b"]]>")].replace(b"&", b"&amp;")
+            elif b"<" in raw:
+                raw = raw[: raw.find(b"<")]
+            values.append(raw)
+        return values
+
+
+def _text(raw):
+    text = raw.decode("UTF-8", errors="replace")
+    if "&" in text:
+        text = html.unescape(text)
+    return text
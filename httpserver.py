@@ -0,0 +1,210 @@
+import asyncio
+import inspect
+import logging
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class HttpError(Exception):
+    """
+    Raised by handlers to answer with an error status.
+    """
+
+    def __init__(self, status, message=""):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Request:
+    """
+    An HTTP request. query maps the names of the query parameters to their
+    last value, headers are keyed by lower case names.
+    """
+
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+
+class HttpServer:
+    """
+    This class is a minimal HTTP/1.1 server on the event loop of the
+    messaging server, for local tools like a metrics scraper.
+
+    Handlers are registered per method and path with route(). They are
+    called as handler(request), may be coroutines and return a tuple
+    (status, content type, body). body is bytes, or an iterable or async
+    iterable of bytes that is streamed with chunked transfer encoding: The
+    event loop keeps running while a slow client reads a large response.
+    Every connection serves a single request.
+    """
+
+    # Limits of a request
+    max_header = 8192
+    max_body = 1 << 20
+    timeout = 10.0
+
+    def __init__(self, host="127.0.0.1", port=9300):
+        self._host = host
+        self._port = port
+        self._routes = {}
+        self._server = None
+        self._writers = set()
+
+    @property
+    def port(self):
+        return self._port
+
+    def route(self, method, path, handler):
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self._host, self._port, limit=self.max_header)
+        # The port the system chose for port 0
+        self._port = self._server.sockets[0].getsockname()[1]
+        logger.info("HTTP server listening on %s:%s", self._host, self._port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # wait_closed() waits for the connections too, e.g. of /events
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), self.timeout)
+                status, content_type, body = await self._call(request)
+            except HttpError as exp:
+                status, content_type, body = exp.status, "text/plain; charset=utf-8", (exp.message + "\n").encode("UTF-8")
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                return
+            except Exception as exp:
+                logger.warning("HTTP handler failed: %s", exp)
+                status, content_type, body = 500, "text/plain; charset=utf-8", b"internal error\n"
+
+            head = "HTTP/1.1 {} {}\r\nContent-Type: {}\r\nConnection: close\r\n".format(status, _REASONS.get(status, ""), content_type)
+            if isinstance(body, bytes):
+                writer.write("{}Content-Length: {}\r\n\r\n".format(head, len(body)).encode("ascii"))
+                writer.write(body)
+            else:
+                writer.write((head + "Transfer-Encoding: chunked\r\n\r\n").encode("ascii"))
+                if hasattr(body, "__aiter__"):
+                    await self._stream(reader, writer, body)
+                else:
+                    for chunk in body:
+                        await self._write_chunk(writer, chunk)
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception as exp:
+            # The headers are out already, the client sees a truncated response.
+            logger.warning("HTTP response failed: %s", exp)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _stream(self, reader, writer, body):
+        """
+        Writes the chunks of an async iterable body. A body that waits for
+        its next chunk (like /events) is closed as soon as the client closes
+        the connection, not only when the next write fails.
+        """
+        disconnected = asyncio.ensure_future(self._wait_disconnect(reader))
+        chunks = body.__aiter__()
+        try:
+            while True:
+                chunk = asyncio.ensure_future(chunks.__anext__())
+                await asyncio.wait((chunk, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if not chunk.done():
+                    chunk.cancel()
+                    await asyncio.wait((chunk,))
+                    raise ConnectionResetError("client closed the connection")
+                try:
+                    data = chunk.result()
+                except StopAsyncIteration:
+                    break
+                await self._write_chunk(writer, data)
+        finally:
+            disconnected.cancel()
+            if hasattr(body, "aclose"):
+                await body.aclose()
+
+    @staticmethod
+    async def _wait_disconnect(reader):
+        """
+        Returns when the client closed the connection. Every connection serves
+        a single request, anything the client sends after it is ignored.
+        """
+        try:
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+
+    @staticmethod
+    async def _write_chunk(writer, chunk):
+        if chunk:
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            await writer.drain()
+
+    async def _read_request(self, reader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise HttpError(413, "request header too large")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise HttpError(400, "malformed request line")
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HttpError(400, "malformed Content-Length")
+        if length > self.max_body:
+            raise HttpError(413, "request body too large")
+        body = await reader.readexactly(length) if length else b""
+
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        return Request(method, urllib.parse.unquote(url.path), query, headers, body)
+
+    async def _call(self, request):
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                raise HttpError(405, "method not allowed")
+            raise HttpError(404, "not found")
+        result = handler(request)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
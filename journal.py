@@ -0,0 +1,361 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+_ESCAPE = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n"})
+_UNESCAPE = {"\\": "\\", "t": "\t", "n": "\n"}
+_ESCAPE_SEQUENCE = re.compile(r"\\(.)")
+
+
+def _encode(entry):
+    """
+    Encodes a list of values as one line of the journal.
+    """
+    return "\t".join("" if value is None else str(value).translate(_ESCAPE) for value in entry) + "\n"
+
+
+def _unescape(field):
+    return _ESCAPE_SEQUENCE.sub(lambda m: _UNESCAPE.get(m.group(1), m.group(1)), field)
+
+
+class Journal:
+    """
+    This class implements an append-only journal of the outbox.
+
+    Every transition of a queued message is written as one line of
+    tab-separated fields:
+    * q <record...>: A message was queued. <record> is Message.to_record().
+    * a <internal id> <time>: A send attempt was made.
+    * d <internal id> <reason>: The message left the queue (delivered / expired).
+    Tabs, newlines and backslashes inside a field are escaped with a backslash.
+    All values are read back as strings.
+
+    Records are collected in memory and written with a single write() and
+    fsync() per commit interval (group commit). Callbacks passed to append()
+    are called once the record is on disk.
+    Without group commit every record is synced on its own.
+
+    The file is only written by a thread of its own, so the event loop never
+    waits for the disk. With group commit one write is in flight at a time:
+    Records appended meanwhile are written together once it is done.
+    Without group commit several writes may be in flight. Once one fails, the
+    thread skips the others and all of them are written again in order, so
+    e.g. a "d" record never ends up before the "q" record of its message.
+
+    The journal only grows. compact() rewrites it with the queued messages
+    still alive.
+    """
+
+    # Seconds to wait before a failed write is tried again
+    retry_interval = 1.0
+
+    def __init__(self, path, group_commit=True, commit_interval=0.005):
+        """
+        Opens (or creates) the journal at `path`.
+
+        commit_interval is the maximum time in seconds a record waits in
+        memory before it is written when group commit is enabled.
+        """
+
+        self._path = path
+        self._group_commit = group_commit
+        self._commit_interval = commit_interval
+
+        self._buffer = []
+        self._callbacks = []
+        self._flush_handle = None
+
+        # The writes in flight as (future, data, callbacks, compacted), see _start_write()
+        self._writing = collections.deque()
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="journal")
+        self._closed = False
+        # Writes are started in generations, a failed write ends its
+        # generation: The writer thread skips the remaining writes of it.
+        self._generation = 0
+        self._failed_generation = None
+
+        # number of records in the file and number of messages alive in it
+        self._records = 0
+        self._live = 0
+
+        self._file = open(path, "a", encoding="UTF-8")
+
+    def recover(self):
+        """
+        Reads the journal and returns the state of all messages that have not
+        left the queue yet.
+
+        Returns a list of (record, last_send_try) tuples in the order
+        the messages were queued.
+        """
+
+        with open(self._path, "rb") as f:
+            data = f.read()
+
+        # The last line is incomplete if we crashed while writing it.
+        # Cut it off, so new records start on a fresh line.
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            logger.warning("Ignoring incomplete last record in journal %s", self._path)
+            os.truncate(self._path, end)
+
+        text = data[:end].decode("UTF-8", errors="replace")
+        lines = text.split("\n")
+        del lines[-1]
+
+        queued = self._replay(lines, "\\" in text)
+        self._records = len(lines)
+        self._live = len(queued)
+        logger.info("Recovered %s queued messages from %s journal records", self._live, self._records)
+
+        return [(entry[1:], float(last_send_try)) for entry, last_send_try in queued.values()]
+
+    def _replay(self, lines, escaped=True):
+        """
+        Replays the lines of the journal.
+        Returns a dict of internal id => [q entry, last_send_try] of the messages still queued.
+
+        Without `escaped` no line contains a backslash, so the fields need
+        no unescaping. This loop dominates the startup time of a large queue.
+        """
+
+        queued = {}
+        get = queued.get
+        for line in lines:
+            entry = line.split("\t")
+            if escaped and "\\" in line:
+                entry = [_unescape(field) for field in entry]
+
+            kind = entry[0]
+            if kind == "a" and len(entry) == 3:
+                state = get(entry[1])
+                if state is not None:
+                    state[1] = entry[2]
+            elif kind == "q" and len(entry) > 2:
+                queued[entry[1]] = [entry, 0]
+            elif kind == "d" and len(entry) == 3:
+                queued.pop(entry[1], None)
+            else:
+                logger.warning("Ignoring corrupt record in journal %s: %r", self._path, line)
+        return queued
+
+    def queued(self, record, callback=None):
+        self._live += 1
+        self.append(["q"] + record, callback)
+
+    def attempted(self, internal_ext_id, when):
+        self.append(["a", internal_ext_id, when])
+
+    def done(self, internal_ext_id, reason):
+        self._live -= 1
+        self.append(["d", internal_ext_id, reason])
+
+    def append(self, entry, callback=None):
+        """
+        Appends an entry to the journal.
+
+        callback is called without arguments once the entry is on disk.
+        """
+
+        self._buffer.append(_encode(entry))
+        if callback is not None:
+            self._callbacks.append(callback)
+
+        if not self._group_commit:
+            self.flush()
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self._commit_interval, self.flush)
+
+    def flush(self):
+        """
+        Starts writing all buffered entries to disk. Their callbacks are
+        called once the entries are synced.
+        """
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if self._buffer and not (self._writing and self._group_commit):
+            self._start_write(self._write, "".join(self._buffer), None)
+
+    def _start_write(self, write, data, compacted):
+        """
+        Runs write(data) in the writer thread and takes over the buffer, its
+        callbacks are called once the write is done. compacted is the number
+        of records of a rewritten journal, None if data is appended.
+        """
+
+        buffered = data if compacted is None else "".join(self._buffer)
+        callbacks = self._callbacks
+        self._buffer, self._callbacks = [], []
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(self._run, write, data, self._generation)
+        self._writing.append((future, buffered, callbacks, compacted))
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._written, future))
+
+    def _written(self, future):
+        """
+        Called on the event loop once a write is done. The writer thread
+        does them in order.
+        """
+
+        if not self._writing or self._writing[0][0] is not future:
+            # close() or the failure of a write before took care of it
+            return
+        exp = future.exception()
+        if exp is not None:
+            logger.error("Writing journal %s failed: %s", self._path, exp)
+            # The writes after this one are skipped, all of them are written again.
+            failed = list(self._writing)
+            self._writing.clear()
+            self._generation += 1
+            self._buffer[:0] = [data for _, data, _, _ in failed]
+            self._callbacks[:0] = [callback for _, _, callbacks, _ in failed for callback in callbacks]
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self._flush_handle = asyncio.get_running_loop().call_later(self.retry_interval, self.flush)
+            return
+
+        _, data, callbacks, compacted = self._writing.popleft()
+        self._committed(data, callbacks, compacted)
+        if self._buffer:
+            self.flush()
+
+    def _committed(self, data, callbacks, compacted):
+        """
+        Counts the records written and calls their callbacks.
+        """
+
+        if compacted is None:
+            self._records += data.count("\n")
+        else:
+            logger.info("Compacted journal %s from %s to %s records", self._path, self._records, compacted)
+            self._records = compacted
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as exp:
+                logger.warning("Journal callback %s failed with exception %s.", callback, exp)
+
+    def _run(self, write, data, generation):
+        """
+        Runs write(data) unless a write of the same generation failed before.
+        This runs in the writer thread.
+        """
+
+        if self._failed_generation == generation:
+            raise OSError("skipped after a failed write")
+        try:
+            write(data)
+        except Exception:
+            self._failed_generation = generation
+            raise
+
+    def _write(self, data):
+        """
+        Appends data to the journal and syncs it. This runs in the writer thread.
+        """
+
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def wants_compaction(self):
+        """
+        Returns True if most of the journal is made up of dead records.
+        """
+
+        return self._records > 4 * self._live + 10000
+
+    def compact(self, records):
+        """
+        Rewrites the journal so it only contains `records`.
+
+        `records` are the (record, last_send_try) tuples of all messages
+        still alive, like they are returned by recover(). They supersede the
+        buffered entries, whose callbacks are called once the new journal is
+        synced. Nothing happens while a write is in flight, wants_compaction()
+        then stays True.
+        """
+
+        if self._writing:
+            return
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        lines = []
+        for record, last_send_try in records:
+            lines.append(_encode(["q"] + record))
+            if last_send_try:
+                lines.append(_encode(["a", record[0], last_send_try]))
+        self._start_write(self._rewrite, "".join(lines), len(lines))
+
+    def _rewrite(self, data):
+        """
+        Replaces the journal with data. This runs in the writer thread.
+        """
+
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._file.close()
+        os.replace(tmp_path, self._path)
+        self._sync_directory()
+        self._file = open(self._path, "a", encoding="UTF-8")
+
+    def _sync_directory(self):
+        """
+        Makes the rename of a compacted journal durable.
+        """
+
+        fd = os.open(os.path.dirname(os.path.abspath(self._path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """
+        Writes everything buffered and closes the journal. This blocks until
+        it is on disk, also when called from the event loop.
+        """
+
+        if self._closed:
+            return
+        self._closed = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        self._executor.shutdown(wait=True)
+        failed, failed_callbacks = [], []
+        while self._writing:
+            future, data, callbacks, compacted = self._writing.popleft()
+            if future.exception() is None:
+                self._committed(data, callbacks, compacted)
+            else:
+                failed.append(data)
+                failed_callbacks.extend(callbacks)
+        self._buffer[:0] = failed
+        self._callbacks[:0] = failed_callbacks
+
+        if self._buffer:
+            data = "".join(self._buffer)
+            self._write(data)
+            self._buffer = []
+            callbacks, self._callbacks = self._callbacks, []
+            self._committed(data, callbacks, None)
+        self._file.close()
@@ -0,0 +1,42 @@
+import logging
+import logging.handlers
+import queue
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+def setup_logging(level=logging.INFO, filename=None, use_queue=False, label=None):
+    """
+    Configures the root logger of the server.
+
+    Records are written to `filename` or to stderr if no filename is given.
+    With use_queue the handlers do not run on the event loop: Records are put
+    into a queue and written by a background thread, so slow disks or
+    syslog can not block the server.
+    label is put in front of every record, e.g. to tell several worker
+    processes apart.
+
+    Returns the QueueListener of the background thread or None.
+    The listener has to be stopped on shutdown to write the remaining records.
+    """
+
+    if filename:
+        handler = logging.FileHandler(filename, encoding="UTF-8")
+    else:
+        handler = logging.StreamHandler()
+    log_format = LOG_FORMAT
+    if label:
+        log_format = log_format.replace("%(name)s", "[{}] %(name)s".format(label.replace("%", "%%")))
+    handler.setFormatter(logging.Formatter(log_format))
+
+    listener = None
+    if use_queue:
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+        handler = logging.handlers.QueueHandler(records)
+
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+
+    if listener is not None:
+        listener.start()
+    return listener
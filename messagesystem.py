@@ -1,50 +1,26 @@
 import asyncio
+import gc
 import logging
 import random
 import time
 
-logger = logging.getLogger(__name__)
-
-
-class Message:
-    """
-    This class encapsulates a Text-Message with it's metadata.
-    """
-
-    def __init__(self, xml_message):
-        """
-        Creates a Message from it's XML-Element-Tree representation.
-        """
-
-        self.created = time.time()
-        self.last_send_try = 0
-
-        self._xml_message = xml_message
+import metrics
+from outbox import Outbox
+from ratelimit import RateController
+from retry import RetryPolicies
+from templates import Template
 
-        self.ext_id = xml_message.find("./externalid").text
-        self.message = xml_message.find("./jobdata/messages/messageuui").text
-        self.from_name = xml_message.find("./senderdata/name").text
-        self.from_ext = xml_message.find("./senderdata/address").text
-        self.from_loc = xml_message.find("./senderdata/location").text
-        self.to_ext = xml_message.find("./persondata/address").text
-        self.sysdata_datetime = xml_message.find("./systemdata/datetime").text
-        self.sysdata_ts = xml_message.find("./systemdata/timestamp").text
-
-        # This 10-Digit random number will be used as ID, when re-sending
-        # the message to it's recipient.
-        self.internal_ext_id = random.randrange(9999999999 + 1)
-
-    def get_messageresponse(self):
-        """
-        This function creates a 'received confirmation' for a received message.
-        It seems the BaseStations are somewhat picky on the format of the XML.
-        Thus I am using a template here to create the binary-xml I really want.
+logger = logging.getLogger(__name__)
 
-        'Received confirmations' are empty message containing the same externalid
-        and an empty message. They are send with senderdata and persondata swapped.
-        """
+_status_received = metrics.counter("snom_status_received_total", "Status answers of the BaseStations, by status code", ("status",))
+_retries = metrics.counter("snom_retries_total", "Messages sent again, by outcome of the previous attempt", ("outcome",))
+_finished = metrics.counter("snom_messages_finished_total", "Messages removed from the queue, by reason", ("reason",))
+_delivery_seconds = metrics.histogram(
+    "snom_delivery_seconds", "Time from queueing a message to its status 1", ("priority",), buckets=metrics.DELIVERY_BUCKETS
+)
 
-        response = """<?xml version="1.0" encoding="UTF-8"?>
+_RESPONSE_TEMPLATE = Template(
+    """<?xml version="1.0" encoding="UTF-8"?>
 <response version="19.11.12.1403" type="job">
 <externalid>{{eid}}</externalid>
 <systemdata>
@@ -55,7 +31,7 @@ class Message:
 <statusinfo>System running</statusinfo>
 </systemdata>
 <jobdata>
-<priority>0</priority>
+<priority>{{priority}}</priority>
 <messages>
 <message1></message1>
 <message2></message2>
@@ -76,25 +52,10 @@ class Message:
 </persondata>
 </response>
 \0"""
-        response = response.replace("{{eid}}", self.ext_id)
-        response = response.replace("{{from_ext}}", self.from_ext)
-        response = response.replace("{{from_name}}", self.from_name)
-        response = response.replace("{{from_loc}}", self.from_loc)
-        response = response.replace("{{to_ext}}", self.to_ext)
-        response = response.replace("{{dt}}", self.sysdata_datetime)
-        response = response.replace("{{ts}}", self.sysdata_ts)
-        return response
-
-    def get_message(self):
-        """
-        This function creates a new message for a received message.
-        It seems the BaseStations are somewhat picky on the format of the XML.
-        Thus I am using a template here to create the binary-xml I really want.
+)
 
-        The new message looks like the one we received. But we can re-create it anytime
-        we want.
-        """
-        message = """<?xml version="1.0" encoding="UTF-8"?>
+_MESSAGE_TEMPLATE = Template(
+    """<?xml version="1.0" encoding="UTF-8"?>
 <request version="19.11.12.1403" type="job">
 <externalid>{{eid}}</externalid>
 <systemdata>
@@ -105,7 +66,7 @@ class Message:
 <statusinfo>System running</statusinfo>
 </systemdata>
 <jobdata>
-<priority>0</priority>
+<priority>{{priority}}</priority>
 <messages>
 <message1></message1>
 <message2></message2>
@@ -124,15 +85,262 @@ class Message:
 </persondata>
 </request>
 \0"""
-        message = message.replace("{{eid}}", "{:010}".format(self.internal_ext_id))
-        message = message.replace("{{from_ext}}", self.from_ext)
-        message = message.replace("{{from_name}}", self.from_name)
-        message = message.replace("{{from_loc}}", self.from_loc)
-        message = message.replace("{{to_ext}}", self.to_ext)
-        message = message.replace("{{dt}}", self.sysdata_datetime)
-        message = message.replace("{{ts}}", self.sysdata_ts)
-        message = message.replace("{{msg}}", self.message)
-        return message
+)
+
+
+class Message:
+    """
+    This class encapsulates a Text-Message with it's metadata.
+    """
+
+    def __init__(self, frame):
+        """
+        Creates a Message from the Frame it was received in.
+        """
+
+        self.created = time.time()
+        self._init_state()
+
+        self.ext_id = frame.get("externalid")
+        self.message = frame.get("jobdata/messages/messageuui")
+        self.from_name = frame.get("senderdata/name")
+        self.from_ext = frame.get("senderdata/address")
+        self.from_loc = frame.get("senderdata/location")
+        self.to_ext = frame.get("persondata/address")
+        self.sysdata_datetime = frame.get("systemdata/datetime")
+        self.sysdata_ts = frame.get("systemdata/timestamp")
+        self.priority = frame.get_int("jobdata/priority", 0)
+
+        # This 10-Digit random number will be used as ID, when re-sending
+        # the message to it's recipient.
+        self.internal_ext_id = random.randrange(9999999999 + 1)
+
+    def _init_state(self, template=_MESSAGE_TEMPLATE):
+        """
+        Initializes the state of a new message that is not part of its content.
+        """
+        self.last_send_try = 0
+
+        # Outcome of the last answered send attempt (see RetryPolicies), how
+        # many answers in a row had this outcome and the number of attempts
+        # since the last answer.
+        self.outcome = "no_response"
+        self.outcome_count = 0
+        self.unanswered = 0
+
+        # Bookkeeping of the Outbox: time of the next send attempt and
+        # sequence number of the retry-heap entry that is currently valid.
+        self.next_try = 0
+        self.outbox_seq = None
+
+        # Cache of get_message() and the fields it was rendered from.
+        self._wire = None
+        self._wire_key = None
+
+        # Template for get_message(), see create().
+        self._template = template
+
+        # The Broadcast this message is part of.
+        self.broadcast = None
+
+    def to_record(self):
+        """
+        Returns the data of this message as a list of plain values,
+        e.g. for writing it to the journal.
+        """
+        return [
+            self.internal_ext_id,
+            self.created,
+            self.ext_id,
+            self.message,
+            self.from_name,
+            self.from_ext,
+            self.from_loc,
+            self.to_ext,
+            self.sysdata_datetime,
+            self.sysdata_ts,
+            self.priority,
+        ]
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Re-Creates a Message from a list created by to_record().
+        The values may also be the strings read back from the journal.
+        Records written before messages had a priority are read with priority 0.
+        """
+        self = cls.__new__(cls)
+        if len(record) == 10:
+            record = list(record) + [0]
+        (
+            internal_ext_id,
+            created,
+            self.ext_id,
+            self.message,
+            self.from_name,
+            self.from_ext,
+            self.from_loc,
+            self.to_ext,
+            self.sysdata_datetime,
+            self.sysdata_ts,
+            priority,
+        ) = record
+        self.internal_ext_id = int(internal_ext_id)
+        self.created = float(created)
+        self.priority = int(priority)
+        self._init_state()
+        return self
+
+    @classmethod
+    def create(
+        cls,
+        to_ext,
+        message,
+        from_ext,
+        from_name,
+        from_loc,
+        ext_id=None,
+        sysdata_datetime=None,
+        sysdata_ts=None,
+        priority=0,
+        template=None,
+    ):
+        """
+        Creates a Message that was not received from a phone, e.g. one of the
+        copies of a broadcast.
+
+        The system data defaults to the current time. template may be a
+        partial of _MESSAGE_TEMPLATE with the fields shared by many messages
+        already filled in.
+        """
+        now = time.time()
+        self = cls.__new__(cls)
+        self.internal_ext_id = random.randrange(9999999999 + 1)
+        self.created = now
+        self.ext_id = ext_id
+        self.message = message
+        self.from_name = from_name
+        self.from_ext = from_ext
+        self.from_loc = from_loc
+        self.to_ext = to_ext
+        self.sysdata_datetime = sysdata_datetime if sysdata_datetime is not None else time.strftime("%d.%m.%Y %H:%M:%S", time.localtime(now))
+        self.sysdata_ts = sysdata_ts if sysdata_ts is not None else str(int(now))
+        self.priority = priority
+        self._init_state(template if template is not None else _MESSAGE_TEMPLATE)
+        return self
+
+    def get_messageresponse(self):
+        """
+        This function creates a 'received confirmation' for a received message.
+        It seems the BaseStations are somewhat picky on the format of the XML.
+        Thus I am using a template here to create the binary-xml I really want.
+
+        'Received confirmations' are empty message containing the same externalid
+        and an empty message. They are send with senderdata and persondata swapped.
+        """
+
+        return _RESPONSE_TEMPLATE.render(
+            eid=self.ext_id,
+            priority=self.priority,
+            from_ext=self.from_ext,
+            from_name=self.from_name,
+            from_loc=self.from_loc,
+            to_ext=self.to_ext,
+            dt=self.sysdata_datetime,
+            ts=self.sysdata_ts,
+        )
+
+    def get_message(self):
+        """
+        This function creates a new message for a received message.
+        It seems the BaseStations are somewhat picky on the format of the XML.
+        Thus I am using a template here to create the binary-xml I really want.
+
+        The new message looks like the one we received. But we can re-create it anytime
+        we want.
+
+        The rendered message is cached, as it is sent again on every retry.
+        It is only rendered again if one of its fields changed.
+        Fields filled in by a partial template (see create()) are not
+        rendered again.
+        """
+
+        key = (
+            self.internal_ext_id,
+            self.from_ext,
+            self.from_name,
+            self.from_loc,
+            self.to_ext,
+            self.sysdata_datetime,
+            self.sysdata_ts,
+            self.message,
+            self.priority,
+        )
+        if self._wire_key != key:
+            self._wire = self._template.render(
+                eid="{:010}".format(self.internal_ext_id),
+                priority=self.priority,
+                from_ext=self.from_ext,
+                from_name=self.from_name,
+                from_loc=self.from_loc,
+                to_ext=self.to_ext,
+                dt=self.sysdata_datetime,
+                ts=self.sysdata_ts,
+                msg=self.message,
+            )
+            self._wire_key = key
+        return self._wire
+
+
+class Broadcast:
+    """
+    This class aggregates the delivery status of a message sent to many recipients.
+
+    The status of every recipient is one of:
+    queued, sent, absent (the handset was not reachable), delivered, expired,
+    failed (given up by its RetryPolicy) or cancelled (by an operator).
+    """
+
+    _final = ("delivered", "expired", "failed", "cancelled")
+
+    def __init__(self, broadcast_id, recipients):
+        self.id = broadcast_id
+        self.created = time.time()
+        self.status = dict.fromkeys(recipients, "queued")
+        # Recipients not in a final state yet
+        self._open = len(self.status)
+
+    def __repr__(self):
+        return "<Broadcast {} {}>".format(self.id, self.summary())
+
+    def update(self, to_ext, status):
+        """
+        Updates the status of a recipient. Final states are never left.
+        """
+        current = self.status.get(to_ext)
+        if current in Broadcast._final:
+            return
+        if current is None:
+            self._open += 1
+        self.status[to_ext] = status
+        if status in Broadcast._final:
+            self._open -= 1
+
+    def summary(self):
+        """
+        Returns the number of recipients per status.
+        """
+        counts = {}
+        for status in self.status.values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    @property
+    def done(self):
+        """
+        True once every recipient got the message or it was given up.
+        """
+        return self._open == 0
 
 
 class MessageSystem:
@@ -149,143 +357,695 @@ class MessageSystem:
         11: ("User absent", False),
     }
 
-    def __init__(self, udp_server, roaming_monitor):
+    # Outcomes (see RetryPolicies) of the status codes that keep a message in the queue.
+    # All other codes are "unknown".
+    _status_outcomes = {
+        11: "absent",
+    }
+
+    # Seconds after which undelivered messages are dropped.
+    _max_age = 7 * 24 * 60 * 60
+
+    # Messages handled by this driver, see UdpServer.register_driver()
+    handles = {
+        ("request", "job"): "process_job",
+        ("response", "job"): "process_status",
+    }
+
+    # Paths read from these messages, see UdpServer.register_driver()
+    reads = {
+        ("request", "job"): (
+            "externalid",
+            "jobdata/messages/messageuui",
+            "jobdata/priority",
+            "senderdata/name",
+            "senderdata/address",
+            "senderdata/location",
+            "persondata/address",
+            "systemdata/datetime",
+            "systemdata/timestamp",
+        ),
+        ("response", "job"): ("externalid", "jobdata/status"),
+    }
+
+    def __init__(self, udp_server, roaming_monitor, journal=None, groups=None, rate_controller=None, retry_policies=None):
         """
         Create a new MessageSystem.
 
         This Message-System implements SMS-Communication with storage of
         non-delivered messages for Snom DECT handsets.
+
+        If a Journal is given, the queue is persisted to it and the messages
+        still queued in the journal are recovered.
+
+        groups is a dict of group name => list of extensions. Messages sent to
+        a group name are broadcast to all extensions of the group.
+
+        The rate of messages sent to each BaseStation is limited by
+        rate_controller, a RateController with default settings if None.
+
+        When a message is sent again depends on the answer of the BaseStation,
+        see retry_policies (RetryPolicies with default settings if None).
         """
         self._udp_server = udp_server
-        self._queue = []
+        self._outbox = Outbox(MessageSystem._max_age)
+        self._groups = groups or {}
+
+        # Broadcasts with recipients still waiting for the message, by id.
+        # Broadcasts are not persisted: Recovered messages are sent on their own.
+        self._broadcasts = {}
+
+        # Callbacks for status changes, see add_listener()
+        self._listeners = []
+
+        self._rate_controller = rate_controller if rate_controller is not None else RateController()
+        # Internal ids of the messages waiting for the time slot they reserved.
+        self._reserved = set()
+        # addr => when to try the messages parked for the BaseStation again,
+        # see _release_parked()
+        self._parked_wake = {}
+
+        self._retry_policies = retry_policies if retry_policies is not None else RetryPolicies()
+
+        self._journal = journal
+        if self._journal is not None:
+            self._recover()
 
         self._udp_server.register_driver(self)
 
-        loop = asyncio.get_event_loop()
-        loop.create_task(self.process_outbox())
+        # Set whenever the outbox might have work to do earlier than the
+        # next deadline it is currently sleeping for.
+        self._wakeup = asyncio.Event()
+
+        # Set whenever a BaseStation answered, see stop().
+        self._answered = asyncio.Event()
 
         self._roaming_monitor = roaming_monitor
+        self._roaming_monitor.add_listener(self._presence_changed)
+
+        self._task = None
+        self._stopping = False
+
+    async def start(self):
+        """
+        Starts sending the queued messages.
+        """
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.get_running_loop().create_task(self.process_outbox())
+            logger.debug("MessageSystem started with %s queued messages", len(self._outbox))
+
+    async def stop(self, timeout=5.0):
+        """
+        Stops the MessageSystem gracefully.
+
+        New messages are refused and nothing is sent anymore. Messages that
+        were just sent get up to `timeout` seconds to be answered by their
+        BaseStation, so their status is not lost. Finally the journal is
+        flushed and closed: All queued messages are sent again after a restart.
+        """
+        deadline = time.monotonic() + timeout
+        self._stopping = True
+
+        if self._task is not None:
+            # process_outbox ends once it sees _stopping. Do not cancel it
+            # in the middle of a send unless it takes too long.
+            self.wakeup()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                self._task.cancel()
+            self._task = None
+
+        # drain the messages in flight
+        while True:
+            remaining = deadline - time.monotonic()
+            outstanding = self._rate_controller.outstanding(time.time())
+            if not outstanding:
+                break
+            if remaining <= 0:
+                logger.warning("Stopping with %s messages still waiting for their status", outstanding)
+                break
+            self._answered.clear()
+            try:
+                await asyncio.wait_for(self._answered.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        self._udp_server.unregister_driver(self)
+        self.close()
+        logger.info("MessageSystem stopped, %s messages queued", len(self._outbox))
 
     def close(self):
-        # TODO: Implement proper shutdown of this function.
-        pass
+        """
+        Releases all resources at once, see stop() for a graceful shutdown.
+        """
+        self._stopping = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._journal is not None:
+            self._journal.close()
+
+    def _recover(self):
+        """
+        Re-Queues all messages found in the journal.
+        """
+        # Recovering creates lots of long-living objects. This makes the garbage
+        # collector run over and over again without finding anything.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._recover_messages()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _recover_messages(self):
+        now = time.time()
+        recovered = []
+        # priority => delay of the first retry
+        delays = {}
+        for record, last_send_try in self._journal.recover():
+            try:
+                m = Message.from_record(record)
+            except ValueError as exp:
+                logger.warning("Ignoring broken message in journal: %s (%s)", record, exp)
+                continue
+            m.last_send_try = last_send_try
+            due = now
+            if last_send_try:
+                delay = delays.get(m.priority)
+                if delay is None:
+                    delay = delays[m.priority] = self._retry_policies.get("no_response", m.priority).delay(1)
+                due = last_send_try + delay
+            recovered.append((m, due))
+        self._outbox.load(recovered)
+        logger.info("Recovered %s messages from journal", len(self._outbox))
+
+        index, number = self._udp_server.partition
+        moved = [(m, due) for m, due in recovered if m.internal_ext_id % number != index]
+        if moved:
+            # Queued while a different number of workers was running: The
+            # status responses would be forwarded to another worker.
+            logger.info("Assigning new ids to %s recovered messages", len(moved))
+            for m, due in moved:
+                self._outbox.remove(m.internal_ext_id)
+                self._journal.done(m.internal_ext_id, "moved")
+                m.internal_ext_id = self._new_id()
+                self._outbox.add(m, due)
+                self._journal.queued(m.to_record())
+
+    def _new_id(self):
+        """
+        Returns a random internal id that is not used by a queued message.
+        With several workers the id tells which one owns the message, see
+        snom_messaging.WorkerServer.
+        """
+        index, number = self._udp_server.partition
+        while True:
+            internal_ext_id = random.randrange(index, 9999999999 + 1, number)
+            if internal_ext_id not in self._outbox:
+                return internal_ext_id
+
+    def expand_recipients(self, recipients):
+        """
+        Replaces group names in a list of recipients by the extensions of the group.
+        Duplicates are removed, the order is kept.
+        """
+        expanded = {}
+        for recipient in recipients:
+            for to_ext in self._groups.get(recipient, (recipient,)):
+                expanded[to_ext] = None
+        return list(expanded)
+
+    def broadcast(
+        self,
+        recipients,
+        message,
+        from_ext="server",
+        from_name="System",
+        from_loc="server",
+        broadcast_id=None,
+        sysdata_datetime=None,
+        sysdata_ts=None,
+        priority=0,
+        callback=None,
+    ):
+        """
+        Queues a message for many recipients at once.
+
+        recipients is a list of extensions and group names.
+        The message is rendered once, only the ids and the recipient differ
+        between the copies. Sending is paced per BaseStation, see process_outbox().
+
+        callback is called without arguments once all copies are queued
+        (and written to the journal).
+        Returns the Broadcast to follow the delivery.
+        """
+        recipients = self.expand_recipients(recipients)
+        if broadcast_id is None:
+            broadcast_id = "{:010}".format(random.randrange(9999999999 + 1))
+        broadcast = Broadcast(broadcast_id, recipients)
+
+        template = _MESSAGE_TEMPLATE.partial(from_ext=from_ext, from_name=from_name, from_loc=from_loc, msg=message, priority=priority)
+        now = time.time()
+        messages = []
+        for to_ext in recipients:
+            m = Message.create(to_ext, message, from_ext, from_name, from_loc, broadcast_id, sysdata_datetime, sysdata_ts, priority, template)
+            m.internal_ext_id = self._new_id()
+            m.broadcast = broadcast
+            self._outbox.add(m, now)
+            self._set_status(m, "queued")
+            messages.append(m)
+
+        if messages:
+            self._broadcasts[broadcast_id] = broadcast
+        logger.info("Added broadcast %s for %s recipients", broadcast_id, len(messages))
+        self.wakeup()
+
+        if self._journal is not None and messages:
+            # The journal calls back in order, so all copies are on disk once the last one is.
+            for m in messages[:-1]:
+                self._journal.queued(m.to_record())
+            self._journal.queued(messages[-1].to_record(), callback)
+        elif callback is not None:
+            callback()
+        return broadcast
+
+    def queue_message(self, to_ext, message, from_ext="server", from_name="System", from_loc="server", priority=0, callback=None):
+        """
+        Queues a message for a single extension that was not received from a phone.
+
+        callback is called without arguments once the message is queued
+        (and written to the journal).
+        Returns the Message, its internal_ext_id identifies it.
+        """
+        m = Message.create(to_ext, message, from_ext, from_name, from_loc, priority=priority)
+        m.internal_ext_id = self._new_id()
+        self._outbox.add(m, time.time())
+        logger.info("Added Message with internal id %s for %s", m.internal_ext_id, to_ext)
+        self._set_status(m, "queued")
+        self.wakeup()
+
+        if self._journal is not None:
+            self._journal.queued(m.to_record(), callback)
+        elif callback is not None:
+            callback()
+        return m
+
+    def query_outbox(self, to_ext=None, offset=0, limit=100):
+        """
+        Returns a page of the queued messages, see Outbox.page().
+        """
+        return self._outbox.page(offset, limit, to_ext)
+
+    def get_message(self, internal_ext_id):
+        """
+        Returns the queued Message with the given internal id or None.
+        """
+        return self._outbox.get(internal_ext_id)
+
+    def cancel(self, internal_ext_id):
+        """
+        Removes a message from the queue without delivering it.
+        Returns the Message or None if it is not queued.
+        """
+        message = self._outbox.remove(internal_ext_id)
+        if message is None:
+            return None
+        logger.info("Cancelled message %s to %s", internal_ext_id, message.to_ext)
+        self._reserved.discard(internal_ext_id)
+        self._set_status(message, "cancelled")
+        _finished.inc(("cancelled",))
+        if self._journal is not None:
+            self._journal.done(internal_ext_id, "cancelled")
+        return message
 
-    def process(self, xml_message, addr):
+    def requeue(self, internal_ext_id):
         """
-        Process a message received via UDP.
+        Sends a queued message again right away and restarts its retries,
+        e.g. after the recipient was found to be reachable again.
+        Returns the Message or None if it is not queued.
+        """
+        message = self._outbox.get(internal_ext_id)
+        if message is None:
+            return None
+        logger.info("Requeued message %s to %s", internal_ext_id, message.to_ext)
+        message.outcome = "no_response"
+        message.outcome_count = 0
+        message.unanswered = 0
+        self._reserved.discard(internal_ext_id)
+        self._outbox.schedule(message, time.time())
+        self.wakeup()
+        return message
+
+    def get_broadcast(self, broadcast_id):
+        """
+        Returns the Broadcast with the given id or None if it is unknown or complete.
+        """
+        return self._broadcasts.get(broadcast_id)
+
+    def add_listener(self, callback):
+        """
+        Registers a callback for the delivery status of the messages.
+
+        The callback is called as callback(message, status) whenever a message
+        is queued, sent, answered with absent or leaves the queue. status is one
+        of the states of a Broadcast recipient, see Broadcast.
+        """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _set_status(self, message, status):
+        """
+        Records the status of a message in its Broadcast and tells the listeners.
+        """
+        broadcast = message.broadcast
+        if broadcast is not None:
+            broadcast.update(message.to_ext, status)
+            if broadcast.done and self._broadcasts.pop(broadcast.id, None) is not None:
+                logger.info("Broadcast %s complete: %s", broadcast.id, broadcast.summary())
 
-        We are interested in two typed of messages from the UDP-Socket:
-        * New Messages from Phones
-        * Status-Updates for messages we have sent
+        for callback in self._listeners:
+            try:
+                callback(message, status)
+            except Exception as exp:
+                logger.warning("Status listener %s failed with exception %s.", callback, exp)
 
-        All other messages are not consumed.
+    def _retry(self, message, outcome, now):
         """
+        Schedules the next attempt of a message after an answer of the
+        BaseStation (or none) according to its RetryPolicy.
+        The message is given up if the policy says so.
+        """
+        if outcome == "no_response":
+            message.unanswered += 1
+            retry = message.unanswered
+        else:
+            message.unanswered = 0
+            if message.outcome == outcome:
+                message.outcome_count += 1
+            else:
+                message.outcome = outcome
+                message.outcome_count = 1
+            retry = message.outcome_count
+
+        delay = self._retry_policies.get(outcome, message.priority).delay(retry)
+        if delay is None:
+            logger.warning("Giving up message %s to %s after %s attempts (%s)", message.internal_ext_id, message.to_ext, retry, outcome)
+            self._outbox.remove(message.internal_ext_id)
+            self._reserved.discard(message.internal_ext_id)
+            self._set_status(message, "failed")
+            _finished.inc(("failed",))
+            if self._journal is not None:
+                self._journal.done(message.internal_ext_id, "failed")
+            return
 
-        if xml_message.tag == "request" and xml_message.attrib["type"] == "job":
-            # This is an incoming message. We will queue this message in our outbox and
-            # send a reception confirmation to the sending phone.
-            # We do not track if the sending phone confirms our status update.
-            logger.debug("Found incoming message. Trying to parse and add it to queue")
-            m = Message(xml_message)
-            self._queue.append(m)
-            logger.info("Added Message with external ID %s and internal id %s", m.ext_id, m.internal_ext_id)
+        self._reserved.discard(message.internal_ext_id)
+        self._outbox.schedule(message, now + delay)
 
+    def queue_length(self):
+        """
+        Returns the number of messages waiting for delivery.
+        """
+        return len(self._outbox)
+
+    def rate_stats(self):
+        """
+        Returns the counters of the rate controller per BaseStation, see RateController.stats().
+        """
+        return self._rate_controller.stats(time.time())
+
+    def wakeup(self):
+        """
+        Wakes up process_outbox to re-evaluate the queue immediately.
+        """
+        self._wakeup.set()
+
+    def _presence_changed(self, event):
+        """
+        Called by the RoamingMonitor with a RoamingEvent whenever an extension
+        appears, moves or disappears.
+
+        Pending messages for an extension that just showed up are due
+        immediately, instead of waiting for their next regular retry,
+        if their RetryPolicy wants this. Messages sent within the ack
+        timeout of the RateController whose answer is still outstanding
+        are left alone, they will most likely be answered.
+        """
+        if event.addr is None:
+            return
+        number, addr = event.number, event.addr
+
+        now = time.time()
+        answer_due = now - self._rate_controller.ack_timeout
+        pending = [
+            message
+            for message in self._outbox.for_recipient(number)
+            if self._retry_policies.get(message.outcome, message.priority).wake_on_presence
+            and not (message.unanswered and message.last_send_try > answer_due)
+        ]
+        if pending:
+            logger.debug("%s showed up on %s, flushing %s pending messages", number, addr, len(pending))
+            for message in pending:
+                self._reserved.discard(message.internal_ext_id)
+                self._outbox.schedule(message, now)
+            self.wakeup()
+
+    def process_job(self, frame, addr):
+        """
+        Process a new message from a phone.
+        """
+
+        # This is an incoming message. We will queue this message in our outbox and
+        # send a reception confirmation to the sending phone.
+        # We do not track if the sending phone confirms our status update.
+        if self._stopping:
+            # Without confirmation the sender will try again after the restart.
+            logger.warning("Refusing message %s from %s while stopping", frame.get("externalid"), addr)
+            return
+
+        logger.debug("Found incoming message. Trying to parse and add it to queue")
+        m = Message(frame)
+
+        recipients = frame.getall("persondata/address")
+        if len(recipients) > 1 or m.to_ext in self._groups:
+            # Sent to several extensions or a group, the sender only gets a single confirmation.
+            self.broadcast(
+                recipients,
+                m.message,
+                m.from_ext,
+                m.from_name,
+                m.from_loc,
+                m.ext_id,
+                m.sysdata_datetime,
+                m.sysdata_ts,
+                m.priority,
+                lambda: self._udp_server.send_dgram(m.get_messageresponse(), addr, ("response", "job")),
+            )
+            return
+
+        m.internal_ext_id = self._new_id()
+        self._outbox.add(m, time.time())
+        logger.info("Added Message with external ID %s and internal id %s", m.ext_id, m.internal_ext_id)
+        self._set_status(m, "queued")
+        self.wakeup()
+
+        def confirm():
             # send confirmation to sender
-            self._udp_server.send_dgram(m.get_messageresponse(), addr)
+            self._udp_server.send_dgram(m.get_messageresponse(), addr, ("response", "job"))
             logger.debug("Confirmation for sender sent!")
 
-            return True
-
-        if xml_message.tag == "response" and xml_message.attrib["type"] == "job":
-            # This is a reception confirmation.
-            # These come in two tastes:
-            # * With "./response/jobdata": These contain status information for a message
-            #   ./response/jobdata/status == 1: Message received
-            #   ./response/jobdata/status == 11: User absent?
-            # * Without "./response/jobdata":  I am not sure what these do. They seem to be send
-            #   by the BaseStations. I am currently ignoring these.
-
-            if xml_message.find("./jobdata"):
-                ext_id = int(xml_message.find("./externalid").text)
-                logger.debug("Status update for %s", ext_id)
-
-                status = int(xml_message.find(".jobdata/status").text)
-
-                remove_from_queue = False
-                if status in MessageSystem._snom_message_status:
-                    logger.info(
-                        "Status Update for %s: %s => '%s'. Remove from queue? %s",
-                        ext_id,
-                        status,
-                        MessageSystem._snom_message_status[status][0],
-                        MessageSystem._snom_message_status[status][1],
-                    )
-                    remove_from_queue = MessageSystem._snom_message_status[status][1]
+        if self._journal is not None:
+            # Only confirm the message to the sender once it is safe on disk.
+            self._journal.queued(m.to_record(), confirm)
+        else:
+            confirm()
+
+    def process_status(self, frame, addr):
+        """
+        Process a status update for a message we have sent.
+        """
+
+        # This is a reception confirmation.
+        # These come in two tastes:
+        # * With "./response/jobdata": These contain status information for a message
+        #   ./response/jobdata/status == 1: Message received
+        #   ./response/jobdata/status == 11: User absent?
+        # * Without "./response/jobdata":  I am not sure what these do. They seem to be send
+        #   by the BaseStations. I am currently ignoring these.
+
+        status = frame.get_int("jobdata/status")
+        if status is not None:
+            ext_id = frame.get_int("externalid")
+            logger.debug("Status update for %s", ext_id)
+            _status_received.inc((status,))
+
+            now = time.time()
+            remove_from_queue = False
+            if status in MessageSystem._snom_message_status:
+                logger.info(
+                    "Status Update for %s: %s => '%s'. Remove from queue? %s",
+                    ext_id,
+                    status,
+                    MessageSystem._snom_message_status[status][0],
+                    MessageSystem._snom_message_status[status][1],
+                )
+                remove_from_queue = MessageSystem._snom_message_status[status][1]
+            else:
+                logger.warning("Got unknown status code: %s. Keeping message in queue", status)
+
+            self._rate_controller.response(addr, ext_id, status, now)
+            self._answered.set()
+
+            message = self._outbox.get(ext_id)
+            if remove_from_queue:
+                if self._outbox.remove(ext_id) is not None:
+                    logger.debug("Removed %s from queue", ext_id)
+                    _finished.inc(("delivered",))
+                    _delivery_seconds.observe(now - message.created, (message.priority,))
+                    self._reserved.discard(ext_id)
+                    self._set_status(message, "delivered")
+                    if self._journal is not None:
+                        self._journal.done(ext_id, "delivered")
                 else:
-                    logger.warning("Got unknown status code: %s. Keeping message in queue", status)
-
-                if remove_from_queue:
-                    for msg in self._queue:
-                        if msg.internal_ext_id == ext_id:
-                            self._queue.remove(msg)
-                            logger.debug("Removed %s from queue", ext_id)
-                            break
-                    else:
-                        logger.warning("Got reception confirmation for unknown message: %s", ext_id)
+                    logger.warning("Got reception confirmation for unknown message: %s", ext_id)
+            elif message is not None:
+                outcome = MessageSystem._status_outcomes.get(status, "unknown")
+                if outcome == "absent":
+                    self._set_status(message, "absent")
+                self._retry(message, outcome, now)
+            self.wakeup()
 
-            return True
+    def _send(self, message, addr, now):
+        """
+        Sends a message to the BaseStation at addr and schedules the next
+        attempt in case there is no answer.
+        """
+        logger.debug("Sending message %s", message.internal_ext_id)
+        if message.last_send_try:
+            _retries.inc(("no_response" if message.unanswered else message.outcome,))
+        try:
+            self._udp_server.send_dgram(message.get_message(), addr)
+            self._rate_controller.sent(addr, message.internal_ext_id, now)
+            if self._journal is not None:
+                self._journal.attempted(message.internal_ext_id, now)
+            self._set_status(message, "sent")
+        except Exception as e:
+            logger.error("Error sending message %s to %s: %s", message.internal_ext_id, addr, e)
+        # Schedule the next attempt in case there is no answer, even if
+        # this one failed, to avoid continuous attempts
+        message.last_send_try = now
+        self._retry(message, "no_response", now)
+
+    def _release_parked(self, addr, now):
+        """
+        Sends or reserves time slots for as many messages parked for the
+        BaseStation at addr as it can take now, the most urgent first.
 
-        return False
+        Only the message at the head of the queue is looked at when the
+        BaseStation is still busy, so a long queue costs nothing while it waits.
+        """
+        while True:
+            message = self._outbox.peek_parked(addr)
+            if message is None:
+                del self._parked_wake[addr]
+                return
+            target_addr = self._roaming_monitor.get_addr(message.to_ext)
+            if target_addr != addr:
+                # The recipient moved or left while the message waited
+                self._outbox.schedule(message, now)
+                continue
+            slot, reserved = self._rate_controller.reserve(addr, now, message.priority)
+            if not reserved:
+                self._parked_wake[addr] = slot
+                return
+            self._outbox.take_parked(addr)
+            if slot > now:
+                self._reserved.add(message.internal_ext_id)
+                self._outbox.schedule(message, slot)
+            else:
+                self._send(message, addr, now)
 
     async def process_outbox(self):
         """
         Process the queue of outgoing messages.
+
+        This coroutine sleeps until the earliest deadline of the outbox.
+        It is woken up early by wakeup(), e.g. when a new message is queued.
         """
-        last_roaming_print = 0
+        deadline = None
 
-        while True:
+        while not self._stopping:
+            self._wakeup.clear()
             try:
-                # Mostra periodicamente la roaming table (ogni 2 minuti)
-                if time.time() - last_roaming_print > 120:
-                    self._roaming_monitor.print_roaming_table()
-                    last_roaming_print = time.time()
-
-                # check if any message is to resend
-                for message in self._queue:
-                    if (time.time() - message.last_send_try) > 60:
-                        logger.debug("Sending message %s", message.internal_ext_id)
-                        target_addr = self._roaming_monitor.get_addr(message.to_ext)
-                        if target_addr is not None:
-                            try:
-                                self._udp_server.send_dgram(message.get_message(), target_addr)
-                                message.last_send_try = time.time()
-                            except Exception as e:
-                                logger.error("Error sending message %s to %s: %s", message.internal_ext_id, target_addr, e)
-                                message.last_send_try = time.time()  # Avoid continuous retry
+                now = time.time()
+
+                # purge all messages older than the maximum age
+                for message in self._outbox.pop_expired(now):
+                    logger.info("Removing undelivered message from queue: %s", message.internal_ext_id)
+                    if self._journal is not None:
+                        self._journal.done(message.internal_ext_id, "expired")
+                    self._reserved.discard(message.internal_ext_id)
+                    self._set_status(message, "expired")
+                    _finished.inc(("expired",))
+
+                # send all messages whose next attempt is due
+                for message in self._outbox.pop_due(now):
+                    target_addr = self._roaming_monitor.get_addr(message.to_ext)
+                    if target_addr is not None:
+                        # Pace the messages to each BaseStation, e.g. for broadcasts to
+                        # many handsets on the same one or after it rebooted. A message
+                        # that has to wait for its BaseStation either waits for the time
+                        # slot it reserved or, if too many wait already, is parked until
+                        # the BaseStation has a free slot again.
+                        if message.internal_ext_id in self._reserved:
+                            self._reserved.discard(message.internal_ext_id)
+                        elif target_addr in self._parked_wake:
+                            self._outbox.park(message, target_addr)
+                            continue
                         else:
-                            logger.warning(
-                                "Cannot send message %s to extension %s: extension not found in roaming table",
-                                message.internal_ext_id,
-                                message.to_ext,
-                            )
-                            message.last_send_try = time.time()  # Update last_send_try to avoid continuous attempts
-
-                # purge all messages older than
-                messages_to_remove = []
-                for message in self._queue:
-                    if (time.time() - message.created) > 7 * 24 * 60 * 60:
-                        logger.info("Removing undelivered message from queue: %s", message.internal_ext_id)
-                        messages_to_remove.append(message)
-
-                # Remove messages outside the iteration to avoid modification during iteration
-                for message in messages_to_remove:
-                    self._queue.remove(message)
+                            slot, reserved = self._rate_controller.reserve(target_addr, now, message.priority)
+                            if not reserved:
+                                self._outbox.park(message, target_addr)
+                                self._parked_wake[target_addr] = slot
+                                continue
+                            if slot > now:
+                                self._reserved.add(message.internal_ext_id)
+                                self._outbox.schedule(message, slot)
+                                continue
+                        self._send(message, target_addr, now)
+                    else:
+                        # Nobody to send to: The recipient is as absent as it can be.
+                        logger.warning(
+                            "Cannot send message %s to extension %s: extension not found in roaming table",
+                            message.internal_ext_id,
+                            message.to_ext,
+                        )
+                        self._retry(message, "absent", now)
+
+                for addr, wake in list(self._parked_wake.items()):
+                    if wake <= now:
+                        self._release_parked(addr, now)
+
+                if self._journal is not None and self._journal.wants_compaction():
+                    self._journal.compact((m.to_record(), m.last_send_try) for m in self._outbox)
+
+                deadline = self._outbox.next_deadline()
+                if self._parked_wake:
+                    wake = min(self._parked_wake.values())
+                    deadline = wake if deadline is None else min(deadline, wake)
 
             except Exception as e:
                 logger.error("Error in process_outbox: %s", e)
 
+            # Without any deadline only wakeup() has something to do.
+            timeout = None if deadline is None else max(0, deadline - time.time())
             try:
-                await asyncio.sleep(1)
-            except Exception as e:
-                logger.error("Error in asyncio.sleep: %s", e)
-                break  # Exit the loop if sleep fails
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
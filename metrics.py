@@ -0,0 +1,188 @@
+"""
+Metrics of the server in the Prometheus text format.
+
+Modules create their metrics once at import time, like their loggers:
+| _frames_received = metrics.counter("snom_frames_received_total", "Frames received", ("tag", "type"))
+| ...
+| _frames_received.inc((frame.tag, frame.type))
+
+Label values are passed as a tuple in the order of the label names.
+Updates are plain dict operations on the event loop, without locks.
+"""
+
+import bisect
+import math
+
+# Buckets in seconds for timings on the event loop
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+# Buckets in seconds for the delivery of messages
+DELIVERY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [
+        '{}="{}"'.format(name, ("" if value is None else str(value)).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    """
+    A counter per combination of label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        # label values => count
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        values = self.values
+        values[labels] = values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, _format_labels(self.labels, labels), value
+
+
+class Histogram:
+    """
+    A histogram per combination of label values: observations counted in
+    buckets with the given upper bounds, their number and their sum.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=FAST_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values => [count per bucket..., count above the last bucket, sum]
+        self.series = {}
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, labels=()):
+        series = self.series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def samples(self):
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                yield self.name + "_bucket", _format_labels(self.labels, labels, 'le="{}"'.format(_format_value(float(bound)))), cumulative
+            yield self.name + "_count", _format_labels(self.labels, labels), cumulative
+            yield self.name + "_sum", _format_labels(self.labels, labels), series[-1]
+
+
+class Gauge:
+    """
+    A value read when the metrics are collected: func() returns a number,
+    or a dict mapping label values to numbers if the gauge has labels.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, description, func, labels=()):
+        self.name = name
+        self.description = description
+        self.func = func
+        self.labels = tuple(labels)
+
+    def samples(self):
+        value = self.func()
+        if value is None:
+            return
+        if not self.labels:
+            yield self.name, "", value
+            return
+        for labels, item in value.items():
+            yield self.name, _format_labels(self.labels, labels), item
+
+
+class Registry:
+    """
+    This class holds all metrics of a process.
+    """
+
+    def __init__(self):
+        # name => metric, in the order they were created
+        self._metrics = {}
+
+    def _add(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None and not isinstance(metric, Gauge):
+            if type(existing) is not type(metric) or existing.labels != metric.labels:
+                raise ValueError("Metric {} already exists with other labels".format(metric.name))
+            return existing
+        # A gauge is replaced, it reads the most recent object.
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self._add(Counter(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=FAST_BUCKETS):
+        return self._add(Histogram(name, description, labels, buckets))
+
+    def gauge(self, name, description, func, labels=()):
+        return self._add(Gauge(name, description, func, labels))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text format (version 0.0.4) as bytes.
+        """
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append("# HELP {} {}".format(metric.name, metric.description))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, labels, _format_value(value)))
+        lines.append("")
+        return "\n".join(lines).encode("UTF-8")
+
+
+# The registry of this process
+registry = Registry()
+
+counter = registry.counter
+histogram = registry.histogram
+gauge = registry.gauge
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def serve(http_server, path="/metrics"):
+    """
+    Serves the metrics of this process on an HttpServer.
+    """
+    http_server.route("GET", path, lambda request: (200, CONTENT_TYPE, registry.render()))
@@ -5,14 +5,45 @@ Script to monitor messaging server activity in real time.
 Useful for debugging during tests with real phones.
 """
 
-import os
+import json
 import subprocess
 import time
+import urllib.request
 
+METRICS_PORT = 9300
+METRICS_URL = "http://127.0.0.1:{}/metrics".format(METRICS_PORT)
+ROAMING_URL = "http://127.0.0.1:{}/roaming".format(METRICS_PORT)
 
-def monitor_server_logs():
+# Series of read_metrics()
+HANDSETS = ("snom_roaming_entries", 'kind="handsets"')
+BASESTATIONS = ("snom_roaming_entries", 'kind="basestations"')
+DELIVERED = ("snom_messages_finished_total", 'reason="delivered"')
+LAG_P99 = ("snom_event_loop_lag_seconds", 'stat="p99"')
+
+
+def read_metrics(url=METRICS_URL):
+    """
+    Reads the metrics of the server (snom_messaging.py --http).
+    Returns a dict mapping the metric names to the sum over all their labels
+    and (name, labels) to the single values.
+    """
+    with urllib.request.urlopen(url, timeout=2) as response:
+        text = response.read().decode("UTF-8")
+
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, _, value = line.rpartition(" ")
+        name, _, labels = series.partition("{")
+        values[(name, labels.rstrip("}"))] = float(value)
+        values[name] = values.get(name, 0.0) + float(value)
+    return values
+
+
+def monitor_server_logs(interval=2.0):
     """
-    Monitors server logs in real time showing only relevant lines.
+    Monitors the server in real time, printing its activity every `interval` seconds.
     """
     print("🔍 Snom DECT Server Monitoring")
     print("Press Ctrl+C to exit")
@@ -22,28 +53,46 @@ def monitor_server_logs():
         # Start server if not already running
         try:
             subprocess.run(["pgrep", "-f", "snom_messaging.py"], check=True, capture_output=True)
-            print("✅ Server already running")
+            print("✅ Server already running (metrics need --http {})".format(METRICS_PORT))
         except subprocess.CalledProcessError:
             print("🚀 Starting server...")
-            server_process = subprocess.Popen(
-                ["python3", "snom_messaging.py"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True
+            subprocess.Popen(
+                ["python3", "snom_messaging.py", "--http", str(METRICS_PORT)],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
             )
             time.sleep(2)
 
-        # Monitor log files if they exist
-        log_files = []
-        if os.path.exists("logs"):
-            print("📁 Monitoring logs/ folder")
-
-        print("\n📊 Server Log:")
+        print("\n📊 Server activity (per second):")
         print("-" * 30)
 
-        # For now we simply monitor the output
+        previous = None
         while True:
-            time.sleep(1)
-
-            # Here you could add log file monitoring
-            # or other specific checks
+            try:
+                current = read_metrics()
+            except OSError as e:
+                print(f"❌ No metrics from {METRICS_URL}: {e}")
+                time.sleep(interval)
+                continue
+
+            if previous is not None:
+
+                def rate(name):
+                    return (current.get(name, 0.0) - previous.get(name, 0.0)) / interval
+
+                # Only measured with --loop-lag
+                lag = f"  lag p99 {current[LAG_P99] * 1000:5.1f} ms" if LAG_P99 in current else ""
+                print(
+                    f"in {rate('snom_datagrams_received_total'):7.1f}  "
+                    f"out {rate('snom_datagrams_sent_total'):7.1f}  "
+                    f"delivered {rate(DELIVERED):6.1f}  "
+                    f"retries {rate('snom_retries_total'):6.1f}  "
+                    f"queued {current.get('snom_outbox_messages', 0):6.0f}  "
+                    f"handsets {current.get(HANDSETS, 0):5.0f}"
+                    f"{lag}"
+                )
+            previous = current
+            time.sleep(interval)
 
     except KeyboardInterrupt:
         print("\n\n👋 Monitoring interrupted")
@@ -55,10 +104,21 @@ def show_roaming_table():
     """
     Shows current roaming table status.
     """
-    print("\n📋 To see current roaming table:")
-    print("   1. Check server logs")
-    print("   2. Wait for automatic print every 2 minutes")
-    print("   3. Or send a message to trigger activity")
+    try:
+        metrics = read_metrics()
+    except OSError as e:
+        print(f"\n❌ No metrics from {METRICS_URL}: {e}")
+        return
+    print("\n📋 Roaming table:")
+    print(f"   Handsets:     {metrics.get(HANDSETS, 0):.0f}")
+    print(f"   BaseStations: {metrics.get(BASESTATIONS, 0):.0f}")
+    print(f"   Queued messages: {metrics.get('snom_outbox_messages', 0):.0f}")
+
+    # The first page of the table, one JSON object per line
+    with urllib.request.urlopen(ROAMING_URL + "?limit=50", timeout=2) as response:
+        for line in response:
+            entry = json.loads(line)
+            print(f"   Extension {entry['extension']}: {entry['base']} (last seen: {time.ctime(entry['last_seen'])})")
 
 
 def show_test_instructions():
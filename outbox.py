@@ -0,0 +1,288 @@
+import heapq
+import itertools
+
+
+def _by_priority(message):
+    return -message.priority
+
+
+class Outbox:
+    """
+    This class stores the messages waiting for delivery.
+
+    Messages are indexed by their internal id, so status updates can find
+    them without scanning the queue. A second index groups the messages by
+    recipient, so all messages for a handset can be found when it shows up.
+    Two heaps keep track of time:
+    * The retry-heap is ordered by the time the next send attempt is due.
+    * The expiry-heap is ordered by the time a message is dropped undelivered.
+
+    Due messages that have to wait for their BaseStation are parked in a
+    queue per BaseStation instead, see park(). They are taken out one by one
+    as the BaseStation can take them, without a timer per message.
+
+    All heaps use lazy deletion: Removing or rescheduling a message leaves
+    its old heap entry behind. Stale entries are skipped when they reach the
+    top of the heap and the heaps are rebuilt if they grow too large.
+    """
+
+    def __init__(self, max_age):
+        """
+        Creates a new, empty Outbox.
+
+        max_age is the time in seconds after which an undelivered message
+        is removed from the Outbox.
+        """
+
+        self._max_age = max_age
+        self._messages = {}
+        self._by_recipient = {}
+        self._retry_heap = []
+        self._expiry_heap = []
+        # key => heap of parked messages, see park()
+        self._parked = {}
+        self._parked_entries = 0
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(list(self._messages.values()))
+
+    def __contains__(self, internal_ext_id):
+        return internal_ext_id in self._messages
+
+    def get(self, internal_ext_id):
+        return self._messages.get(internal_ext_id)
+
+    def page(self, offset=0, limit=100, to_ext=None):
+        """
+        Returns up to `limit` queued messages, skipping the first `offset`,
+        optionally only those for the extension `to_ext`.
+        """
+
+        if to_ext is None:
+            return list(itertools.islice(self._messages.values(), offset, offset + limit))
+        ids = itertools.islice(self._by_recipient.get(to_ext, ()), offset, offset + limit)
+        return [self._messages[internal_ext_id] for internal_ext_id in ids]
+
+    def for_recipient(self, to_ext):
+        """
+        Returns all queued messages for the extension `to_ext`.
+        """
+
+        return [self._messages[internal_ext_id] for internal_ext_id in self._by_recipient.get(to_ext, ())]
+
+    def add(self, message, due=0):
+        """
+        Adds a message to the Outbox. The first send attempt is due at `due`.
+        """
+
+        self._messages[message.internal_ext_id] = message
+        self._by_recipient.setdefault(message.to_ext, set()).add(message.internal_ext_id)
+        heapq.heappush(self._expiry_heap, (message.created + self._max_age, message.internal_ext_id))
+        self.schedule(message, due)
+
+    def load(self, messages):
+        """
+        Adds many messages at once, e.g. when recovering the queue on startup.
+
+        messages is an iterable of (message, due) tuples.
+        This is a lot faster than calling add() for every message.
+        """
+
+        retry_heap = self._retry_heap
+        expiry_heap = self._expiry_heap
+        all_messages = self._messages
+        by_recipient = self._by_recipient
+        seq = self._seq
+        max_age = self._max_age
+        for message, due in messages:
+            internal_ext_id = message.internal_ext_id
+            all_messages[internal_ext_id] = message
+            pending = by_recipient.get(message.to_ext)
+            if pending is None:
+                pending = by_recipient[message.to_ext] = set()
+            pending.add(internal_ext_id)
+            message.next_try = due
+            message.outbox_seq = outbox_seq = next(seq)
+            retry_heap.append((due, outbox_seq, internal_ext_id))
+            expiry_heap.append((message.created + max_age, internal_ext_id))
+        heapq.heapify(retry_heap)
+        heapq.heapify(expiry_heap)
+
+    def remove(self, internal_ext_id):
+        """
+        Removes a message from the Outbox.
+
+        Returns the removed message or None if the message was unknown.
+        """
+
+        message = self._messages.pop(internal_ext_id, None)
+        if message is not None:
+            message.outbox_seq = None
+            self._unindex(message)
+            self._compact()
+        return message
+
+    def schedule(self, message, due):
+        """
+        (Re-)Schedules the next send attempt of a message.
+        Any previously scheduled attempt of this message is discarded.
+        """
+
+        message.next_try = due
+        message.outbox_seq = next(self._seq)
+        heapq.heappush(self._retry_heap, (due, message.outbox_seq, message.internal_ext_id))
+        self._compact()
+
+    def pop_due(self, now):
+        """
+        Returns all messages whose next send attempt is due at `now`, the
+        most urgent first: by priority (highest first), then by the time
+        they were due.
+
+        The returned messages stay in the Outbox but are no longer scheduled.
+        The caller has to schedule the next attempt using schedule().
+        """
+
+        due = []
+        heap = self._retry_heap
+        while heap and heap[0][0] <= now:
+            _, seq, internal_ext_id = heapq.heappop(heap)
+            message = self._messages.get(internal_ext_id)
+            if message is not None and message.outbox_seq == seq:
+                message.outbox_seq = None
+                due.append(message)
+        # The heap yields them by time already, the sort is stable.
+        due.sort(key=_by_priority)
+        return due
+
+    def park(self, message, key):
+        """
+        Parks a message returned by pop_due() in the queue `key`, e.g. the
+        address of its BaseStation, until take_parked() hands it out.
+        Parked messages are handed out by priority, then by the time they
+        were due. schedule() and remove() take a message out of its queue.
+        """
+
+        message.outbox_seq = next(self._seq)
+        heap = self._parked.get(key)
+        if heap is None:
+            heap = self._parked[key] = []
+        heapq.heappush(heap, (-message.priority, message.next_try, message.outbox_seq, message.internal_ext_id))
+        self._parked_entries += 1
+
+    def peek_parked(self, key):
+        """
+        Returns the next message parked in the queue `key` without taking it
+        out, or None if the queue is empty.
+        """
+
+        heap = self._parked.get(key)
+        while heap:
+            _, _, seq, internal_ext_id = heap[0]
+            message = self._messages.get(internal_ext_id)
+            if message is not None and message.outbox_seq == seq:
+                return message
+            heapq.heappop(heap)
+            self._parked_entries -= 1
+        self._parked.pop(key, None)
+        return None
+
+    def take_parked(self, key):
+        """
+        Takes the next message out of the queue `key` and returns it, or None
+        if the queue is empty. Like pop_due() the message is no longer scheduled.
+        """
+
+        message = self.peek_parked(key)
+        if message is not None:
+            heapq.heappop(self._parked[key])
+            self._parked_entries -= 1
+            message.outbox_seq = None
+        return message
+
+    def pop_expired(self, now):
+        """
+        Removes and returns all messages that are older than max_age at `now`.
+        """
+
+        expired = []
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            _, internal_ext_id = heapq.heappop(heap)
+            message = self._messages.pop(internal_ext_id, None)
+            if message is not None:
+                message.outbox_seq = None
+                self._unindex(message)
+                expired.append(message)
+        return expired
+
+    def next_deadline(self):
+        """
+        Returns the earliest point in time the Outbox needs attention,
+        or None if there is nothing to do.
+        """
+
+        self._drop_stale()
+        deadlines = []
+        if self._retry_heap:
+            deadlines.append(self._retry_heap[0][0])
+        if self._expiry_heap:
+            deadlines.append(self._expiry_heap[0][0])
+        return min(deadlines, default=None)
+
+    def _unindex(self, message):
+        """
+        Removes a message from the recipient index.
+        """
+
+        pending = self._by_recipient.get(message.to_ext)
+        if pending is not None:
+            pending.discard(message.internal_ext_id)
+            if not pending:
+                del self._by_recipient[message.to_ext]
+
+    def _drop_stale(self):
+        """
+        Removes stale entries from the top of both heaps.
+        """
+
+        heap = self._retry_heap
+        while heap:
+            _, seq, internal_ext_id = heap[0]
+            message = self._messages.get(internal_ext_id)
+            if message is not None and message.outbox_seq == seq:
+                break
+            heapq.heappop(heap)
+
+        heap = self._expiry_heap
+        while heap and heap[0][1] not in self._messages:
+            heapq.heappop(heap)
+
+    def _compact(self):
+        """
+        Rebuilds the heaps if they mostly consist of stale entries.
+        """
+
+        limit = 2 * len(self._messages) + 64
+        if len(self._retry_heap) > limit:
+            self._retry_heap = [
+                entry for entry in self._retry_heap if entry[2] in self._messages and self._messages[entry[2]].outbox_seq == entry[1]
+            ]
+            heapq.heapify(self._retry_heap)
+        if len(self._expiry_heap) > limit:
+            self._expiry_heap = [entry for entry in self._expiry_heap if entry[1] in self._messages]
+            heapq.heapify(self._expiry_heap)
+        if self._parked_entries > limit:
+            self._parked_entries = 0
+            for key, heap in list(self._parked.items()):
+                heap = [entry for entry in heap if entry[3] in self._messages and self._messages[entry[3]].outbox_seq == entry[2]]
+                if heap:
+                    heapq.heapify(heap)
+                    self._parked[key] = heap
+                    self._parked_entries += len(heap)
+                else:
+                    del self._parked[key]
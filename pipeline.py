@@ -0,0 +1,215 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+
+from frame import Frame, classify
+
+logger = logging.getLogger(__name__)
+
+# Frames the BaseStations send periodically. They are dropped first when the
+# server can not keep up: The next one carries the same information.
+_KEEPALIVES = {
+    ("request", "systeminfo"),
+}
+
+
+def _parse_batch(batch, reads):
+    """
+    Parses a list of (data, addr) datagrams. This runs in the pool.
+
+    Every Frame has the paths its drivers read (see UdpServer.register_driver())
+    in its cache already, so the event loop does not need to scan the raw bytes.
+    Returns a list of (frame, addr) tuples. Messages that are not XML are
+    returned as (ValueError, addr).
+    """
+    results = []
+    for data, addr in batch:
+        for message in data.split(b"\0"):
+            if not message.strip():
+                continue
+            try:
+                frame = Frame(message)
+            except ValueError as exp:
+                results.append((exp, addr))
+                continue
+            results.append((frame.materialize(reads.get((frame.tag, frame.type), ())), addr))
+    return results
+
+
+class ParsePipeline:
+    """
+    This class parses incoming datagrams in a pool of threads or processes
+    and hands the Frames back to the event loop in the order they arrived.
+
+    Datagrams are queued until the pool can take them and sent to the pool
+    in batches of up to `batch_size`. At most `max_queued` datagrams wait in
+    the queue. If it is full, the oldest keep-alive is dropped for a new
+    datagram. If there are no keep-alives in the queue, the new datagram is
+    dropped: Phones send jobs again if they get no confirmation.
+
+    Threads keep the event loop responsive while parsing (the GIL is passed
+    on every few milliseconds), processes also parse in parallel to it.
+    """
+
+    def __init__(self, server, executor="thread", workers=2, max_queued=10000, batch_size=64):
+        self._server = server
+        if executor == "process":
+            self._executor = concurrent.futures.ProcessPoolExecutor(workers)
+        elif executor == "thread":
+            self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="parser")
+        else:
+            raise ValueError("Unknown executor: {!r}".format(executor))
+        self._max_batches = workers
+        self._max_queued = max_queued
+        self._batch_size = batch_size
+
+        # Keep-alives and everything else, as (sequence number, data, addr).
+        self._keepalives = collections.deque()
+        self._others = collections.deque()
+        self._sequence = 0
+
+        # Futures of the batches in the pool, in the order they were submitted.
+        self._in_flight = collections.deque()
+
+        self.received = 0
+        self.batches = 0
+        self.shed = 0
+        self.dropped = 0
+        self.max_queue_length = 0
+
+    def __len__(self):
+        return len(self._keepalives) + len(self._others)
+
+    def submit(self, data, addr):
+        """
+        Queues a datagram for parsing. Called by the UdpServer for every datagram.
+        """
+        self.received += 1
+        keepalive = classify(data) in _KEEPALIVES
+        if len(self) >= self._max_queued:
+            if self._keepalives:
+                self._keepalives.popleft()
+                self.shed += 1
+            else:
+                self.dropped += 1
+                logger.debug("Parse queue full, dropping datagram from %s", addr)
+                return
+
+        (self._keepalives if keepalive else self._others).append((self._sequence, data, addr))
+        self._sequence += 1
+        self.max_queue_length = max(self.max_queue_length, len(self))
+        self._schedule()
+
+    def _schedule(self):
+        """
+        Sends batches of queued datagrams to the pool while it has idle workers.
+        """
+        keepalives = self._keepalives
+        others = self._others
+        while len(self._in_flight) < self._max_batches and (keepalives or others):
+            batch = []
+            while len(batch) < self._batch_size and (keepalives or others):
+                if not others or (keepalives and keepalives[0][0] < others[0][0]):
+                    _, data, addr = keepalives.popleft()
+                else:
+                    _, data, addr = others.popleft()
+                batch.append((data, addr))
+
+            self.batches += 1
+            future = asyncio.get_running_loop().run_in_executor(self._executor, _parse_batch, batch, self._server.reads)
+            future.add_done_callback(self._completed)
+            self._in_flight.append(future)
+
+    def _completed(self, _):
+        """
+        Dispatches the Frames of all finished batches, keeping the order.
+        """
+        while self._in_flight and self._in_flight[0].done():
+            future = self._in_flight.popleft()
+            if future.cancelled():
+                continue
+            try:
+                results = future.result()
+            except Exception as exp:
+                logger.warning("Parsing a batch of datagrams failed: %s", exp)
+                continue
+            for frame, addr in results:
+                if isinstance(frame, ValueError):
+                    logger.warning("Dropping message from %s that is not XML: %s", addr, frame)
+                else:
+                    self._server.dispatch(frame, addr)
+        self._schedule()
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "batches": self.batches,
+            "queued": len(self),
+            "max_queue_length": self.max_queue_length,
+            "shed": self.shed,
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        """
+        Drops the queued datagrams and shuts the pool down.
+        """
+        self._keepalives.clear()
+        self._others.clear()
+        for future in self._in_flight:
+            future.cancel()
+        self._in_flight.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class LoopLag:
+    """
+    This class measures how late the event loop runs a timer that is due
+    every `interval` seconds. Long running callbacks (e.g. parsing a large
+    datagram) show up as lag.
+    """
+
+    def __init__(self, interval=0.01, samples=10000):
+        self._interval = interval
+        self._samples = collections.deque(maxlen=samples)
+        self._handle = None
+        self._due = None
+        self.max = 0.0
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._due = loop.time() + self._interval
+        self._handle = loop.call_at(self._due, self._tick, loop)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _tick(self, loop):
+        now = loop.time()
+        lag = max(0.0, now - self._due)
+        self._samples.append(lag)
+        self.max = max(self.max, lag)
+        self._due = now + self._interval
+        self._handle = loop.call_at(self._due, self._tick, loop)
+
+    def reset(self):
+        self._samples.clear()
+        self.max = 0.0
+
+    def stats(self):
+        """
+        Returns mean, 99th percentile and maximum of the lag in seconds
+        over the last samples (the maximum since the last reset()).
+        """
+        samples = sorted(self._samples)
+        if not samples:
+            return {"samples": 0, "mean": 0.0, "p99": 0.0, "max": self.max}
+        return {
+            "samples": len(samples),
+            "mean": sum(samples) / len(samples),
+            "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+            "max": self.max,
+        }
@@ -0,0 +1,218 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _BaseStation:
+    """
+    State of the rate controller for a single BaseStation.
+    """
+
+    __slots__ = (
+        "addr",
+        "rate",
+        "tat",
+        "budget_tat",
+        "outstanding",
+        "last_decrease",
+        "sent",
+        "acks",
+        "responses",
+        "lost",
+        "delayed",
+        "decreases",
+    )
+
+    def __init__(self, addr, rate):
+        self.addr = addr
+        self.rate = rate
+        # Theoretical arrival time of the next message at the configured rate (GCRA)
+        self.tat = 0.0
+        # priority => theoretical arrival time within the budget of the priority
+        self.budget_tat = {}
+        # internal id => time sent, in the order the messages were sent
+        self.outstanding = {}
+        self.last_decrease = 0.0
+
+        self.sent = 0
+        self.acks = 0
+        self.responses = 0
+        self.lost = 0
+        self.delayed = 0
+        self.decreases = 0
+
+
+class RateController:
+    """
+    This class limits the rate of messages sent to each BaseStation.
+
+    Every BaseStation has a token bucket: Up to `burst` messages are sent at
+    once, further messages are spaced at the current rate of the BaseStation.
+    Time slots are only reserved up to `burst` messages ahead, so changes of
+    the rate apply to all messages that are not on their way yet.
+    The rate adapts to what the BaseStation can take (AIMD):
+    * Acknowledgements (status 1) increase the rate. While all messages are
+      acknowledged the rate grows by `increase` messages/s every second.
+    * A message without any response within `ack_timeout` seconds counts as lost.
+      Losses halve the rate (`decrease`), at most once per `ack_timeout`.
+
+    If several controllers send to the same BaseStations (e.g. one per worker
+    process), each one uses `share` of the rates.
+
+    budgets maps message priorities to the share of the rate of a BaseStation
+    their messages may use, e.g. {0: 0.8}: Routine messages leave room for
+    urgent ones, which are sent right away even while a backlog of routine
+    messages keeps the BaseStation busy. Priorities without a budget may use
+    the whole rate.
+    """
+
+    def __init__(
+        self,
+        initial_rate=50.0,
+        min_rate=2.0,
+        max_rate=200.0,
+        burst=10,
+        increase=5.0,
+        decrease=0.5,
+        ack_timeout=5.0,
+        share=1.0,
+        budgets=None,
+    ):
+        self._initial_rate = initial_rate * share
+        self._min_rate = min_rate * share
+        self._max_rate = max_rate * share
+        self._burst = burst
+        self._increase = increase * share
+        self._decrease = decrease
+        self._ack_timeout = ack_timeout
+        self._budgets = dict(budgets or {})
+
+        self._bases = {}
+
+    @property
+    def ack_timeout(self):
+        """
+        Seconds after which a message without response counts as lost.
+        """
+        return self._ack_timeout
+
+    def _base(self, addr):
+        base = self._bases.get(addr)
+        if base is None:
+            base = self._bases[addr] = _BaseStation(addr, self._initial_rate)
+        return base
+
+    def reserve(self, addr, now, priority=0):
+        """
+        Reserves the next time slot for a message of the given priority to
+        the BaseStation at addr.
+
+        Returns a tuple (slot, reserved): If reserved is True, the message may
+        be sent at slot, which is `now` if it can be sent immediately.
+        Otherwise too many messages are waiting for the BaseStation (or within
+        the budget of the priority) already and reserve() has to be called
+        again at slot.
+        """
+        base = self._base(addr)
+        self._detect_losses(base, now)
+
+        interval = 1.0 / base.rate
+        tat = max(base.tat, now)
+        slot = max(now, tat - (self._burst - 1) * interval)
+        if slot > now + self._burst * interval:
+            return slot - self._burst * interval, False
+
+        budget = self._budgets.get(priority)
+        if budget is not None:
+            # The same token bucket at the share of the rate
+            budget_interval = interval / budget
+            budget_tat = max(base.budget_tat.get(priority, 0.0), now)
+            budget_slot = max(now, budget_tat - (self._burst - 1) * budget_interval)
+            if budget_slot > now + self._burst * budget_interval:
+                return budget_slot - self._burst * budget_interval, False
+            base.budget_tat[priority] = budget_tat + budget_interval
+            slot = max(slot, budget_slot)
+
+        base.tat = tat + interval
+        if slot > now:
+            base.delayed += 1
+        return slot, True
+
+    def sent(self, addr, internal_ext_id, now):
+        """
+        Records that a message was sent to the BaseStation at addr.
+        """
+        base = self._base(addr)
+        base.sent += 1
+        base.outstanding.pop(internal_ext_id, None)
+        base.outstanding[internal_ext_id] = now
+
+    def response(self, addr, internal_ext_id, status, now):
+        """
+        Records a status response for a message from the BaseStation at addr.
+        """
+        base = self._bases.get(addr)
+        if base is None:
+            return
+        base.responses += 1
+        base.outstanding.pop(internal_ext_id, None)
+        if status == 1:
+            base.acks += 1
+            base.rate = min(self._max_rate, base.rate + self._increase / base.rate)
+
+    def _detect_losses(self, base, now):
+        """
+        Counts the messages without response for longer than ack_timeout as
+        lost and backs off if there are any.
+        """
+        outstanding = base.outstanding
+        deadline = now - self._ack_timeout
+        lost = 0
+        while outstanding:
+            internal_ext_id, sent = next(iter(outstanding.items()))
+            if sent > deadline:
+                break
+            del outstanding[internal_ext_id]
+            lost += 1
+
+        if lost:
+            base.lost += lost
+            if now - base.last_decrease >= self._ack_timeout:
+                base.last_decrease = now
+                base.decreases += 1
+                base.rate = max(self._min_rate, base.rate * self._decrease)
+                logger.warning("%s messages to %s got no response, reducing rate to %.1f messages/s", lost, base.addr, base.rate)
+
+    def outstanding(self, now):
+        """
+        Returns the number of messages waiting for a response that are not
+        counted as lost yet.
+        """
+        count = 0
+        for base in self._bases.values():
+            self._detect_losses(base, now)
+            count += len(base.outstanding)
+        return count
+
+    def stats(self, now=None):
+        """
+        Returns the counters of all BaseStations as a list of dicts.
+        """
+        result = []
+        for base in self._bases.values():
+            if now is not None:
+                self._detect_losses(base, now)
+            result.append(
+                {
+                    "addr": base.addr,
+                    "rate": base.rate,
+                    "sent": base.sent,
+                    "acks": base.acks,
+                    "responses": base.responses,
+                    "lost": base.lost,
+                    "delayed": base.delayed,
+                    "decreases": base.decreases,
+                    "outstanding": len(base.outstanding),
+                }
+            )
+        return result
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""
+Replays a capture file (see snom_messaging.py --capture) into the messaging
+server and reports its throughput, latency and memory.
+
+Without --server the datagrams go straight into UdpServer.datagram_received()
+of a server in this process, outgoing datagrams are dropped. With --server
+they are sent over UDP to a running server, from one socket per
+BaseStation of the capture.
+"""
+
+import argparse
+import asyncio
+import logging
+import resource
+import time
+
+from capture import read_capture
+from consumer import ConsumerDriver
+from frame import Frame, classify
+from messagesystem import MessageSystem
+from roaming import RoamingMonitor
+from rssi import RssiMonitor
+from snom_messaging import UdpServer
+
+logger = logging.getLogger(__name__)
+
+
+class _NullTransport:
+    """
+    Stands in for the UDP socket, outgoing datagrams are dropped.
+    """
+
+    def sendto(self, data, addr=None):
+        pass
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def _paced(records, speed):
+    """
+    Yields (data, addr) of the records at `speed` times the speed they were
+    captured at, or as fast as possible if speed is None.
+    """
+    start = time.perf_counter()
+    first = None
+    for count, (when, data, addr) in enumerate(records, 1):
+        if speed is None:
+            if count % 100 == 0:
+                # Let the server run its timers, e.g. the outbox.
+                await asyncio.sleep(0)
+        else:
+            if first is None:
+                first = when
+            delay = (when - first) / speed - (time.perf_counter() - start)
+            if delay > 0.001:
+                await asyncio.sleep(delay)
+        yield data, addr
+
+
+async def replay_direct(records, speed=None):
+    """
+    Feeds the records into datagram_received() of a complete server in this process.
+
+    Returns a dict with the number of datagrams, the seconds it took, the
+    percentiles of the time datagram_received() took per datagram, the
+    messages queued at the end and the peak RSS of this process in KiB.
+    """
+    server = UdpServer()
+    server.connection_made(_NullTransport())
+    roaming_monitor = RoamingMonitor(server)
+    RssiMonitor(server, roaming_monitor)
+    message_system = MessageSystem(server, roaming_monitor)
+    ConsumerDriver(server)
+    await roaming_monitor.start()
+    await message_system.start()
+
+    latencies = []
+    begin = time.perf_counter()
+    async for data, addr in _paced(records, speed):
+        start = time.perf_counter()
+        server.datagram_received(data, addr)
+        latencies.append(time.perf_counter() - start)
+    # Give the outbox a chance to catch up.
+    await asyncio.sleep(0)
+    elapsed = time.perf_counter() - begin
+
+    queued = len(message_system._outbox)
+    await message_system.stop(0)
+    await roaming_monitor.stop()
+    return {
+        "datagrams": len(latencies),
+        "seconds": elapsed,
+        "p50": _percentile(latencies, 0.5),
+        "p99": _percentile(latencies, 0.99),
+        "queued": queued,
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+class _Source(asyncio.DatagramProtocol):
+    """
+    The socket of one BaseStation of the capture. Measures the time until
+    the server confirms the jobs sent from it.
+    """
+
+    def __init__(self, pending, latencies):
+        self._pending = pending
+        self._latencies = latencies
+
+    def datagram_received(self, data, addr):
+        if classify(data) != ("response", "job"):
+            # Messages the server sends to the handsets
+            return
+        sent = self._pending.pop(Frame(data.rstrip(b"\0")).get("externalid"), None)
+        if sent is not None:
+            self._latencies.append(time.perf_counter() - sent)
+
+
+def _server_memory(pid):
+    """
+    Returns the peak RSS of the process pid in KiB, None if unknown.
+    """
+    try:
+        with open("/proc/{}/status".format(pid), encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+async def replay_remote(records, host, port, speed=None, pid=None, wait=1.0):
+    """
+    Sends the records to a running server.
+
+    Returns a dict like replay_direct(). The latencies are the times until
+    the server confirmed the jobs, max_rss is the peak RSS of the server
+    process pid (None without pid).
+    """
+    loop = asyncio.get_running_loop()
+    sources = {}
+    pending = {}
+    latencies = []
+    count = 0
+    begin = time.perf_counter()
+    try:
+        async for data, addr in _paced(records, speed):
+            transport = sources.get(addr)
+            if transport is None:
+                transport, _ = await loop.create_datagram_endpoint(lambda: _Source(pending, latencies), remote_addr=(host, port))
+                sources[addr] = transport
+            if classify(data) == ("request", "job"):
+                pending[Frame(data.rstrip(b"\0")).get("externalid")] = time.perf_counter()
+            transport.sendto(data)
+            count += 1
+        elapsed = time.perf_counter() - begin
+        await asyncio.sleep(wait)
+    finally:
+        for transport in sources.values():
+            transport.close()
+
+    return {
+        "datagrams": count,
+        "seconds": elapsed,
+        "p50": _percentile(latencies, 0.5),
+        "p99": _percentile(latencies, 0.99),
+        "unconfirmed": len(pending),
+        "max_rss": _server_memory(pid) if pid else None,
+    }
+
+
+def print_stats(stats, latency="processing"):
+    print(f"{stats['datagrams']} datagrams in {stats['seconds']:.2f} s: {stats['datagrams'] / stats['seconds']:.0f} datagrams/s")
+    print(f"  {latency} latency: p50 {stats['p50'] * 1e6:.0f} us, p99 {stats['p99'] * 1e6:.0f} us")
+    if "queued" in stats:
+        print(f"  messages queued: {stats['queued']}")
+    if "unconfirmed" in stats:
+        print(f"  jobs not confirmed: {stats['unconfirmed']}")
+    if stats["max_rss"] is not None:
+        print(f"  peak memory: {stats['max_rss'] / 1024:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a capture file into the messaging server")
+    parser.add_argument("capture", help="Capture file written by snom_messaging.py --capture")
+    parser.add_argument(
+        "--speed",
+        default="1",
+        type=lambda value: None if value == "max" else float(value),
+        help="Speed relative to the capture, e.g. 1, 10 or max (default: 1)",
+    )
+    parser.add_argument("--server", help="HOST:PORT of a running server (default: replay into a server in this process)")
+    parser.add_argument("--pid", type=int, help="Process id of the running server to report its memory")
+    parser.add_argument("--log-level", default="ERROR", help="Log level of the server in this process (default: ERROR)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    records = read_capture(args.capture)
+    if args.server:
+        host, _, port = args.server.rpartition(":")
+        print_stats(asyncio.run(replay_remote(records, host or "127.0.0.1", int(port), args.speed, args.pid)), "job confirmation")
+    else:
+        print_stats(asyncio.run(replay_direct(records, args.speed)))
+
+
+if __name__ == "__main__":
+    main()
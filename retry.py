@@ -0,0 +1,101 @@
+import random
+
+
+class RetryPolicy:
+    """
+    This class decides when a message is sent again.
+
+    The delay before the n-th retry is initial * factor ** (n - 1), limited to
+    max_interval and varied randomly by +/- jitter (a fraction of the delay),
+    so messages queued at the same time do not stay in lockstep.
+    After max_attempts retries the message is given up (None: never).
+    With wake_on_presence, the message is retried as soon as its recipient
+    shows up on a BaseStation.
+    """
+
+    def __init__(self, initial=60, factor=1, max_interval=None, jitter=0, max_attempts=None, wake_on_presence=True):
+        self.initial = initial
+        self.factor = factor
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.wake_on_presence = wake_on_presence
+
+    def __repr__(self):
+        return "<RetryPolicy initial={} factor={} max_interval={} jitter={} max_attempts={} wake_on_presence={}>".format(
+            self.initial, self.factor, self.max_interval, self.jitter, self.max_attempts, self.wake_on_presence
+        )
+
+    def delay(self, retry):
+        """
+        Returns the seconds to wait before the retry with the given number
+        (starting at 1) or None if the message should be given up.
+        """
+        if self.max_attempts is not None and retry > self.max_attempts:
+            return None
+
+        delay = self.initial * self.factor ** (retry - 1)
+        if self.max_interval is not None:
+            delay = min(delay, self.max_interval)
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return delay
+
+
+class RetryPolicies:
+    """
+    This class holds the RetryPolicy for every outcome of a send attempt:
+    * no_response: The BaseStation did not answer (yet).
+    * absent: The BaseStation reported the recipient as absent (status 11).
+    * unknown: The BaseStation answered with a status code we do not know.
+
+    Messages with a priority can have their own policies, outcomes without
+    one use the default policy.
+    """
+
+    OUTCOMES = ("no_response", "absent", "unknown")
+
+    def __init__(self, policies=None, priorities=None):
+        """
+        policies is a dict of outcome => RetryPolicy overriding the defaults.
+        priorities is a dict of priority => dict of outcome => RetryPolicy.
+        """
+        self._policies = {
+            # Datagrams get lost: try again like we always did.
+            "no_response": RetryPolicy(initial=60),
+            # Nobody is going to read it before the handset comes back, which
+            # we usually notice by its presence.
+            "absent": RetryPolicy(initial=60, factor=2, max_interval=4 * 60 * 60, jitter=0.2),
+            # Retrying will most likely not help.
+            "unknown": RetryPolicy(initial=60, max_attempts=5, wake_on_presence=False),
+        }
+        self._policies.update(policies or {})
+        self._priorities = priorities or {}
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Creates the RetryPolicies from a dict as read from a JSON file, e.g.:
+        {"absent": {"initial": 30, "factor": 2},
+         "priorities": {"1": {"absent": {"initial": 10, "max_interval": 600}}}}
+        The keys of a policy are the arguments of RetryPolicy.
+        """
+
+        def policies(section):
+            unknown = set(section) - set(cls.OUTCOMES)
+            if unknown:
+                raise ValueError("Unknown outcomes in retry policies: {}".format(", ".join(sorted(unknown))))
+            return {outcome: RetryPolicy(**arguments) for outcome, arguments in section.items()}
+
+        config = dict(config)
+        priorities = config.pop("priorities", {})
+        return cls(policies(config), {int(priority): policies(section) for priority, section in priorities.items()})
+
+    def get(self, outcome, priority=0):
+        """
+        Returns the RetryPolicy for an outcome of a message with the given priority.
+        """
+        policies = self._priorities.get(priority)
+        if policies is not None and outcome in policies:
+            return policies[outcome]
+        return self._policies[outcome]
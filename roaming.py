@@ -1,83 +1,526 @@
+import asyncio
+import itertools
 import logging
 import time
 
+from timerwheel import TimerWheel
+
 logger = logging.getLogger(__name__)
 
+# Kinds of RoamingEvents
+ADD = "add"
+MOVE = "move"
+REMOVE = "remove"
+
+
+class RoamingEvent:
+    """
+    A change of the roaming table:
+    * add: The extension showed up or logged in on the BaseStation addr.
+    * move: The extension moved from the BaseStation previous to addr.
+    * remove: The extension left the BaseStation previous or logged out, addr is None.
+    """
+
+    __slots__ = ("kind", "number", "addr", "previous")
+
+    def __init__(self, kind, number, addr, previous=None):
+        self.kind = kind
+        self.number = number
+        self.addr = addr
+        self.previous = previous
+
+    def __repr__(self):
+        return "<RoamingEvent {} {} {} => {}>".format(self.kind, self.number, self.previous, self.addr)
+
+
+class _BaseStation:
+    """
+    State of a single BaseStation.
+
+    An extension the BaseStation lists that has no state of its own is
+    stored in the roaming table as the _BaseStation itself instead of a
+    Presence, see RoamingMonitor. Like a Presence it has `base`.
+    """
+
+    __slots__ = ("addr", "listed", "unlisted", "seen", "interval", "expires", "scheduled")
+
+    def __init__(self, addr, now):
+        # The addr tuple is stored once per BaseStation, not per extension.
+        self.addr = addr
+        # Extensions of the last systeminfo, in its order. A tuple takes a
+        # fraction of the memory of a set and an unchanged list compares equal.
+        self.listed = ()
+        # Extensions that logged in here but are not listed (yet)
+        self.unlisted = set()
+        self.seen = now
+        # Average time between two systeminfo, None until the second one.
+        self.interval = None
+        # See RoamingMonitor._schedule()
+        self.expires = None
+        self.scheduled = None
+
+    @property
+    def base(self):
+        return self
+
+    def unlist(self, number):
+        """
+        Removes an extension that left the BaseStation.
+        """
+        if number in self.listed:
+            self.listed = tuple(listed for listed in self.listed if listed != number)
+        self.unlisted.discard(number)
+
+
+class Presence:
+    """
+    Where an extension is: The BaseStation it is on (addr), when it was last
+    seen there and the RSSI the BaseStation reported (None if unknown).
+
+    The roaming table only keeps a Presence for extensions that logged in
+    but are not listed by their BaseStation (yet) or have an RSSI.
+    """
+
+    __slots__ = ("number", "base", "seen", "rssi", "expires", "scheduled")
+
+    def __init__(self, number, base, now):
+        self.number = number
+        self.base = base
+        # Time of the login or the first systeminfo listing the extension.
+        self.seen = now
+        self.rssi = None
+        # Only set while no systeminfo lists the extension, see RoamingMonitor._schedule().
+        self.expires = None
+        self.scheduled = None
+
+    def __repr__(self):
+        return "<Presence {} on {} rssi={}>".format(self.number, self.addr, self.rssi)
+
+    @property
+    def addr(self):
+        return self.base.addr
+
+    @property
+    def last_seen(self):
+        """
+        The last time the BaseStation listed the extension, or the time it logged in.
+        """
+        if self.number in self.base.listed:
+            return max(self.seen, self.base.seen)
+        return self.seen
+
 
 class RoamingMonitor:
-    def __init__(self, udp_server):
+    """
+    This class tracks which extension is on which BaseStation.
+
+    Entries expire if they are not confirmed for `misses` keep-alive
+    intervals of their BaseStation (at least min_ttl seconds, default_ttl
+    until the interval is known): All extensions of a BaseStation that is
+    not heard of anymore are removed, as well as extensions that logged in
+    but are not listed by the systeminfo of their BaseStation.
+    Expiry runs on a TimerWheel holding the BaseStations and the unlisted
+    extensions, so keep-alives only move a deadline.
+
+    Most extensions are just listed by their BaseStation. The table maps
+    them to the _BaseStation, which costs nothing per extension but the
+    entry; only the others have a Presence.
+
+    Where the cells overlap, several BaseStations list the same extension.
+    It stays on its BaseStation as long as that one lists it, the others
+    are remembered and take over when it drops the extension.
+    """
+
+    # Messages handled by this driver, see UdpServer.register_driver()
+    handles = {
+        ("request", "systeminfo"): "process_systeminfo",
+        ("request", "login"): "process_login",
+    }
+
+    # Paths read from these messages, see UdpServer.register_driver()
+    reads = {
+        ("request", "systeminfo"): ("senderdata/address",),
+        ("request", "login"): ("logindata/status", "senderdata/address"),
+    }
+
+    # Seconds between two runs of expire()
+    _tick = 1.0
+
+    def __init__(self, udp_server, misses=3, default_ttl=600.0, min_ttl=30.0):
         self._udp_server = udp_server
         self._udp_server.register_driver(self)
 
+        self._misses = misses
+        self._default_ttl = default_ttl
+        self._min_ttl = min_ttl
+
+        # extension => Presence, or _BaseStation if it is only listed there
         self._locations = {}
+        # addr => _BaseStation
+        self._bases = {}
+        # extension => other _BaseStations listing it, checked when they take over
+        self._also = {}
+        self._wheel = TimerWheel(self._tick)
+        self._timer = None
+        self._listeners = []
+        # Tells which BaseStation receives an extension best, see set_signal().
+        self._signal = None
+
+    async def start(self):
+        """
+        Starts expiring entries. Extensions are tracked from the moment the
+        RoamingMonitor is created.
+        """
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._tick, self._run_expiry)
+
+    async def stop(self):
+        """
+        Stops tracking the extensions. Listeners are not notified anymore.
+        """
+        self._udp_server.unregister_driver(self)
+        self.close()
 
     def close(self):
-        # TODO: Implement proper shutdown of this function.
-        pass
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """
+        Registers a callback for presence changes.
+
+        The callback is called as callback(event) with a RoamingEvent whenever
+        an extension shows up on a basestation, moves to another one or is gone.
+        """
+        self._listeners.append(callback)
+
+    def _notify(self, event):
+        for callback in self._listeners:
+            try:
+                callback(event)
+            except Exception as exp:
+                logger.warning("Presence listener %s failed with exception %s.", callback, exp)
+
+    def set_signal(self, signal):
+        """
+        Sets the source of signal strengths used by get_addr(), e.g. a
+        RssiMonitor, or None to route to the registered BaseStation.
+        It is asked as signal.best_addr(number, registered addr).
+        """
+        self._signal = signal
 
     def get_addr(self, number):
-        if number in self._locations:
-            return self._locations[number]["addr"]
-        return None
+        """
+        Returns the addr of the BaseStation to send to for an extension or
+        None if the extension is unknown.
+
+        This is the BaseStation that received the extension best recently
+        if there is a signal source, else the one the extension is registered on.
+        """
+        entry = self._locations.get(number)
+        if entry is None:
+            return None
+        addr = entry.base.addr
+        if self._signal is not None:
+            best = self._signal.best_addr(number, addr)
+            if best is not None and best in self._bases:
+                return best
+        return addr
+
+    def get_presence(self, number):
+        """
+        Returns the Presence of an extension or None if it is unknown.
+        Use set_rssi() to change it.
+        """
+        return self._presence(number, self._locations.get(number))
+
+    def _presence(self, number, entry):
+        """
+        Returns the Presence for an entry of the table, a new one if the
+        extension is only listed by its BaseStation.
+        """
+        if entry is None or entry.base is not entry:
+            return entry
+        return Presence(number, entry, entry.seen)
+
+    def set_rssi(self, number, addr, rssi):
+        """
+        Sets the RSSI the BaseStation at addr reported for an extension, if
+        the extension is on it.
+        """
+        entry = self._locations.get(number)
+        if entry is None or entry.base.addr != addr:
+            return
+        if entry.base is entry:
+            entry = self._locations[number] = Presence(number, entry, entry.seen)
+        entry.rssi = rssi
+
+    def stats(self):
+        return {"handsets": len(self._locations), "basestations": len(self._bases)}
+
+    def query(self, number=None, addr=None, offset=0, limit=100):
+        """
+        Returns a page of the roaming table: Up to `limit` Presences, skipping
+        the first `offset`, optionally only the extension `number` or the
+        extensions on the BaseStation `addr`.
+        """
+        if number is not None:
+            entry = self._locations.get(number)
+            if entry is None or (addr is not None and entry.base.addr != addr):
+                return []
+            return [self._presence(number, entry)][offset : offset + limit]
+
+        if addr is None:
+            entries = iter(self._locations.items())
+        else:
+            base = self._bases.get(addr)
+            if base is None:
+                return []
+            locations = self._locations
+            entries = (
+                (number, locations[number])
+                for number in itertools.chain(base.listed, base.unlisted)
+                if number in locations and locations[number].base is base
+            )
+        return [self._presence(number, entry) for number, entry in itertools.islice(entries, offset, offset + limit)]
+
+    def _ttl(self, base):
+        if base.interval is None:
+            return self._default_ttl
+        return max(self._min_ttl, self._misses * base.interval)
+
+    def process_systeminfo(self, frame, addr):
+        """
+        Updates the roaming table from the list of extensions a BaseStation
+        sends with every keep-alive.
+
+        Only the difference to the last list of the same BaseStation is
+        processed: Extensions that appeared were added or moved here, unless
+        their BaseStation still lists them. Extensions that disappeared move
+        to another BaseStation listing them or are removed. An unchanged list
+        only updates the time the BaseStation was last heard of.
+        """
+        now = time.time()
+        base = self._bases.get(addr)
+        if base is None:
+            base = self._new_base(addr, now)
+        else:
+            gap = now - base.seen
+            base.interval = gap if base.interval is None else base.interval + (gap - base.interval) / 4
+            base.seen = now
+            self._schedule(base, now + self._ttl(base))
+
+        numbers = tuple(frame.getall("senderdata/address"))
+        listed = base.listed
+        if numbers == listed:
+            return
+        # The table keeps using the strings it has already.
+        kept = dict(zip(listed, listed))
+        current = set(numbers)
+        added = [number for number in dict.fromkeys(numbers) if number not in kept]
+        removed = [number for number in listed if number not in current]
+        base.listed = tuple(kept.get(number, number) for number in numbers)
 
-    def get_roaming_table(self):
+        locations = self._locations
+        events = []
+        for number in added:
+            entry = locations.get(number)
+            if entry is None:
+                locations[number] = base
+                events.append(RoamingEvent(ADD, number, addr))
+            elif entry.base is base:
+                # Logged in before it was listed.
+                base.unlisted.discard(number)
+                entry.expires = None
+                if entry.rssi is None:
+                    locations[number] = base
+            elif self._lists(entry.base, number):
+                # Both cells receive it, it stays where it is.
+                self._also.setdefault(number, []).append(base)
+            else:
+                old = entry.base
+                self._move(number, entry, base, now)
+                # The old BaseStation may be this one before it expired.
+                events.append(RoamingEvent(MOVE if old.addr != addr else ADD, number, addr, old.addr))
+        for number in removed:
+            entry = locations.get(number)
+            if entry is None:
+                continue
+            if entry.base is base:
+                self._take_over(number, entry, now, events)
+            else:
+                others = self._also.get(number)
+                if others is not None and base in others:
+                    others.remove(base)
+                    if not others:
+                        del self._also[number]
+
+        if events:
+            self._log_events(addr, events)
+            for event in events:
+                self._notify(event)
+
+    def _lists(self, base, number):
         """
-        Restituisce la tabella di roaming attuale per debug.
+        Returns True if base is still there and its last list has the extension.
         """
-        return dict(self._locations)
+        return self._bases.get(base.addr) is base and number in base.listed
 
-    def print_roaming_table(self):
+    def _move(self, number, entry, base, now):
         """
-        Stampa la tabella di roaming per debug.
+        Moves an extension to another BaseStation. Its old BaseStation is
+        remembered if it still lists the extension.
         """
-        if self._locations:
-            logger.info("=== ROAMING TABLE ===")
-            for ext, info in self._locations.items():
-                logger.info(f"  Extension {ext}: {info['addr']} (last seen: {time.ctime(info['time'])})")
-            logger.info("====================")
+        old = entry.base
+        old.unlisted.discard(number)
+        others = self._also.get(number)
+        if others is not None and base in others:
+            others.remove(base)
+        if self._lists(old, number):
+            others = self._also.setdefault(number, [])
+            others.append(old)
+        if others is not None and not others:
+            del self._also[number]
+        if entry is old:
+            self._locations[number] = base
         else:
-            logger.info("Roaming table is empty")
-
-    def process(self, xml_message, addr):
-        if xml_message.tag == "request" and xml_message.attrib["type"] == "systeminfo":
-            #                xml_message.tag == "request" and xml_message.attrib["type"] == "alarm": # not sure if this updates only contain connected phones...
-            logger.debug("Systeminfo update received")
-
-            senderdata = xml_message.find("senderdata")
-            for element in senderdata.findall("address"):
-                if element.text in self._locations:
-                    if not self._locations[element.text]["addr"] == addr:
-                        logger.info("Updated {}  to {}".format(element.text, addr))
-                        self._locations[element.text]["addr"] = addr
-                        self._locations[element.text]["time"] = time.time()
-                    else:
-                        logger.info("Already known: {} on {}".format(element.text, addr))
-                        self._locations[element.text]["time"] = time.time()
-                else:
-                    logger.info("Added {} on {}".format(element.text, addr))
-                    self._locations[element.text] = {"addr": addr, "time": time.time()}
-                    self.print_roaming_table()  # Mostra la tabella quando si aggiunge qualcuno
-
-        if xml_message.tag == "request" and xml_message.attrib["type"] == "login":
-            logger.debug("Login event received")
-
-            status = xml_message.find("logindata").find("status")
-            address = xml_message.find("senderdata").find("address")
-
-            if status.text == "0":
-                if address.text in self._locations:
-                    logger.info("{} logged out".format(address.text))
-                    del self._locations[address.text]
-                else:
-                    logger.info("{} logged out but wasn't known".format(address.text))
-            elif status.text == "1":
-                if address.text in self._locations:
-                    logger.info("{} logged in on {} and was already known".format(address.text, addr))
-                    self._locations[address.text]["addr"] = addr
-                    self._locations[address.text]["time"] = time.time()
-                else:
-                    logger.info("{} logged in on {} (and wasn't known until know...)".format(address.text, addr))
-                    self._locations[address.text] = {"addr": addr, "time": time.time()}
-                    self.print_roaming_table()  # Mostra la tabella quando qualcuno fa login
-
-        return False
+            entry.base = base
+            entry.seen = now
+            if number in base.listed:
+                entry.expires = None
+
+    def _take_over(self, number, entry, now, events):
+        """
+        The BaseStation of an extension lost it: Moves it to another BaseStation
+        that lists it or removes it. Appends the RoamingEvent to events.
+        """
+        old = entry.base
+        others = self._also.pop(number, [])
+        while others:
+            base = others.pop(0)
+            if self._lists(base, number):
+                if others:
+                    self._also[number] = others
+                self._move(number, entry, base, now)
+                events.append(RoamingEvent(MOVE, number, base.addr, old.addr))
+                return
+        old.unlisted.discard(number)
+        del self._locations[number]
+        events.append(RoamingEvent(REMOVE, number, None, old.addr))
+
+    def _new_base(self, addr, now):
+        base = self._bases[addr] = _BaseStation(addr, now)
+        self._schedule(base, now + self._ttl(base))
+        return base
+
+    def _schedule(self, item, expires):
+        """
+        Sets the time a _BaseStation or Presence expires.
+
+        Postponing only changes `expires`: The entry in the TimerWheel stays
+        and the item is scheduled again when it comes out. An earlier time
+        needs a new entry, `scheduled` tells which entry is the current one.
+        """
+        item.expires = expires
+        if item.scheduled is None or expires < item.scheduled:
+            item.scheduled = expires
+            self._wheel.schedule(item, expires)
+
+    def _log_events(self, addr, events):
+        counts = {ADD: 0, MOVE: 0, REMOVE: 0}
+        for event in events:
+            counts[event.kind] += 1
+            logger.debug("%s", event)
+        logger.info(
+            "BaseStation %s: %s extensions added, %s moved here, %s removed", addr, counts[ADD], counts[MOVE], counts[REMOVE]
+        )
+
+    def process_login(self, frame, addr):
+        logger.debug("Login event received")
+
+        status = frame.get("logindata/status")
+        number = frame.get("senderdata/address")
+        entry = self._locations.get(number)
+
+        if status == "0":
+            if entry is not None:
+                logger.info("%s logged out", number)
+                del self._locations[number]
+                self._also.pop(number, None)
+                entry.base.unlist(number)
+                self._notify(RoamingEvent(REMOVE, number, None, entry.base.addr))
+            else:
+                logger.info("%s logged out but wasn't known", number)
+        elif status == "1":
+            now = time.time()
+            base = self._bases.get(addr)
+            if base is None:
+                base = self._new_base(addr, now)
+            if entry is None:
+                logger.info("%s logged in on %s (and wasn't known until know...)", number, addr)
+                event = RoamingEvent(ADD, number, addr)
+            elif entry.base is base:
+                logger.info("%s logged in on %s and was already known", number, addr)
+                event = RoamingEvent(ADD, number, addr, addr)
+            else:
+                old = entry.base
+                logger.info("%s logged in on %s and was known on %s", number, addr, old.addr)
+                self._move(number, entry, base, now)
+                event = RoamingEvent(MOVE, number, addr, old.addr)
+                entry = self._locations[number]
+
+            if number in base.listed and (entry is None or entry.base is entry):
+                self._locations[number] = base
+            else:
+                presence = entry if entry is not None and entry.base is not entry else Presence(number, base, now)
+                presence.base = base
+                presence.seen = now
+                self._locations[number] = presence
+                if number not in base.listed:
+                    # Expires unless the next systeminfo lists it.
+                    base.unlisted.add(number)
+                    self._schedule(presence, now + self._ttl(base))
+            self._notify(event)
+
+    def _run_expiry(self):
+        self._timer = asyncio.get_running_loop().call_later(self._tick, self._run_expiry)
+        self.expire(time.time())
+
+    def expire(self, now):
+        """
+        Removes the BaseStations and extensions that expired at `now`.
+        This runs every second after start().
+        """
+        events = []
+        for deadline, item in self._wheel.advance(now):
+            if item.scheduled != deadline:
+                # Replaced by an entry for an earlier time.
+                continue
+            item.scheduled = None
+            if isinstance(item, _BaseStation):
+                if self._bases.get(item.addr) is not item:
+                    continue
+                if item.expires > now:
+                    self._schedule(item, item.expires)
+                    continue
+                logger.warning(
+                    "BaseStation %s not heard of for %.0f s, removing %s extensions", item.addr, now - item.seen, len(item.listed)
+                )
+                del self._bases[item.addr]
+                for number in item.listed:
+                    entry = self._locations.get(number)
+                    if entry is not None and entry.base is item:
+                        self._take_over(number, entry, now, events)
+            else:
+                if item.expires is None or self._locations.get(item.number) is not item:
+                    continue
+                if item.expires > now:
+                    self._schedule(item, item.expires)
+                    continue
+                logger.info("%s was not seen on %s since %s, removing it", item.number, item.addr, time.ctime(item.seen))
+                self._take_over(item.number, item, now, events)
+
+        for event in events:
+            self._notify(event)
@@ -0,0 +1,140 @@
+import array
+import logging
+import time
+
+from roaming import REMOVE
+
+logger = logging.getLogger(__name__)
+
+
+class _Samples:
+    """
+    Ring buffer of the last RSSI samples of a single handset.
+    """
+
+    __slots__ = ("times", "values", "addrs", "next")
+
+    def __init__(self, size):
+        self.times = array.array("d", bytes(8 * size))
+        self.values = array.array("H", bytes(2 * size))
+        # addr of the reporting BaseStation, None for unused entries
+        self.addrs = [None] * size
+        self.next = 0
+
+    def add(self, now, addr, rssi):
+        i = self.next
+        self.times[i] = now
+        self.values[i] = rssi
+        self.addrs[i] = addr
+        self.next = (i + 1) % len(self.addrs)
+
+
+class RssiMonitor:
+    """
+    This driver collects the RSSI of the handsets that the BaseStations
+    report in alarm frames:
+    | <rssidata>
+    | <rfpi>1333a39f00</rfpi>
+    | <rssi>204</rssi>
+    | </rssidata>
+    | <senderdata>
+    | <address>99</address>
+    | ...
+
+    The last `window` samples of every handset are kept, samples older than
+    `max_age` seconds are ignored. The RoamingMonitor asks best_addr() which
+    BaseStation receives a handset best and sends messages there.
+    """
+
+    # Messages handled by this driver, see UdpServer.register_driver()
+    handles = {
+        ("request", "alarm"): "process_alarm",
+    }
+
+    # Paths read from these messages, see UdpServer.register_driver()
+    reads = {
+        ("request", "alarm"): ("rssidata/rfpi", "rssidata/rssi", "senderdata/address"),
+    }
+
+    def __init__(self, udp_server, roaming_monitor, window=8, max_age=60.0, margin=10):
+        """
+        Creates a new RssiMonitor and makes roaming_monitor route by signal.
+
+        Another BaseStation than the one the handset is registered on is only
+        used if its mean RSSI is better by `margin`, so messages do not go
+        back and forth between two BaseStations receiving a handset equally well.
+        """
+        self._udp_server = udp_server
+        self._roaming_monitor = roaming_monitor
+        self._window = window
+        self._max_age = max_age
+        self._margin = margin
+
+        # extension => _Samples
+        self._samples = {}
+        # One addr tuple per BaseStation, shared by all samples.
+        self._addrs = {}
+        # addr => RFPI of the BaseStation
+        self._rfpis = {}
+
+        self._udp_server.register_driver(self)
+        self._roaming_monitor.add_listener(self._presence_changed)
+        self._roaming_monitor.set_signal(self)
+
+    def close(self):
+        self._udp_server.unregister_driver(self)
+        self._roaming_monitor.set_signal(None)
+        self._samples.clear()
+
+    def _presence_changed(self, event):
+        if event.kind == REMOVE:
+            self._samples.pop(event.number, None)
+
+    def process_alarm(self, frame, addr):
+        rssi = frame.get_int("rssidata/rssi")
+        number = frame.get("senderdata/address")
+        if rssi is None or not number:
+            return
+
+        now = time.time()
+        addr = self._addrs.setdefault(addr, addr)
+        samples = self._samples.get(number)
+        if samples is None:
+            samples = self._samples[number] = _Samples(self._window)
+        samples.add(now, addr, max(0, min(rssi, 0xFFFF)))
+
+        rfpi = frame.get("rssidata/rfpi")
+        if rfpi and self._rfpis.get(addr) != rfpi:
+            logger.debug("BaseStation %s has RFPI %s", addr, rfpi)
+            self._rfpis[addr] = rfpi
+
+        self._roaming_monitor.set_rssi(number, addr, rssi)
+
+    def best_addr(self, number, current=None, now=None):
+        """
+        Returns the addr of the BaseStation with the best mean RSSI of the
+        recent samples of an extension, or None if there are no recent samples.
+        current is the BaseStation the extension is registered on.
+        """
+        samples = self._samples.get(number)
+        if samples is None:
+            return None
+
+        cutoff = (time.time() if now is None else now) - self._max_age
+        sums = {}
+        counts = {}
+        for when, rssi, addr in zip(samples.times, samples.values, samples.addrs):
+            if addr is None or when < cutoff:
+                continue
+            sums[addr] = sums.get(addr, 0) + rssi
+            counts[addr] = counts.get(addr, 0) + 1
+        if not sums:
+            return None
+
+        best = max(sums, key=lambda addr: sums[addr] / counts[addr])
+        if current in sums and sums[best] / counts[best] < sums[current] / counts[current] + self._margin:
+            return current
+        return best
+
+    def stats(self):
+        return {"handsets": len(self._samples), "basestations": len(self._rfpis)}
@@ -1,57 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import logging
 import random
-import socket
 import sys
 import time
 from datetime import datetime
+from xml.sax.saxutils import escape
 
-logger = logging.getLogger(__name__)
-
-
-class MessageSender:
-    """
-    Class for sending messages to specific extensions via the Snom DECT system.
-    """
-
-    def __init__(self, server_host="localhost", server_port=1300):
-        """
-        Initialize the sender with the UDP server address.
+from frame import Frame
+from submission import FINAL, SubmissionClient
 
-        Args:
-            server_host: IP address of the message server (default: localhost)
-            server_port: Port of the message server (default: 1300)
-        """
-        self.server_host = server_host
-        self.server_port = server_port
-        self.sock = None
-
-    def create_message_xml(self, to_ext, message_text, from_ext="server", from_name="System", from_location="server"):
-        """
-        Creates the message XML in the format required by the Snom system.
-
-        Args:
-            to_ext: Recipient extension
-            message_text: Message text
-            from_ext: Sender extension (default: "server")
-            from_name: Sender name (default: "System")
-            from_location: Sender location (default: "server")
-
-        Returns:
-            Formatted XML string for sending
-        """
-        # Generate a unique 10-digit external ID
-        external_id = f"{random.randrange(9999999999):010d}"
+logger = logging.getLogger(__name__)
 
-        # Get current timestamp
-        now = datetime.now()
-        datetime_str = now.strftime("%d.%m.%Y %H:%M:%S")
-        timestamp_str = str(int(time.time()))
 
-        # XML template for the message
-        xml_template = """<?xml version="1.0" encoding="UTF-8"?>
+_MESSAGE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
 <request version="19.11.12.1403" type="job">
 <externalid>{external_id}</externalid>
 <systemdata>
@@ -62,7 +26,7 @@ class MessageSender:
 <statusinfo>System running</statusinfo>
 </systemdata>
 <jobdata>
-<priority>0</priority>
+<priority>{priority}</priority>
 <messages>
 <message1></message1>
 <message2></message2>
@@ -77,59 +41,177 @@ class MessageSender:
 <location>{from_location}</location>
 </senderdata>
 <persondata>
-<address>{to_ext}</address>
+{recipients}
 </persondata>
 </request>
 \0"""
 
-        # Replace placeholders with actual values
-        xml_message = xml_template.format(
-            external_id=external_id,
-            datetime=datetime_str,
-            timestamp=timestamp_str,
-            message=message_text,
-            from_ext=from_ext,
-            from_name=from_name,
-            from_location=from_location,
-            to_ext=to_ext,
-        )
 
-        return xml_message, external_id
+def create_message_xml(to_ext, message_text, from_ext="server", from_name="System", from_location="server", external_id=None, priority=0):
+    """
+    Creates the message XML in the format required by the Snom system.
+
+    Args:
+        to_ext: Recipient extension or group name, or a list of them for a broadcast
+        message_text: Message text
+        from_ext: Sender extension (default: "server")
+        from_name: Sender name (default: "System")
+        from_location: Sender location (default: "server")
+        external_id: 10-digit ID of the message (default: random)
+        priority: Priority of the message, higher is more urgent (default: 0)
+
+    Returns:
+        Tuple (xml: str, external_id: str)
+    """
+    if external_id is None:
+        external_id = f"{random.randrange(9999999999):010d}"
+
+    if isinstance(to_ext, str):
+        to_ext = [to_ext]
 
-    def send_message(self, to_ext, message_text, from_ext="server", from_name="System", from_location="server"):
+    now = datetime.now()
+    xml_message = _MESSAGE_TEMPLATE.format(
+        external_id=external_id,
+        priority=int(priority),
+        datetime=now.strftime("%d.%m.%Y %H:%M:%S"),
+        timestamp=str(int(time.time())),
+        message=escape(message_text),
+        from_ext=escape(from_ext),
+        from_name=escape(from_name),
+        from_location=escape(from_location),
+        recipients="\n".join(f"<address>{escape(recipient)}</address>" for recipient in to_ext),
+    )
+
+    return xml_message, external_id
+
+
+class _SenderProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram endpoint of an AsyncMessageSender.
+
+    Replies of the server are matched to the messages waiting for them by
+    their externalid.
+    """
+
+    def __init__(self):
+        self.transport = None
+        # externalid => future resolved with the reply
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        for message in data.split(b"\0"):
+            if not message.strip():
+                continue
+            logger.debug("Received response from %s: %s", addr, message.decode("UTF-8", errors="replace"))
+            try:
+                external_id = Frame(message).get("externalid")
+            except ValueError:
+                logger.warning("Ignoring reply from %s that is not XML", addr)
+                continue
+            future = self.pending.get(external_id)
+            if future is not None and not future.done():
+                future.set_result(message)
+
+    def error_received(self, exc):
+        # ICMP errors can not be related to a single message, so they fail all waiting messages.
+        logger.debug("Sender socket: Got exception: %s", exc)
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.cancel()
+
+
+class AsyncMessageSender:
+    """
+    Sends messages to the messaging server from asyncio code.
+
+    All messages are sent over a single long-lived UDP socket. Many messages
+    can be sent concurrently: Every message is in flight from the moment it
+    is sent until the server confirmed it or reply_timeout passed.
+    max_in_flight limits the number of messages in flight at the same time.
+    """
+
+    def __init__(self, server_host="localhost", server_port=1300, max_in_flight=32, reply_timeout=10):
         """
-        Sends a message to a specific extension.
+        Initialize the sender with the UDP server address.
+
+        Args:
+            server_host: IP address of the message server (default: localhost)
+            server_port: Port of the message server (default: 1300)
+            max_in_flight: Maximum number of messages waiting for a reply (default: 32)
+            reply_timeout: Seconds to wait for the confirmation of the server (default: 10)
+        """
+        self.server_host = server_host
+        self.server_port = server_port
+        self.reply_timeout = reply_timeout
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._transport = None
+        self._protocol = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def open(self):
+        """
+        Opens the socket. Called by send_message() if needed.
+        """
+        if self._transport is None:
+            loop = asyncio.get_running_loop()
+            self._transport, self._protocol = await loop.create_datagram_endpoint(
+                _SenderProtocol, remote_addr=(self.server_host, self.server_port)
+            )
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    async def send_message(self, to_ext, message_text, from_ext="server", from_name="System", from_location="server", priority=0):
+        """
+        Sends a message to a specific extension and waits for the confirmation of the server.
 
         Args:
-            to_ext: Recipient extension
+            to_ext: Recipient extension or group name, or a list of them for a broadcast
             message_text: Message text
             from_ext: Sender extension (default: "server")
             from_name: Sender name (default: "System")
             from_location: Sender location (default: "server")
+            priority: Priority of the message, higher is more urgent (default: 0)
 
         Returns:
             Tuple (success: bool, external_id: str, error_msg: str)
         """
         try:
-            # Create UDP socket
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.sock.settimeout(10)  # 10 second timeout
-
-            # Create XML message
-            xml_message, external_id = self.create_message_xml(to_ext, message_text, from_ext, from_name, from_location)
-
-            logger.info(f"Sending message to extension {to_ext} with ID {external_id}")
-            logger.debug(f"Message content:\n{xml_message}")
+            await self.open()
+            async with self._in_flight:
+                pending = self._protocol.pending
+                external_id = None
+                while external_id is None or external_id in pending:
+                    external_id = f"{random.randrange(9999999999):010d}"
+                xml_message, _ = create_message_xml(to_ext, message_text, from_ext, from_name, from_location, external_id, priority)
 
-            # Send the message
-            self.sock.sendto(xml_message.encode("utf-8"), (self.server_host, self.server_port))
+                logger.info("Sending message to extension %s with ID %s", to_ext, external_id)
+                logger.debug("Message content:\n%s", xml_message)
 
-            # Wait for response (optional, system might not respond immediately)
-            try:
-                response, addr = self.sock.recvfrom(4096)
-                logger.debug(f"Received response from {addr}: {response.decode('utf-8', errors='ignore')}")
-            except socket.timeout:
-                logger.debug("No immediate response from server (normal)")
+                reply = pending[external_id] = asyncio.get_running_loop().create_future()
+                try:
+                    self._transport.sendto(xml_message.encode("utf-8"))
+                    await asyncio.wait_for(reply, self.reply_timeout)
+                except asyncio.TimeoutError:
+                    logger.debug("No response from server for %s (normal)", external_id)
+                finally:
+                    del pending[external_id]
 
             return True, external_id, None
 
@@ -138,9 +220,223 @@ class MessageSender:
             logger.error(error_msg)
             return False, None, error_msg
 
-        finally:
-            if self.sock:
-                self.sock.close()
+    async def send_messages(self, messages):
+        """
+        Sends many messages concurrently.
+
+        messages is an iterable of dicts with the arguments of send_message().
+        Returns a list of (success, external_id, error_msg) tuples in the order of messages.
+        """
+        return await asyncio.gather(*[self.send_message(**message) for message in messages])
+
+
+class MessageSender:
+    """
+    Class for sending messages to specific extensions via the Snom DECT system.
+
+    This is the blocking interface to AsyncMessageSender for code that does not use asyncio.
+    With socket_path the messages are queued through the submission socket
+    of the server instead, see submit_messages().
+    """
+
+    def __init__(self, server_host="localhost", server_port=1300, max_in_flight=32, reply_timeout=10, socket_path=None, wait=None):
+        """
+        Initialize the sender with the UDP server address.
+
+        Args:
+            server_host: IP address of the message server (default: localhost)
+            server_port: Port of the message server (default: 1300)
+            max_in_flight: Maximum number of messages waiting for a reply (default: 32)
+            reply_timeout: Seconds to wait for the confirmation of the server (default: 10)
+            socket_path: Submission socket of the server (--submit) to use instead of UDP (default: None)
+            wait: With socket_path: Seconds to wait for the delivery, success then means delivered (default: None)
+        """
+        self.server_host = server_host
+        self.server_port = server_port
+        self.max_in_flight = max_in_flight
+        self.reply_timeout = reply_timeout
+        self.socket_path = socket_path
+        self.wait = wait
+
+    def create_message_xml(self, to_ext, message_text, from_ext="server", from_name="System", from_location="server", priority=0):
+        """
+        Creates the message XML in the format required by the Snom system.
+        See create_message_xml().
+        """
+        return create_message_xml(to_ext, message_text, from_ext, from_name, from_location, priority=priority)
+
+    def send_message(self, to_ext, message_text, from_ext="server", from_name="System", from_location="server", priority=0):
+        """
+        Sends a message to a specific extension.
+
+        Args:
+            to_ext: Recipient extension or group name, or a list of them for a broadcast
+            message_text: Message text
+            from_ext: Sender extension (default: "server")
+            from_name: Sender name (default: "System")
+            from_location: Sender location (default: "server")
+            priority: Priority of the message, higher is more urgent (default: 0)
+
+        Returns:
+            Tuple (success: bool, external_id: str, error_msg: str)
+        """
+        message = dict(
+            to_ext=to_ext, message_text=message_text, from_ext=from_ext, from_name=from_name, from_location=from_location, priority=priority
+        )
+        return self.send_messages([message])[0]
+
+    def send_messages(self, messages):
+        """
+        Sends many messages concurrently over a single socket.
+
+        messages is an iterable of dicts with the arguments of send_message().
+        Returns a list of (success, external_id, error_msg) tuples in the order of messages.
+        """
+        messages = list(messages)
+        if self.socket_path is not None:
+            try:
+                return asyncio.run(submit_messages(self.socket_path, messages, self.wait))
+            except (OSError, ValueError) as e:
+                error_msg = f"Error submitting messages: {e}"
+                logger.error(error_msg)
+                return [(False, None, error_msg) for _ in messages]
+
+        async def run():
+            async with AsyncMessageSender(self.server_host, self.server_port, self.max_in_flight, self.reply_timeout) as sender:
+                return await sender.send_messages(messages)
+
+        return asyncio.run(run())
+
+
+async def submit_message(
+    client, to_ext, message_text, from_ext="server", from_name="System", from_location="server", priority=0, watch=False
+):
+    """
+    Queues a message through the submission socket of the server (--submit)
+    instead of sending it over UDP. client is a submission.SubmissionClient.
+
+    Returns the result of the server: {"id": ...}, {"broadcast": ..., "recipients": ...} or {"error": ...}
+    """
+    message = {
+        "to": to_ext,
+        "text": message_text,
+        "from": from_ext,
+        "from_name": from_name,
+        "from_location": from_location,
+        "priority": priority,
+    }
+    return (await client.submit([message], watch))[0]
+
+
+async def print_status(client, recipients, timeout):
+    """
+    Prints the status events of watched messages until recipients messages
+    left the queue or timeout seconds passed.
+    """
+
+    async def follow():
+        remaining = recipients
+        async for event in client.events():
+            print(f"   {event['to']}: {event['status']}")
+            if event["status"] in FINAL:
+                remaining -= 1
+                if remaining <= 0:
+                    return
+
+    try:
+        await asyncio.wait_for(follow(), timeout)
+    except asyncio.TimeoutError:
+        print(f"   Not all recipients reached after {timeout:g} s")
+
+
+async def submit_messages(path, messages, wait=None):
+    """
+    Queues messages through the submission socket of the server and, if
+    wait is given, waits up to wait seconds for their delivery.
+
+    messages is an iterable of dicts with the arguments of MessageSender.send_message().
+    Returns a list of (success, message_id, error_msg) tuples in the order of
+    messages. message_id is the internal id, or the id of the broadcast.
+    Without wait success means the message is queued, with wait that it was
+    delivered to all recipients; error_msg then tells the status of the others.
+    """
+    requests = [
+        {
+            "to": message["to_ext"],
+            "text": message["message_text"],
+            "from": message.get("from_ext", "server"),
+            "from_name": message.get("from_name", "System"),
+            "from_location": message.get("from_location", "server"),
+            "priority": message.get("priority", 0),
+        }
+        for message in messages
+    ]
+    async with SubmissionClient(path) as client:
+        results = await client.submit(requests, watch=wait is not None)
+        # per message: recipient => last status
+        states = [{} for _ in results]
+        # internal id or broadcast id => index of the message
+        index = {}
+        for i, result in enumerate(results):
+            if "error" not in result:
+                index[result.get("id", result.get("broadcast"))] = i
+
+        async def follow():
+            remaining = sum(result.get("recipients", 1) for result in results if "error" not in result)
+            async for event in client.events():
+                i = index.get(event.get("broadcast", event["id"]))
+                if i is None:
+                    continue
+                previous = states[i].get(event["to"])
+                states[i][event["to"]] = event["status"]
+                if event["status"] in FINAL and previous not in FINAL:
+                    remaining -= 1
+                    if remaining <= 0:
+                        return
+
+        if wait is not None and index:
+            try:
+                await asyncio.wait_for(follow(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    replies = []
+    for result, state in zip(results, states):
+        if "error" in result:
+            replies.append((False, None, result["error"]))
+            continue
+        message_id = result.get("id", result.get("broadcast"))
+        recipients = result.get("recipients", 1)
+        delivered = sum(1 for status in state.values() if status == "delivered")
+        if wait is None or delivered == recipients:
+            replies.append((True, message_id, None))
+            continue
+        details = [f"{to}: {status}" for to, status in state.items() if status != "delivered"]
+        if len(state) < recipients:
+            details.append(f"{recipients - len(state)} still queued")
+        replies.append((False, message_id, f"not delivered within {wait:g} s ({', '.join(details)})"))
+    return replies
+
+
+def _print_sent(recipients, message_id, text):
+    print("✅ Message sent successfully!")
+    print(f"   Recipient: {', '.join(recipients)}")
+    print(f"   Message ID: {message_id}")
+    print(f"   Text: {text}")
+
+
+async def _submit(args, to_ext, recipients):
+    async with SubmissionClient(args.socket) as client:
+        result = await submit_message(
+            client, to_ext, args.message, args.from_ext, args.from_name, args.from_location, args.priority, watch=args.wait is not None
+        )
+        if "error" in result:
+            print(f"❌ Error sending message: {result['error']}")
+            return False
+        _print_sent(recipients, result.get("id", result.get("broadcast")), args.message)
+        if args.wait is not None:
+            await print_status(client, result.get("recipients", 1), args.wait)
+        return True
 
 
 def main():
@@ -148,30 +444,49 @@ def main():
     Main function for command line usage.
     """
     parser = argparse.ArgumentParser(description="Send a message to a Snom DECT extension")
-    parser.add_argument("to_ext", help="Recipient extension")
+    parser.add_argument("to_ext", nargs="?", help="Recipient extension, several extensions separated by commas are sent as broadcast")
     parser.add_argument("message", help="Message text to send")
+    parser.add_argument(
+        "--group", action="append", default=[], help="Broadcast to a group configured on the server (--groups), may be repeated"
+    )
     parser.add_argument("--from-ext", default="server", help="Sender extension (default: server)")
     parser.add_argument("--from-name", default="System", help="Sender name (default: System)")
     parser.add_argument("--from-location", default="server", help="Sender location (default: server)")
+    parser.add_argument(
+        "--priority", type=int, default=0, help="Priority of the message, higher is sent first, e.g. 2 for alarms (default: 0)"
+    )
     parser.add_argument("--server", default="localhost", help="Server address (default: localhost)")
     parser.add_argument("--port", type=int, default=1300, help="Server port (default: 1300)")
+    parser.add_argument("--socket", help="Queue the message through the submission socket of the server (see --submit) instead of UDP")
+    parser.add_argument("--wait", type=float, help="With --socket: print the delivery status for up to WAIT seconds")
     parser.add_argument("--debug", action="store_true", help="Enable debug output")
 
     args = parser.parse_args()
 
+    recipients = [ext.strip() for ext in (args.to_ext or "").split(",") if ext.strip()] + args.group
+    if not recipients:
+        parser.error("either an extension or --group is required")
+
     # Configure logging
     level = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(level=level, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
+    to_ext = recipients[0] if len(recipients) == 1 else recipients
+    if args.socket:
+        try:
+            sys.exit(0 if asyncio.run(_submit(args, to_ext, recipients)) else 1)
+        except (OSError, ValueError) as e:
+            print(f"❌ Error sending message: {e}")
+            sys.exit(1)
+
     # Create sender and send message
     sender = MessageSender(args.server, args.port)
-    success, external_id, error = sender.send_message(args.to_ext, args.message, args.from_ext, args.from_name, args.from_location)
+    success, external_id, error = sender.send_message(
+        to_ext, args.message, args.from_ext, args.from_name, args.from_location, args.priority
+    )
 
     if success:
-        print("✅ Message sent successfully!")
-        print(f"   Recipient: {args.to_ext}")
-        print(f"   Message ID: {external_id}")
-        print(f"   Text: {args.message}")
+        _print_sent(recipients, external_id, args.message)
         sys.exit(0)
     else:
         print(f"❌ Error sending message: {error}")
@@ -15,6 +15,21 @@ from send_message import MessageSender
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 
+# Seconds to wait for the delivery when sending through the submission socket
+DELIVERY_TIMEOUT = 30
+
+
+def ask_sender(server):
+    """
+    Asks for the submission socket of the server. Through it the delivery
+    can be followed, over UDP only the server's confirmation is known.
+    """
+    socket_path = input("Submission socket of the server (press Enter to send over UDP): ").strip()
+    if socket_path:
+        return MessageSender(socket_path=socket_path, wait=DELIVERY_TIMEOUT)
+    return MessageSender(server)
+
+
 def send_simple_message():
     """
     Simple interface for sending a message.
@@ -35,22 +50,22 @@ def send_simple_message():
     # Optional parameters
     from_name = input("Sender name (press Enter for 'System'): ").strip() or "System"
     server = input("Server address (press Enter for 'localhost'): ").strip() or "localhost"
+    sender = ask_sender(server)
 
     print("\n📤 Sending message...")
     print(f"   From: {from_name}")
     print(f"   To: {to_ext}")
-    print(f"   Server: {server}")
+    print(f"   Server: {sender.socket_path or server}")
     print(f"   Message: {message}\n")
 
     # Configure minimal logging
     logging.basicConfig(level=logging.WARNING)
 
     # Send the message
-    sender = MessageSender(server)
     success, external_id, error = sender.send_message(to_ext, message, from_name=from_name)
 
     if success:
-        print("✅ Message sent successfully!")
+        print("✅ Message delivered!" if sender.socket_path else "✅ Message handed to the server!")
         print(f"   Message ID: {external_id}")
         return True
     else:
@@ -65,6 +80,7 @@ def send_batch_messages():
     print("=== Batch Message Sending ===\n")
 
     server = input("Server address (press Enter for 'localhost'): ").strip() or "localhost"
+    sender = ask_sender(server)
     from_name = input("Sender name (press Enter for 'System'): ").strip() or "System"
 
     print("\nEnter messages in format: extension,message")
@@ -92,20 +108,20 @@ def send_batch_messages():
     # Configure minimal logging
     logging.basicConfig(level=logging.WARNING)
 
-    sender = MessageSender(server)
     success_count = 0
 
-    for ext, msg in messages:
-        print(f"   Sending to {ext}: {msg[:50]}{'...' if len(msg) > 50 else ''}")
-        success, external_id, error = sender.send_message(ext, msg, from_name=from_name)
+    results = sender.send_messages([dict(to_ext=ext, message_text=msg, from_name=from_name) for ext, msg in messages])
 
+    for (ext, msg), (success, external_id, error) in zip(messages, results):
+        print(f"   Sending to {ext}: {msg[:50]}{'...' if len(msg) > 50 else ''}")
         if success:
-            print(f"   ✅ Sent (ID: {external_id})")
+            print(f"   ✅ {'Delivered' if sender.socket_path else 'Handed to the server'} (ID: {external_id})")
             success_count += 1
         else:
             print(f"   ❌ Error: {error}")
 
-    print(f"\n📊 Result: {success_count}/{len(messages)} messages sent successfully")
+    outcome = "delivered" if sender.socket_path else "handed to the server"
+    print(f"\n📊 Result: {success_count}/{len(messages)} messages {outcome}")
     return success_count == len(messages)
 
 
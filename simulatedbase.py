@@ -0,0 +1,69 @@
+"""
+An in-process stand-in for a BaseStation, for benchmarks and tests.
+"""
+
+import asyncio
+import time
+
+from frame import Frame
+
+_STATUS_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<response version="19.11.12.1403" type="job">
+<externalid>{}</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>27.06.2025 17:08:42</datetime>
+<timestamp>1751036922</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<jobdata>
+<status>{}</status>
+<statusinfo></statusinfo>
+</jobdata>
+</response>
+\0"""
+
+
+class SimulatedBaseStation:
+    """
+    Stands in for the UDP socket of the server and behaves like a BaseStation
+    with limited capacity: It processes `capacity` messages per second and
+    buffers up to `buffer` messages. Messages arriving while the buffer is
+    full are dropped silently. Processed messages are acknowledged with status 1.
+    """
+
+    def __init__(self, server, addr, capacity=100, buffer=20):
+        self.addr = addr
+        self.received = 0
+        self.dropped = 0
+        self.delivered = {}
+        self._server = server
+        self._capacity = capacity
+        self._buffer = buffer
+        self._queue = []
+        self._task = asyncio.get_running_loop().create_task(self._process())
+
+    def sendto(self, data, addr=None):
+        self.received += 1
+        if len(self._queue) >= self._buffer:
+            self.dropped += 1
+        else:
+            self._queue.append(Frame(data.split(b"\0")[0]).get("externalid"))
+
+    def close(self):
+        self._task.cancel()
+
+    async def _process(self):
+        last = time.perf_counter()
+        budget = 0.0
+        while True:
+            await asyncio.sleep(0.005)
+            now = time.perf_counter()
+            budget = min(budget + (now - last) * self._capacity, self._buffer)
+            last = now
+            while self._queue and budget >= 1:
+                budget -= 1
+                external_id = self._queue.pop(0)
+                self.delivered[external_id] = now
+                self._server.datagram_received(_STATUS_TEMPLATE.format(external_id, 1).encode("UTF-8"), self.addr)
@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+
+"""
+Simulates a fleet of M700/M900 BaseStations with their handsets, to load test
+the messaging server without a DECT system.
+
+Every virtual BaseStation has its own UDP socket on the loopback interface.
+It sends systeminfo keep-alives, login and alarm frames for the handsets
+moving on and off it, sends jobs written on its handsets and answers the
+jobs of the server with status 1 (delivered) or 11 (user absent).
+"""
+
+import argparse
+import asyncio
+import heapq
+import logging
+import random
+import time
+
+from frame import Frame, classify
+from templates import Template
+
+logger = logging.getLogger(__name__)
+
+_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="{{type}}">
+<externalid>{{eid}}</externalid>
+<systemdata>
+<name>{{name}}</name>
+<datetime>{{dt}}</datetime>
+<timestamp>{{ts}}</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+"""
+
+_SYSTEMINFO_HEADER = Template(_HEADER + "<senderdata>\n")
+_SYSTEMINFO_HANDSET = Template("<address>{{number}}</address>\n<name>no{{number}}</name>\n")
+_SYSTEMINFO_FOOTER = b"</senderdata>\n</request>\n\0"
+
+_LOGIN_TEMPLATE = Template(
+    _HEADER
+    + """<logindata>
+<status>{{status}}</status>
+</logindata>
+<senderdata>
+<address>{{number}}</address>
+<name>no{{number}}</name>
+<location>{{name}}</location>
+</senderdata>
+</request>
+\0"""
+)
+
+_ALARM_TEMPLATE = Template(
+    _HEADER
+    + """<alarmdata>
+<type>16</type>
+</alarmdata>
+<rssidata>
+<rfpi>{{rfpi}}</rfpi>
+<rssi>{{rssi}}</rssi>
+</rssidata>
+<senderdata>
+<address>{{number}}</address>
+<name>no{{number}}</name>
+<location>{{name}}</location>
+</senderdata>
+</request>
+\0"""
+)
+
+_JOB_TEMPLATE = Template(
+    _HEADER
+    + """<jobdata>
+<priority>0</priority>
+<messages>
+<message1></message1>
+<message2></message2>
+<messageuui>{{msg}}</messageuui>
+</messages>
+<status>0</status>
+<statusinfo></statusinfo>
+</jobdata>
+<senderdata>
+<address>{{from_ext}}</address>
+<name>no{{from_ext}}</name>
+<location>{{name}}</location>
+</senderdata>
+<persondata>
+<address>{{to_ext}}</address>
+</persondata>
+</request>
+\0"""
+)
+
+_STATUS_TEMPLATE = Template(
+    """<?xml version="1.0" encoding="UTF-8"?>
+<response version="19.11.12.1403" type="job">
+<externalid>{{eid}}</externalid>
+<systemdata>
+<name>{{name}}</name>
+<datetime>{{dt}}</datetime>
+<timestamp>{{ts}}</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<jobdata>
+<status>{{status}}</status>
+<statusinfo></statusinfo>
+</jobdata>
+</response>
+\0"""
+)
+
+# Text of the jobs sent by the simulator: the job number and when it was written.
+_TEXT_PREFIX = "sim "
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _events(expected):
+    """
+    Returns a random number of events with the mean `expected`.
+    """
+    count = int(expected)
+    return count + (random.random() < expected - count)
+
+
+class Handset:
+    """
+    A virtual handset. base is the VirtualBase it is registered on, None while absent.
+    """
+
+    __slots__ = ("number", "base", "rssi")
+
+    def __init__(self, number):
+        self.number = number
+        self.base = None
+        self.rssi = 0
+
+
+class VirtualBase(asyncio.DatagramProtocol):
+    """
+    A virtual BaseStation. Its handsets are in `handsets` (number => Handset).
+    """
+
+    def __init__(self, fleet, index):
+        self._fleet = fleet
+        self.index = index
+        self.name = "M900" if index % 2 else "M700"
+        self.rfpi = "{:010x}".format(0x1333A39F00 + index * 0x100)
+        self.handsets = {}
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def error_received(self, exc):
+        # Usually the server is not (yet) running.
+        logger.debug("BaseStation %s: %s", self.index, exc)
+
+    def send(self, data):
+        """
+        Sends a datagram to the server, unless the loss model drops it.
+        """
+        fleet = self._fleet
+        if random.random() < fleet.loss:
+            fleet.stats["lost"] += 1
+            return
+        self.transport.sendto(data)
+        fleet.stats["sent"] += 1
+
+    def _header(self, msg_type):
+        now = time.time()
+        return {
+            "type": msg_type,
+            "eid": "{:010d}".format(random.randrange(10**10)),
+            "name": self.name,
+            "dt": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
+            "ts": "{:08x}".format(int(now)),
+        }
+
+    def send_systeminfo(self):
+        data = _SYSTEMINFO_HEADER.render(**self._header("systeminfo"))
+        data += b"".join(_SYSTEMINFO_HANDSET.render(number=number) for number in self.handsets)
+        self.send(data + _SYSTEMINFO_FOOTER)
+
+    def send_login(self, handset, status):
+        self.send(_LOGIN_TEMPLATE.render(status=status, number=handset.number, **self._header("login")))
+
+    def send_alarm(self, handset):
+        self.send(_ALARM_TEMPLATE.render(rfpi=self.rfpi, rssi=handset.rssi, number=handset.number, **self._header("alarm")))
+
+    def send_job(self, eid, from_ext, to_ext, text):
+        header = self._header("job")
+        header["eid"] = eid
+        header["dt"] = time.strftime("%d.%m.%Y %H:%M:%S")
+        header["ts"] = str(int(time.time()))
+        self.send(_JOB_TEMPLATE.render(msg=text, from_ext=from_ext, to_ext=to_ext, **header))
+
+    def attach(self, handset):
+        handset.base = self
+        handset.rssi = random.randint(120, 240)
+        self.handsets[handset.number] = handset
+        self.send_login(handset, 1)
+        self.send_alarm(handset)
+
+    def detach(self, handset):
+        del self.handsets[handset.number]
+        handset.base = None
+        self.send_login(handset, 0)
+
+    def datagram_received(self, data, addr):
+        fleet = self._fleet
+        if random.random() < fleet.loss:
+            fleet.stats["lost"] += 1
+            return
+        fleet.stats["received"] += 1
+
+        kind = classify(data)
+        frame = Frame(data.rstrip(b"\0"))
+        if kind == ("response", "job"):
+            # The server confirms a job of one of our handsets.
+            fleet.confirmed(frame.get("externalid"))
+        elif kind == ("request", "job"):
+            self._deliver(frame)
+        else:
+            logger.debug("BaseStation %s: unexpected %s", self.index, kind)
+
+    def _deliver(self, frame):
+        """
+        Answers a job of the server: status 1 if the recipient is registered
+        on this BaseStation, 11 (user absent) otherwise.
+        """
+        number = frame.get("persondata/address")
+        delivered = number in self.handsets
+        if delivered:
+            self._fleet.delivered(frame.get("jobdata/messages/messageuui"))
+        else:
+            self._fleet.stats["absent"] += 1
+        header = self._header("job")
+        header["eid"] = frame.get("externalid")
+        self.send(_STATUS_TEMPLATE.render(status=1 if delivered else 11, **header))
+
+
+class Fleet:
+    """
+    This class runs `bases` VirtualBases with `handsets` handsets in total,
+    sending to the server at server_addr.
+
+    The models run in ticks of `tick` seconds:
+    - roaming: every present handset moves to a neighbouring BaseStation
+      `roam` times per second on average.
+    - absence: every present handset goes absent `absence` times per second
+      on average, for `absence_time` seconds on average.
+    - loss: every datagram is dropped with the probability `loss`, both ways.
+    - jobs: the handsets write `job_rate` jobs per second in total, to random handsets.
+
+    BaseStations send a systeminfo keep-alive every `keepalive` seconds.
+    """
+
+    def __init__(
+        self,
+        server_addr,
+        bases=24,
+        handsets=2000,
+        keepalive=10.0,
+        job_rate=50.0,
+        roam=0.01,
+        absence=0.002,
+        absence_time=30.0,
+        loss=0.0,
+        tick=0.1,
+        first_number=1000,
+    ):
+        self.server_addr = server_addr
+        self.keepalive = keepalive
+        self.job_rate = job_rate
+        self.roam = roam
+        self.absence = absence
+        self.absence_time = absence_time
+        self.loss = loss
+        self.tick = tick
+
+        self.bases = []
+        self.handsets = [Handset(str(first_number + i)) for i in range(handsets)]
+        self._bases_count = bases
+        # (time back, index in handsets) of absent handsets
+        self._absent = []
+        self._tasks = []
+
+        self._job_count = 0
+        # externalid => time sent, of jobs not confirmed yet
+        self._unconfirmed = {}
+        # job number => times delivered
+        self._deliveries = {}
+        self.confirm_latencies = []
+        self.delivery_latencies = []
+        self.stats = dict.fromkeys(
+            ("sent", "received", "lost", "jobs", "confirmed", "delivered", "duplicates", "absent", "roamed", "went_absent"), 0
+        )
+
+    async def start(self):
+        """
+        Opens the sockets of the BaseStations, registers the handsets and starts the models.
+        """
+        loop = asyncio.get_running_loop()
+        for index in range(self._bases_count):
+            base = VirtualBase(self, index)
+            await loop.create_datagram_endpoint(lambda base=base: base, local_addr=("127.0.0.1", 0), remote_addr=self.server_addr)
+            self.bases.append(base)
+
+        for i, handset in enumerate(self.handsets):
+            self.bases[i % len(self.bases)].attach(handset)
+            if i % 100 == 0:
+                # Do not flood the socket buffers.
+                await asyncio.sleep(0.001)
+
+        for base in self.bases:
+            self._tasks.append(asyncio.create_task(self._keepalives(base)))
+        self._tasks.append(asyncio.create_task(self._run_models()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        for base in self.bases:
+            base.transport.close()
+
+    async def _keepalives(self, base):
+        # Spread the keep-alives of the BaseStations over the interval.
+        await asyncio.sleep(random.random() * self.keepalive)
+        while True:
+            base.send_systeminfo()
+            await asyncio.sleep(self.keepalive)
+
+    async def _run_models(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self._step(time.time())
+
+    def _step(self, now):
+        present = len(self.handsets) - len(self._absent)
+
+        for _ in range(_events(present * self.roam * self.tick)):
+            handset = self.handsets[random.randrange(len(self.handsets))]
+            if handset.base is not None and len(self.bases) > 1:
+                index = (handset.base.index + random.choice((-1, 1))) % len(self.bases)
+                handset.base.detach(handset)
+                self.bases[index].attach(handset)
+                self.stats["roamed"] += 1
+
+        for _ in range(_events(present * self.absence * self.tick)):
+            i = random.randrange(len(self.handsets))
+            handset = self.handsets[i]
+            if handset.base is not None:
+                handset.base.detach(handset)
+                heapq.heappush(self._absent, (now + random.expovariate(1 / self.absence_time), i))
+                self.stats["went_absent"] += 1
+
+        while self._absent and self._absent[0][0] <= now:
+            _, i = heapq.heappop(self._absent)
+            self.bases[random.randrange(len(self.bases))].attach(self.handsets[i])
+
+        for _ in range(_events(self.job_rate * self.tick)):
+            self._send_job(now)
+
+    def _send_job(self, now):
+        sender = random.choice(self.handsets)
+        if sender.base is None:
+            return
+        recipient = random.choice(self.handsets)
+        self._job_count += 1
+        eid = "{:010d}".format(random.randrange(10**10))
+        self._unconfirmed[eid] = now
+        sender.base.send_job(eid, sender.number, recipient.number, "{}{} {:.6f}".format(_TEXT_PREFIX, self._job_count, now))
+        self.stats["jobs"] += 1
+
+    def confirmed(self, eid):
+        sent = self._unconfirmed.pop(eid, None)
+        if sent is not None:
+            self.confirm_latencies.append(time.time() - sent)
+            self.stats["confirmed"] += 1
+
+    def delivered(self, text):
+        if not text or not text.startswith(_TEXT_PREFIX):
+            return
+        job, written = text[len(_TEXT_PREFIX) :].split()
+        count = self._deliveries.get(job, 0)
+        self._deliveries[job] = count + 1
+        if count:
+            self.stats["duplicates"] += 1
+        else:
+            self.delivery_latencies.append(time.time() - float(written))
+            self.stats["delivered"] += 1
+
+    def report(self):
+        """
+        Returns the counters and the p50/p99 of the confirmation and delivery latencies in seconds.
+        """
+        report = dict(self.stats)
+        report["unconfirmed"] = len(self._unconfirmed)
+        for name, values in (("confirm", self.confirm_latencies), ("delivery", self.delivery_latencies)):
+            report[name + "_p50"] = _percentile(values, 0.5)
+            report[name + "_p99"] = _percentile(values, 0.99)
+        return report
+
+
+def print_report(report, elapsed):
+    print(f"{report['jobs']} jobs in {elapsed:.1f} s, datagrams sent {report['sent']}, received {report['received']}, lost {report['lost']}")
+    print(f"  confirmed:  {report['confirmed']:8d}  p50 {report['confirm_p50'] * 1000:8.1f} ms  p99 {report['confirm_p99'] * 1000:8.1f} ms")
+    print(f"  delivered:  {report['delivered']:8d}  p50 {report['delivery_p50'] * 1000:8.1f} ms  p99 {report['delivery_p99'] * 1000:8.1f} ms")
+    print(f"  duplicates: {report['duplicates']:8d}  answered absent {report['absent']}")
+    print(f"  handsets roamed {report['roamed']} times, went absent {report['went_absent']} times")
+
+
+async def run(args):
+    host, _, port = args.server.rpartition(":")
+    fleet = Fleet(
+        (host or "127.0.0.1", int(port)),
+        args.bases,
+        args.handsets,
+        args.keepalive,
+        args.job_rate,
+        args.roam,
+        args.absence,
+        args.absence_time,
+        args.loss,
+    )
+    random.seed(args.seed)
+    start = time.perf_counter()
+    await fleet.start()
+    try:
+        await asyncio.sleep(args.duration)
+        # Give the server some time for the last jobs.
+        fleet.job_rate = 0
+        await asyncio.sleep(args.settle)
+    finally:
+        await fleet.stop()
+    print_report(fleet.report(), time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate BaseStations and handsets to load test the messaging server")
+    parser.add_argument("--server", default="127.0.0.1:1300", help="HOST:PORT of the server (default: 127.0.0.1:1300)")
+    parser.add_argument("--bases", type=int, default=24, help="BaseStations (default: 24)")
+    parser.add_argument("--handsets", type=int, default=2000, help="Handsets in total (default: 2000)")
+    parser.add_argument("--keepalive", type=float, default=10, help="Seconds between systeminfo keep-alives (default: 10)")
+    parser.add_argument("--job-rate", type=float, default=50, help="Jobs written per second by all handsets (default: 50)")
+    parser.add_argument("--roam", type=float, default=0.01, help="Moves per handset and second (default: 0.01)")
+    parser.add_argument("--absence", type=float, default=0.002, help="Absences per handset and second (default: 0.002)")
+    parser.add_argument("--absence-time", type=float, default=30, help="Mean seconds of an absence (default: 30)")
+    parser.add_argument("--loss", type=float, default=0.0, help="Probability a datagram is lost, both ways (default: 0)")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to send jobs (default: 30)")
+    parser.add_argument("--settle", type=float, default=5, help="Seconds to wait for deliveries afterwards (default: 5)")
+    parser.add_argument("--seed", type=int, help="Seed of the models")
+    parser.add_argument("--log-level", default="WARNING", help="Log level (default: WARNING)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
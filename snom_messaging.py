@@ -1,80 +1,230 @@
 #!/usr/bin/env python3
 
+import argparse
 import asyncio
+import json
 import logging
+import multiprocessing
+import os
 import random
-import xml.etree.ElementTree as ET
+import signal
+import socket
+import tempfile
+import time
 
+from admin import AdminApi
+from capture import CaptureWriter
 from consumer import ConsumerDriver
+from events import EventBus, Webhook
+from frame import Frame
+from journal import Journal
+from httpserver import HttpServer
+from logsetup import setup_logging
+import metrics
 from messagesystem import MessageSystem
+from pipeline import LoopLag, ParsePipeline
+from ratelimit import RateController
+from retry import RetryPolicies
 from roaming import RoamingMonitor
+from rssi import RssiMonitor
+from submission import SubmissionServer
 
 logger = logging.getLogger(__name__)
 random.seed()
 
+_datagrams_received = metrics.counter("snom_datagrams_received_total", "Datagrams received")
+_frames_received = metrics.counter("snom_frames_received_total", "Frames received, by root element", ("tag", "type"))
+_datagrams_sent = metrics.counter("snom_datagrams_sent_total", "Datagrams sent, by root element", ("tag", "type"))
+_parse_seconds = metrics.histogram("snom_parse_seconds", "Time to parse a frame on the event loop")
+_dispatch_seconds = metrics.histogram(
+    "snom_dispatch_seconds", "Time a driver took to handle a frame", ("driver", "tag", "type")
+)
 
-def _prettyprint_mlstring(s, output):
-    lines = s.split("\n")
-    j = 1
-    for i in lines:
-        output("{:02} {}".format(j, i))
-        j += 1
+
+def _prettyprint_mlstring(data, level=logging.DEBUG):
+    """
+    Logs a datagram line by line with line numbers.
+    Nothing is decoded or split if `level` is disabled.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    for number, line in enumerate(data.decode("UTF-8", errors="replace").split("\n"), 1):
+        logger.log(level, "%02d %s", number, line)
+
+
+class DriverStats:
+    """
+    Counters of a single handler registered by a driver.
+    """
+
+    __slots__ = ("driver", "key", "labels", "calls", "errors", "seconds")
+
+    def __init__(self, driver, key):
+        self.driver = driver
+        self.key = key
+        # Label values of the dispatch time histogram
+        self.labels = (type(driver).__name__,) + key
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
 
 
 class UdpServer(asyncio.DatagramProtocol):
+    # (index, number) of this process among the workers sharing the port, see WorkerServer.
+    partition = (0, 1)
+
     def __init__(self):
         self._transport = None
         self._lastConnection = None
         self._drivers = []
 
+        # (tag, type) => list of (handler, DriverStats)
+        self._dispatch = {}
+
+        # (tag, type) => tuple of the paths the drivers read, see register_driver()
+        self.reads = {}
+
+        # Parses datagrams off the event loop if set, see ParsePipeline.
+        self.pipeline = None
+
+        # Writes every incoming datagram to a capture file if set, see CaptureWriter.
+        self.recorder = None
+
     def connection_made(self, transport):
         self._transport = transport
         logger.debug("UDP Socket opened")
 
     def datagram_received(self, data, addr):
-        logger.debug("incoming datagram from: {}".format(addr))
+        logger.debug("incoming datagram from: %s", addr)
         # Take a note of the last origin.
         # We assume this BaseStation will still be online when we are going to
         # send anything.
         self._lastConnection = addr
+        _datagrams_received.inc()
+
+        if self.recorder is not None:
+            self.recorder.write(data, addr)
+
+        if self.pipeline is not None:
+            _prettyprint_mlstring(data)
+            self.pipeline.submit(data, addr)
+            return
 
         # process all messages in a datagram
         # I haven't seen any datagram with more than one message inside.
         # But having them \0-terminated is either an off-by-one error or can
         # be a delimiter.
-        data = data.decode("UTF-8")
-        for message in data.split("\0"):
-            if not message:
+        for message in data.split(b"\0"):
+            if not message.strip():
                 # skip messages with len(0).
                 continue
 
-            _prettyprint_mlstring(message, logger.debug)
-            xml_message = ET.fromstring(message)
-            for driver in self._drivers:
-                # check if we find any driver for this message
-                try:
-                    if driver.process(xml_message, addr):
-                        break
-                except Exception as exp:
-                    logger.warning(
-                        "Message-Driver {} failed to process message with \
-                        exception {}.".format(driver, exp)
-                    )
-            else:
-                logger.warning("No driver is interested in this message. Dumping content.")
-                _prettyprint_mlstring(message, logger.warning)
+            _prettyprint_mlstring(message)
+            start = time.perf_counter()
+            try:
+                frame = Frame(message)
+            except ValueError as exp:
+                logger.warning("Dropping message from %s that is not XML: %s", addr, exp)
+                _frames_received.inc(("invalid", None))
+                continue
+            _parse_seconds.observe(time.perf_counter() - start)
+
+            self.dispatch(frame, addr)
+
+    def dispatch(self, frame, addr):
+        """
+        Passes a Frame received from addr to the drivers registered for it.
+        """
+        key = (frame.tag, frame.type)
+        _frames_received.inc(key)
+        handlers = self._dispatch.get(key)
+        if handlers is None:
+            logger.warning("No driver is interested in this message. Dumping content.")
+            _prettyprint_mlstring(frame.data, logging.WARNING)
+            return
+
+        for handler, stats in handlers:
+            start = time.perf_counter()
+            try:
+                handler(frame, addr)
+            except Exception as exp:
+                stats.errors += 1
+                logger.warning("Message-Driver %s failed to process message with exception %s.", stats.driver, exp)
+            elapsed = time.perf_counter() - start
+            stats.calls += 1
+            stats.seconds += elapsed
+            _dispatch_seconds.observe(elapsed, stats.labels)
 
     def error_received(self, exc):
-        logger.debug("UDP Socket: Got exception: {}".format(exc))
+        logger.debug("UDP Socket: Got exception: %s", exc)
 
     def register_driver(self, driver):
-        logger.debug("Attached Driver {}".format(driver))
+        """
+        Registers a driver for incoming messages.
+
+        Drivers declare the messages they are interested in with the class
+        attribute `handles`: A dict mapping (tag, type) of the root element to
+        the name of the method called as method(frame, addr) for these messages.
+        Several drivers may handle the same messages. They are called in the
+        order they were registered in.
+
+        Drivers may also declare the paths they read from these messages with
+        the class attribute `reads`: A dict mapping (tag, type) to a tuple of
+        paths. A ParsePipeline reads them off the event loop.
+        """
+        logger.debug("Attached Driver %s", driver)
         self._drivers.append(driver)
+        for key, method in driver.handles.items():
+            self._dispatch.setdefault(key, []).append((getattr(driver, method), DriverStats(driver, key)))
+        self._update_reads()
+
+    def _update_reads(self):
+        reads = {}
+        for driver in self._drivers:
+            for key, paths in getattr(driver, "reads", {}).items():
+                reads[key] = tuple(dict.fromkeys(reads.get(key, ()) + tuple(paths)))
+        self.reads = reads
+
+    def unregister_driver(self, driver):
+        """
+        Removes a driver registered with register_driver().
+        """
+        if driver not in self._drivers:
+            return
+        logger.debug("Detached Driver %s", driver)
+        self._drivers.remove(driver)
+        for key in driver.handles:
+            handlers = [(handler, stats) for handler, stats in self._dispatch.get(key, ()) if stats.driver is not driver]
+            if handlers:
+                self._dispatch[key] = handlers
+            else:
+                self._dispatch.pop(key, None)
+        self._update_reads()
 
-    def send_dgram(self, dgram, addr=None):
+    def driver_stats(self):
+        """
+        Returns the counters of all registered handlers as a list of dicts.
+        """
+        return [
+            {
+                "driver": type(stats.driver).__name__,
+                "tag": stats.key[0],
+                "type": stats.key[1],
+                "calls": stats.calls,
+                "errors": stats.errors,
+                "seconds": stats.seconds,
+            }
+            for handlers in self._dispatch.values()
+            for _, stats in handlers
+        ]
+
+    def send_dgram(self, dgram, addr=None, kind=("request", "job")):
         """
         Sends the String in dgram over the socket to the last known
         origin.
+
+        dgram may also be bytes, which are sent as they are.
+        kind is the (tag, type) of its root element, for the metrics.
         """
 
         if not self._lastConnection and addr is None:
@@ -84,32 +234,442 @@ class UdpServer(asyncio.DatagramProtocol):
                 out_addr = self._lastConnection
             else:
                 out_addr = addr
-            logger.debug("Outgoing Datagram to {}".format(addr))
-            _prettyprint_mlstring(dgram, logger.debug)
-            self._transport.sendto(dgram.encode("UTF-8"), addr)  # type: ignore
+            if isinstance(dgram, str):
+                dgram = dgram.encode("UTF-8")
+            logger.debug("Outgoing Datagram to %s", addr)
+            _prettyprint_mlstring(dgram)
+            self._transport.sendto(dgram, addr)  # type: ignore
+            _datagrams_sent.inc(kind)
+
+
+class WorkerServer(UdpServer):
+    """
+    The UdpServer of one of several worker processes sharing the port with
+    SO_REUSEPORT.
+
+    The kernel hands all datagrams from one address to the same worker, so
+    every BaseStation talks to a single worker. Jobs are accepted by whichever
+    worker receives them and the messages belong to that worker: Their
+    internal ids are chosen so that id % number == index (see
+    MessageSystem._new_id()). Status responses are forwarded to the worker
+    owning the message, roaming information is forwarded to all workers.
+
+    Frames are parsed once, by the worker that receives them: Workers forward
+    the texts the drivers read (see UdpServer.register_driver()) as JSON
+    over unix datagram sockets in socket_dir. A keep-alive that repeats the
+    last one of its BaseStation is forwarded without them. Roaming
+    information is collected for batch_interval seconds and forwarded in one
+    datagram per worker.
+    """
+
+    # Frames all workers need to know where the extensions are.
+    _shared = {
+        ("request", "systeminfo"),
+        ("request", "login"),
+        ("request", "alarm"),
+    }
+
+    # A repeated frame is forwarded with its texts again after this many
+    # times, in case a worker missed the last full one.
+    _resend = 10
+
+    batch_interval = 0.02
+    # Bytes of roaming information forwarded at once at most
+    _batch_size = 1 << 16
+
+    def __init__(self, index, number, socket_dir):
+        super().__init__()
+        self.partition = (index, number)
+        self._socket_dir = socket_dir
+        self._peers = None
+        self.forwarded = 0
+        # (key, addr) => [texts, repeated] of the last frame forwarded to all workers
+        self._sent = {}
+        # (key, addr) => texts of the last frame with texts from another worker
+        self._received = {}
+        # Messages for all other workers, see _flush_batch()
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_handle = None
+
+    @staticmethod
+    def socket_path(socket_dir, index):
+        return os.path.join(socket_dir, "worker-{}.sock".format(index))
+
+    async def open_peers(self):
+        """
+        Binds the unix socket the other workers forward frames to.
+        """
+        path = self.socket_path(self._socket_dir, self.partition[0])
+        loop = asyncio.get_running_loop()
+        self._peers, _ = await loop.create_datagram_endpoint(lambda: _PeerProtocol(self), local_addr=path, family=socket.AF_UNIX)
 
+    def close_peers(self):
+        self._flush_batch()
+        if self._peers is not None:
+            self._peers.close()
+            self._peers = None
 
-async def main():
-    logging.basicConfig(level=logging.INFO)
+    def dispatch(self, frame, addr):
+        index, number = self.partition
+        key = (frame.tag, frame.type)
+        if key == ("response", "job"):
+            owner = frame.get_int("externalid", index) % number
+            if owner != index:
+                self._forward(owner, self._encode(frame, key, addr, False))
+                return
+        super().dispatch(frame, addr)
+        if key in self._shared and number > 1:
+            # The drivers have read the frame already, its texts are cached.
+            message = self._encode(frame, key, addr, True)
+            self._batch.append(message)
+            self._batch_bytes += len(message)
+            if self._batch_bytes >= self._batch_size:
+                self._flush_batch()
+            elif self._batch_handle is None:
+                self._batch_handle = asyncio.get_running_loop().call_later(self.batch_interval, self._flush_batch)
+
+    def _flush_batch(self):
+        """
+        Forwards the collected roaming information to all other workers,
+        one message per line.
+        """
+        if self._batch_handle is not None:
+            self._batch_handle.cancel()
+            self._batch_handle = None
+        if not self._batch:
+            return
+        data = b"\n".join(self._batch)
+        self._batch = []
+        self._batch_bytes = 0
+        index, number = self.partition
+        for peer in range(number):
+            if peer != index:
+                self._forward(peer, data)
+
+    def _encode(self, frame, key, addr, repeatable):
+        """
+        Returns the message forwarding a frame received from addr. If
+        repeatable and the frame repeats the last one from addr, the texts
+        are left out.
+        """
+        texts = {path: frame.getall(path) for path in self.reads.get(key, ())}
+        message = {"addr": addr[:2], "tag": frame.tag, "type": frame.type}
+        if repeatable:
+            last = self._sent.get((key, addr))
+            if last is not None and last[1] < self._resend and last[0] == texts:
+                last[1] += 1
+                return json.dumps(message).encode("UTF-8")
+            self._sent[(key, addr)] = [texts, 0]
+        message["texts"] = texts
+        return json.dumps(message).encode("UTF-8")
+
+    def _forward(self, peer, data):
+        """
+        Sends messages about received frames to another worker.
+        """
+        if self._peers is None:
+            logger.warning("Can not forward to worker %s before the worker socket is open", peer)
+            return
+        self.forwarded += 1
+        self._peers.sendto(data, self.socket_path(self._socket_dir, peer))
+
+    def forwarded_received(self, data):
+        """
+        Handles the messages forwarded by another worker in one datagram.
+        """
+        for line in data.split(b"\n"):
+            self._forwarded_message(line)
+
+    def _forwarded_message(self, data):
+        try:
+            message = json.loads(data)
+            addr = tuple(message["addr"])
+            key = (message["tag"], message["type"])
+        except (ValueError, KeyError, TypeError) as exp:
+            logger.warning("Dropping malformed message from another worker: %s", exp)
+            return
+        texts = message.get("texts")
+        if texts is None:
+            texts = self._received.get((key, addr))
+            if texts is None:
+                # The last full one got lost, a later one has the texts again.
+                return
+        elif key in self._shared:
+            self._received[(key, addr)] = texts
+        # Not forwarded again, the worker that received it did that already.
+        UdpServer.dispatch(self, Frame.from_values(key[0], key[1], texts), addr)
+
+
+class _PeerProtocol(asyncio.DatagramProtocol):
+    """
+    Receives the messages forwarded by the other workers.
+    """
+
+    def __init__(self, server):
+        self._server = server
+
+    def datagram_received(self, data, addr):
+        self._server.forwarded_received(data)
+
+    def error_received(self, exc):
+        # Usually a worker that is not (or no longer) running.
+        logger.warning("Forwarding to another worker failed: %s", exc)
+
+
+async def main(args, worker=None):
+    """
+    Runs the server until SIGTERM or SIGINT.
+
+    worker is None for a single process or the tuple (index, socket_dir) of
+    one of args.workers processes started by run_workers().
+    """
+    label = None if worker is None else "worker {}".format(worker[0])
+    log_listener = setup_logging(args.log_level, args.log_file, args.log_queue, label)
     logger.debug("Begin Setup...")
 
+    journal_path = args.journal
+    share = 1.0
+    if worker is None:
+        server_factory = UdpServer
+    else:
+        index, socket_dir = worker
+        if journal_path:
+            journal_path = "{}.{}".format(journal_path, index)
+        # Every worker sends to every BaseStation.
+        share = 1 / args.workers
+
+        def server_factory():
+            return WorkerServer(index, args.workers, socket_dir)
+
+    rate_controller = RateController(share=share, budgets=args.priority_budgets)
+
+    journal = None
+    if journal_path:
+        journal = Journal(journal_path, group_commit=not args.no_group_commit)
+
+    groups = None
+    if args.groups:
+        with open(args.groups, encoding="UTF-8") as f:
+            groups = json.load(f)
+        logger.info("Loaded %s groups from %s", len(groups), args.groups)
+
+    retry_policies = None
+    if args.retry_policies:
+        with open(args.retry_policies, encoding="UTF-8") as f:
+            retry_policies = RetryPolicies.from_config(json.load(f))
+
     loop = asyncio.get_running_loop()
-    sock = loop.create_datagram_endpoint(UdpServer, local_addr=("0.0.0.0", 1300))
+    sock = loop.create_datagram_endpoint(server_factory, local_addr=("0.0.0.0", args.port), reuse_port=worker is not None)
     transport, protocol = await sock
+    if worker is not None:
+        await protocol.open_peers()
 
     roaming_monitor = RoamingMonitor(protocol)
-    message_system = MessageSystem(protocol, roaming_monitor)
+    rssi_monitor = RssiMonitor(protocol, roaming_monitor)
+    message_system = MessageSystem(protocol, roaming_monitor, journal, groups, rate_controller, retry_policies)
     consumer_driver = ConsumerDriver(protocol)
+    if args.capture:
+        protocol.recorder = CaptureWriter(args.capture if worker is None else "{}.{}".format(args.capture, worker[0]))
+    if args.parse_pool:
+        protocol.pipeline = ParsePipeline(protocol, args.parse_pool, args.parse_workers, args.parse_queue)
+    loop_lag = None
+    if args.loop_lag:
+        # Off by default: The timer wakes up an idle server.
+        loop_lag = LoopLag(args.loop_lag)
+        loop_lag.start()
+    await roaming_monitor.start()
+    await message_system.start()
+
+    metrics.gauge("snom_outbox_messages", "Messages waiting for delivery", message_system.queue_length)
+    metrics.gauge(
+        "snom_roaming_entries",
+        "Handsets and BaseStations in the roaming table",
+        lambda: {(kind,): count for kind, count in roaming_monitor.stats().items()},
+        ("kind",),
+    )
+    if loop_lag is not None:
+        metrics.gauge(
+            "snom_event_loop_lag_seconds",
+            "Lag of the event loop over the last samples",
+            lambda: {(stat,): value for stat, value in loop_lag.stats().items() if stat != "samples"},
+            ("stat",),
+        )
+    if protocol.pipeline is not None:
+        metrics.gauge(
+            "snom_parse_pipeline_datagrams",
+            "Counters of the parse pipeline",
+            lambda: {(name,): value for name, value in protocol.pipeline.stats().items()},
+            ("counter",),
+        )
+    event_bus = EventBus(message_system)
+    webhook = None
+    if args.webhook:
+        webhook = Webhook(event_bus, args.webhook)
+        webhook.start()
+    http_server = None
+    if args.http:
+        # With several workers every worker has its own port.
+        http_server = HttpServer("127.0.0.1", args.http if worker is None else args.http + worker[0])
+        metrics.serve(http_server)
+        AdminApi(message_system, roaming_monitor, event_bus).register(http_server)
+        await http_server.start()
+    submission_server = None
+    if args.submit:
+        submission_server = SubmissionServer(message_system, args.submit if worker is None else "{}.{}".format(args.submit, worker[0]))
+        await submission_server.start()
+
+    # Stop gracefully on SIGTERM (e.g. a rolling restart) and Ctrl+C.
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
 
     logger.info("Snom Messaging started successfully.")
     try:
-        await asyncio.Future()  # run forever
-    except KeyboardInterrupt:
-        pass
+        await stop.wait()
+        logger.info("Stopping...")
+        await message_system.stop(args.drain_timeout)
+        rssi_monitor.close()
+        await roaming_monitor.stop()
     finally:
-        transport.close()
+        if submission_server is not None:
+            await submission_server.stop()
+        if webhook is not None:
+            await webhook.stop()
+        # Ends the streams of GET /events.
+        event_bus.close()
+        if http_server is not None:
+            await http_server.stop()
         message_system.close()
+        transport.close()
+        if worker is not None:
+            protocol.close_peers()
+        if protocol.pipeline is not None:
+            logger.info("Parse pipeline: %s", protocol.pipeline.stats())
+            protocol.pipeline.close()
+        if protocol.recorder is not None:
+            protocol.recorder.close()
+        if loop_lag is not None:
+            loop_lag.stop()
+            lag = loop_lag.stats()
+            logger.info("Event loop lag: mean %.1f ms, p99 %.1f ms, max %.1f ms", lag["mean"] * 1000, lag["p99"] * 1000, lag["max"] * 1000)
+        logger.info("Snom Messaging stopped.")
+        if log_listener is not None:
+            log_listener.stop()
+
+
+def _run_worker(args, index, socket_dir):
+    # The parent only forwards signals, the worker handles them on its event loop.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    asyncio.run(main(args, (index, socket_dir)))
+
+
+def run_workers(args):
+    """
+    Runs args.workers processes of the server sharing the UDP port and waits
+    for them to stop. SIGTERM and SIGINT are passed on to the workers.
+    """
+    if args.journal:
+        # Each worker has its own journal. Messages in the journals of workers
+        # that are not started would be lost.
+        index = args.workers
+        while os.path.exists("{}.{}".format(args.journal, index)):
+            index += 1
+        if index > args.workers:
+            raise SystemExit("{}.{} belongs to worker {}, start at least {} workers".format(args.journal, index - 1, index - 1, index))
+
+    with tempfile.TemporaryDirectory(prefix="snom-messaging-") as socket_dir:
+        processes = [
+            multiprocessing.Process(target=_run_worker, args=(args, index, socket_dir), name="worker-{}".format(index))
+            for index in range(args.workers)
+        ]
+        for process in processes:
+            process.start()
+
+        def forward(signum, _):
+            for process in processes:
+                if process.is_alive():
+                    os.kill(process.pid, signum)
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        for process in processes:
+            process.join()
+
+
+def _parse_budgets(value):
+    """
+    Parses priority budgets like "0=0.8,1=0.9" into {0: 0.8, 1: 0.9}.
+    """
+    budgets = {}
+    for item in value.split(","):
+        priority, sep, share = item.partition("=")
+        try:
+            budgets[int(priority)] = float(share)
+        except ValueError:
+            raise argparse.ArgumentTypeError("expected PRIORITY=SHARE, e.g. 0=0.8, not {!r}".format(item))
+        if not 0 < budgets[int(priority)] <= 1:
+            raise argparse.ArgumentTypeError("the share of priority {} is not in (0, 1]".format(priority))
+    return budgets
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Snom DECT messaging server")
+    parser.add_argument("--port", type=int, default=1300, help="UDP port the BaseStations send to (default: 1300)")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of server processes sharing the port with SO_REUSEPORT (default: 1)"
+    )
+    parser.add_argument("--journal", help="Persist the message queue to this journal file (with --workers: one file per worker)")
+    parser.add_argument("--no-group-commit", action="store_true", help="Sync every journal record on its own (slow)")
+    parser.add_argument("--groups", help="JSON file mapping group names to lists of extensions for broadcasts")
+    parser.add_argument(
+        "--priority-budgets",
+        type=_parse_budgets,
+        help="Share of the rate of a BaseStation the messages of a priority may use, e.g. 0=0.8 leaves 20%% for urgent messages",
+    )
+    parser.add_argument("--retry-policies", help="JSON file configuring when messages are sent again (see retry.py)")
+    parser.add_argument(
+        "--drain-timeout", type=float, default=5, help="Seconds to wait for the status of messages in flight on shutdown (default: 5)"
+    )
+    parser.add_argument(
+        "--parse-pool", choices=("thread", "process"), help="Parse incoming datagrams in a pool of threads or processes"
+    )
+    parser.add_argument("--parse-workers", type=int, default=2, help="Threads or processes of the parse pool (default: 2)")
+    parser.add_argument(
+        "--parse-queue",
+        type=int,
+        default=10000,
+        help="Datagrams waiting for the parse pool before keep-alives and then new datagrams are dropped (default: 10000)",
+    )
+    parser.add_argument(
+        "--loop-lag",
+        type=float,
+        metavar="SECONDS",
+        help="Measure the lag of the event loop with a timer due every SECONDS, e.g. 0.1 (default: off)",
+    )
+    parser.add_argument(
+        "--http",
+        type=int,
+        help="Serve the metrics and the admin API on http://127.0.0.1:HTTP/ (with --workers: HTTP + index of the worker)",
+    )
+    parser.add_argument("--webhook", help="POST the delivery status events of the messages to this URL, see events.py")
+    parser.add_argument(
+        "--submit",
+        help="Accept messages from local clients on this Unix socket, see submission.py (with --workers: SUBMIT.index of the worker)",
+    )
+    parser.add_argument(
+        "--capture", help="Record incoming datagrams to this file for replay.py (with --workers: one file per worker)"
+    )
+    parser.add_argument("--log-level", default="INFO", help="Log level, e.g. DEBUG to dump all datagrams (default: INFO)")
+    parser.add_argument("--log-file", help="Write the log to this file instead of stderr")
+    parser.add_argument("--log-queue", action="store_true", help="Write the log from a background thread")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    arguments = parse_args()
+    if arguments.workers > 1:
+        run_workers(arguments)
+    else:
+        asyncio.run(main(arguments))
@@ -0,0 +1,333 @@
+"""
+Local submission of messages over a Unix socket.
+
+Integrations on the same host queue messages here instead of sending a job
+datagram to the UDP port like a BaseStation would. The protocol is JSON,
+one object per line, in both directions. A request queues a batch:
+| {"seq": 1, "messages": [{"to": "102", "text": "Hello"}, {"to": ["102", "group"], "text": "..."}], "watch": true}
+
+Every message may also have "from", "from_name", "from_location" and
+"priority". The answer has a result per message, in the same order, once
+all of them are queued (and in the journal):
+| {"seq": 1, "results": [{"id": 1234567890}, {"broadcast": "0123456789", "recipients": 12}]}
+
+A malformed message gets {"error": "..."} instead, the others are queued
+anyway. With "watch" the server then pushes the delivery status of the
+messages until they left the queue:
+| {"id": 1234567890, "to": "102", "status": "sent"}
+| {"id": 1234567890, "to": "102", "status": "delivered"}
+
+Events of the copies of a broadcast also have "broadcast". The states are
+those of Broadcast recipients.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+
+from messagesystem import Broadcast
+
+logger = logging.getLogger(__name__)
+
+# States after which a message is no longer queued
+FINAL = Broadcast._final
+
+
+def queue_submission(message_system, data, callback=None):
+    """
+    Queues a submitted message, data is a dict {"to": ..., "text": ..., ...}.
+    A list or a group as "to" makes a broadcast.
+
+    callback is called without arguments once the message is queued (and
+    written to the journal).
+    Returns the result {"id": internal id} or {"broadcast": id, "recipients": count}.
+    Raises ValueError if data is malformed.
+    """
+    if not isinstance(data, dict) or not data.get("to") or not isinstance(data.get("text"), str):
+        raise ValueError('expected {"to": ..., "text": ...}')
+    to = data["to"]
+    sender = {
+        "from_ext": str(data.get("from", "server")),
+        "from_name": str(data.get("from_name", "System")),
+        "from_loc": str(data.get("from_location", "server")),
+    }
+    try:
+        priority = int(data.get("priority", 0))
+    except (TypeError, ValueError):
+        raise ValueError("priority is no integer")
+
+    if isinstance(to, list) or message_system.expand_recipients([str(to)]) != [str(to)]:
+        recipients = [str(recipient) for recipient in to] if isinstance(to, list) else [str(to)]
+        broadcast = message_system.broadcast(recipients, data["text"], priority=priority, callback=callback, **sender)
+        return {"broadcast": broadcast.id, "recipients": len(broadcast.status)}
+
+    message = message_system.queue_message(str(to), data["text"], priority=priority, callback=callback, **sender)
+    return {"id": message.internal_ext_id}
+
+
+class _Connection:
+    """
+    A client of the SubmissionServer and the messages it watches.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        # Events held back while an answer is pending, None otherwise
+        self.held = None
+        self.ids = set()
+        self.broadcast_ids = set()
+
+    def push(self, event):
+        line = (json.dumps(event) + "\n").encode("UTF-8")
+        if self.held is not None:
+            self.held.append(line)
+        else:
+            self.writer.write(line)
+
+
+class SubmissionServer:
+    """
+    This class accepts messages from local clients on a Unix socket, see
+    the module documentation for the protocol.
+
+    Every connection handles its requests one after the other; clients
+    batch messages to submit many per second. A client that does not read
+    the status events it asked for loses its watches once more than
+    max_buffer bytes are waiting for it.
+    """
+
+    max_line = 1 << 20
+    max_buffer = 1 << 20
+
+    def __init__(self, message_system, path):
+        self._message_system = message_system
+        self._path = path
+        self._server = None
+        # internal id or broadcast id => _Connection watching it
+        self._watches = {}
+        self._broadcast_watches = {}
+        # The connection watching the messages queue_submission() is queueing
+        self._submitting = None
+        self._connections = set()
+
+    async def start(self):
+        if os.path.exists(self._path):
+            # Left over from a server that did not stop cleanly
+            os.unlink(self._path)
+        self._server = await asyncio.start_unix_server(self._serve, self._path, limit=self.max_line)
+        self._message_system.add_listener(self._status_changed)
+        logger.info("Submission socket listening on %s", self._path)
+
+    async def stop(self):
+        """
+        Stops listening and closes the connections of the clients, as
+        wait_closed() waits for them.
+        """
+        if self._server is not None:
+            self._message_system.remove_listener(self._status_changed)
+            self._server.close()
+            for connection in list(self._connections):
+                connection.writer.close()
+            await self._server.wait_closed()
+            self._server = None
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+    async def _serve(self, reader, writer):
+        connection = _Connection(writer)
+        self._connections.add(connection)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    writer.write(b'{"seq": null, "error": "request too long"}\n')
+                    break
+                if not line:
+                    break
+                if line.strip():
+                    writer.write((json.dumps(await self._submit(connection, line)) + "\n").encode("UTF-8"))
+                    held, connection.held = connection.held, None
+                    if held:
+                        writer.writelines(held)
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(connection)
+            self._unwatch(connection)
+            writer.close()
+
+    async def _submit(self, connection, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"seq": None, "error": "request is no JSON"}
+        if not isinstance(request, dict):
+            return {"seq": None, "error": 'expected {"seq": ..., "messages": [...]}'}
+        if not isinstance(request.get("messages"), list):
+            return {"seq": request.get("seq"), "error": 'expected {"seq": ..., "messages": [...]}'}
+
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        pending = [0]
+
+        def committed():
+            pending[0] -= 1
+            if pending[0] == 0 and not done.done():
+                done.set_result(None)
+
+        watch = bool(request.get("watch"))
+        if watch:
+            connection.held = []
+        results = []
+        for data in request["messages"]:
+            pending[0] += 1
+            # The messages are watched from their first status ("queued"),
+            # which is set before queue_submission() returns their ids.
+            self._submitting = connection if watch else None
+            try:
+                results.append(queue_submission(self._message_system, data, committed))
+            except ValueError as exp:
+                pending[0] -= 1
+                results.append({"error": str(exp)})
+            finally:
+                self._submitting = None
+
+        if pending[0]:
+            await done
+        return {"seq": request.get("seq"), "results": results}
+
+    def _status_changed(self, message, status):
+        broadcast = message.broadcast
+        if broadcast is None:
+            connection = self._watches.get(message.internal_ext_id)
+            if connection is None:
+                connection = self._submitting
+                if connection is None:
+                    return
+                self._watches[message.internal_ext_id] = connection
+                connection.ids.add(message.internal_ext_id)
+            event = {"id": message.internal_ext_id, "to": message.to_ext, "status": status}
+            if status in FINAL:
+                del self._watches[message.internal_ext_id]
+                connection.ids.discard(message.internal_ext_id)
+        else:
+            connection = self._broadcast_watches.get(broadcast.id)
+            if connection is None:
+                connection = self._submitting
+                if connection is None:
+                    return
+                self._broadcast_watches[broadcast.id] = connection
+                connection.broadcast_ids.add(broadcast.id)
+            event = {"id": message.internal_ext_id, "to": message.to_ext, "status": status, "broadcast": broadcast.id}
+            if broadcast.done:
+                del self._broadcast_watches[broadcast.id]
+                connection.broadcast_ids.discard(broadcast.id)
+
+        connection.push(event)
+        if connection.writer.transport.get_write_buffer_size() > self.max_buffer:
+            logger.warning("Submission client does not read its status events, dropping its watches")
+            self._unwatch(connection)
+
+    def _unwatch(self, connection):
+        for internal_ext_id in connection.ids:
+            self._watches.pop(internal_ext_id, None)
+        for broadcast_id in connection.broadcast_ids:
+            self._broadcast_watches.pop(broadcast_id, None)
+        connection.ids.clear()
+        connection.broadcast_ids.clear()
+
+
+class SubmissionClient:
+    """
+    Submits messages to a SubmissionServer from asyncio code:
+    | async with SubmissionClient("/run/snom/submit.sock") as client:
+    |     results = await client.submit([{"to": "102", "text": "Hello"}], watch=True)
+    |     async for event in client.events():
+    |         ...
+
+    submit() may be called concurrently, the answers are matched to the
+    requests by their seq.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._seq = itertools.count(1)
+        # seq => future resolved with the results
+        self._pending = {}
+        self._events = asyncio.Queue()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_unix_connection(self.path, limit=SubmissionServer.max_line)
+            self._read_task = asyncio.create_task(self._read())
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._read_task.cancel()
+            self._writer = None
+
+    async def submit(self, messages, watch=False):
+        """
+        Queues messages, a list of dicts (see the module documentation).
+        Returns the list of their results once they are queued.
+        """
+        await self.open()
+        seq = next(self._seq)
+        future = self._pending[seq] = asyncio.get_running_loop().create_future()
+        try:
+            self._writer.write((json.dumps({"seq": seq, "messages": messages, "watch": watch}) + "\n").encode("UTF-8"))
+            await self._writer.drain()
+            return await future
+        finally:
+            del self._pending[seq]
+
+    async def events(self):
+        """
+        Yields the status events of the watched messages.
+        Ends when the connection is closed.
+        """
+        while True:
+            event = await self._events.get()
+            if event is None:
+                return
+            yield event
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                reply = json.loads(line)
+                if "seq" not in reply:
+                    self._events.put_nowait(reply)
+                    continue
+                future = self._pending.get(reply["seq"])
+                if future is None or future.done():
+                    continue
+                if "error" in reply:
+                    future.set_exception(ValueError(reply["error"]))
+                else:
+                    future.set_result(reply["results"])
+        except (ConnectionError, ValueError) as exp:
+            logger.warning("Submission connection failed: %s", exp)
+        finally:
+            self._events.put_nowait(None)
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("submission connection closed"))
@@ -0,0 +1,65 @@
+import re
+from xml.sax.saxutils import escape
+
+_PLACEHOLDER = re.compile(r"\{\{(\w+)\}\}")
+
+
+class Template:
+    """
+    This class implements a precompiled XML-template.
+
+    Templates contain placeholders like {{name}}. The template is split at
+    the placeholders once and the static parts are kept as UTF-8 bytes.
+    Rendering only has to escape and encode the values and to join them
+    with the static parts, which is a single bytes-%-operation.
+    """
+
+    def __init__(self, text):
+        parts = _PLACEHOLDER.split(text)
+        self._compile([part.encode("UTF-8") for part in parts[0::2]], parts[1::2])
+
+    def _compile(self, static, fields):
+        """
+        static are the bytes between the placeholders for `fields`.
+        """
+        self._static = static
+        self.fields = tuple(fields)
+        self._format = b"%s".join(part.replace(b"%", b"%%") for part in static)
+
+    def partial(self, **values):
+        """
+        Returns a new Template with the placeholders in `values` filled in.
+
+        This is useful if many messages share most of their content, e.g.
+        the text of a broadcast: The shared values are only escaped and
+        encoded once. render() of the new Template ignores these values.
+        """
+        static = [self._static[0]]
+        fields = []
+        for field, part in zip(self.fields, self._static[1:]):
+            if field in values:
+                static[-1] += _encode(values[field]) + part
+            else:
+                fields.append(field)
+                static.append(part)
+
+        template = Template.__new__(Template)
+        template._compile(static, fields)
+        return template
+
+    def render(self, **values):
+        """
+        Renders the template into bytes.
+        All values are XML-escaped. None is rendered as empty string.
+        """
+
+        return self._format % tuple([_encode(values[field]) for field in self.fields])
+
+
+def _encode(value):
+    if value is None:
+        return b""
+    value = str(value)
+    if "&" in value or "<" in value or ">" in value:
+        value = escape(value)
+    return value.encode("UTF-8")
@@ -0,0 +1,45 @@
+import asyncio
+
+from journal import Journal
+
+
+class _FailingJournal(Journal):
+    """
+    Fails the first write, the writes after it are in flight already.
+    """
+
+    retry_interval = 0.01
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failures = 1
+
+    def _write(self, data):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        super()._write(data)
+
+
+def test_failed_write_keeps_order(tmp_path):
+    path = str(tmp_path / "outbox.journal")
+
+    async def run():
+        journal = _FailingJournal(path, group_commit=False)
+        committed = []
+        journal.queued(["1", "102", "Hello"], lambda: committed.append("q"))
+        journal.done("1", "delivered")
+        journal.append(["a", "2", "1.0"], lambda: committed.append("a"))
+        for _ in range(100):
+            if len(committed) == 2:
+                break
+            await asyncio.sleep(0.01)
+        journal.close()
+        return committed
+
+    assert asyncio.run(run()) == ["q", "a"]
+    with open(path, encoding="UTF-8") as f:
+        assert [line.split("\t")[0] for line in f] == ["q", "d", "a"]
+    journal = Journal(path)
+    assert journal.recover() == []
+    journal.close()
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+from frame import Frame
+from journal import Journal
+from messagesystem import MessageSystem
+from roaming import RoamingMonitor
+from simulatedbase import SimulatedBaseStation
+from snom_messaging import UdpServer
+
+ADDR = ("192.168.1.10", 1300)
+
+
+async def _start(path):
+    """
+    Starts a MessageSystem with the journal at path.
+    Returns the UdpServer, the RoamingMonitor, the MessageSystem and the time start() took.
+    """
+    server = UdpServer()
+    roaming_monitor = RoamingMonitor(server)
+    begin = time.perf_counter()
+    message_system = MessageSystem(server, roaming_monitor, Journal(path))
+    await message_system.start()
+    return server, roaming_monitor, message_system, time.perf_counter() - begin
+
+
+async def _stop(message_system, timeout):
+    begin = time.perf_counter()
+    await message_system.stop(timeout)
+    return time.perf_counter() - begin
+
+
+def test_start_and_stop_empty(tmp_path):
+    async def run():
+        _, _, message_system, started = await _start(str(tmp_path / "outbox.journal"))
+        return started, await _stop(message_system, 5.0)
+
+    started, stopped = asyncio.run(run())
+    # About 1 ms each, the target is single-digit milliseconds.
+    assert started < 0.02
+    assert stopped < 0.02
+
+
+def test_restart_loses_no_messages(tmp_path):
+    path = str(tmp_path / "outbox.journal")
+    handsets = [str(1000 + i) for i in range(200)]
+
+    async def run():
+        server, roaming_monitor, message_system, _ = await _start(path)
+        base = SimulatedBaseStation(server, ADDR, capacity=400)
+        server.connection_made(base)
+        roaming_monitor.process_systeminfo(Frame.from_values("request", "systeminfo", {"senderdata/address": handsets}), ADDR)
+        message_system.broadcast(handsets, "Restart in the middle of this broadcast")
+        # Stop in the middle of the broadcast
+        await asyncio.sleep(0.25)
+        stopped = await _stop(message_system, 2.0)
+        acknowledged = len(base.delivered)
+        base.close()
+
+        _, _, message_system, started = await _start(path)
+        queued = message_system.queue_length()
+        await _stop(message_system, 2.0)
+        return stopped, started, acknowledged, queued
+
+    stopped, started, acknowledged, queued = asyncio.run(run())
+    assert 0 < acknowledged < len(handsets)
+    assert acknowledged + queued == len(handsets)
+    # The messages in flight only take a few ms to be answered.
+    assert stopped < 0.05
+    assert started < 0.05
@@ -0,0 +1,94 @@
+import asyncio
+
+from frame import Frame
+from messagesystem import Broadcast, MessageSystem
+from roaming import RoamingMonitor
+from snom_messaging import UdpServer
+
+ADDR = ("192.168.1.10", 1300)
+
+
+class _Transport:
+    """
+    Records the external ids of the jobs sent to the BaseStation.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr=None):
+        self.sent.append(Frame(data.split(b"\0")[0]).get("externalid"))
+
+
+def _login(roaming_monitor, number):
+    values = {"logindata/status": ["1"], "senderdata/address": [number]}
+    roaming_monitor.process_login(Frame.from_values("request", "login", values), ADDR)
+
+
+def _answer(server, external_id, status):
+    server.datagram_received(
+        b"<response type='job'><externalid>%s</externalid><jobdata><status>%d</status></jobdata></response>"
+        % (external_id.encode("ascii"), status),
+        ADDR,
+    )
+
+
+async def _send_one():
+    """
+    Queues a message for a handset that is logged in and waits until it is sent.
+    """
+    server = UdpServer()
+    transport = _Transport()
+    server.connection_made(transport)
+    roaming_monitor = RoamingMonitor(server)
+    message_system = MessageSystem(server, roaming_monitor)
+    _login(roaming_monitor, "102")
+    await message_system.start()
+    message_system.queue_message("102", "Hello")
+    for _ in range(100):
+        if transport.sent:
+            break
+        await asyncio.sleep(0.01)
+    return server, roaming_monitor, message_system, transport
+
+
+def test_login_does_not_resend_unanswered():
+    async def run():
+        server, roaming_monitor, message_system, transport = await _send_one()
+        # Logs in again while the answer is on its way
+        await asyncio.sleep(0.02)
+        _login(roaming_monitor, "102")
+        await asyncio.sleep(0.1)
+        message_system.close()
+        return transport.sent
+
+    assert len(asyncio.run(run())) == 1
+
+
+def test_login_resends_absent():
+    async def run():
+        server, roaming_monitor, message_system, transport = await _send_one()
+        _answer(server, transport.sent[0], 11)
+        await asyncio.sleep(0.05)
+        sent = len(transport.sent)
+        _login(roaming_monitor, "102")
+        await asyncio.sleep(0.1)
+        message_system.close()
+        return sent, transport.sent
+
+    sent, resent = asyncio.run(run())
+    assert sent == 1
+    assert len(resent) == 2 and resent[0] == resent[1]
+
+
+def test_broadcast_done():
+    broadcast = Broadcast("0123456789", ["102", "103"])
+    broadcast.update("102", "sent")
+    broadcast.update("102", "delivered")
+    # Final states are never left and only count once.
+    broadcast.update("102", "sent")
+    broadcast.update("102", "failed")
+    assert not broadcast.done
+    broadcast.update("103", "cancelled")
+    assert broadcast.done
+    assert broadcast.summary() == {"delivered": 1, "cancelled": 1}
@@ -0,0 +1,57 @@
+from frame import Frame
+from roaming import ADD, MOVE, REMOVE, RoamingMonitor
+from snom_messaging import UdpServer
+
+A = ("192.168.1.10", 1300)
+B = ("192.168.1.11", 1300)
+
+
+def _monitor():
+    roaming_monitor = RoamingMonitor(UdpServer())
+    events = []
+    roaming_monitor.add_listener(lambda event: events.append((event.kind, event.number, event.addr, event.previous)))
+    return roaming_monitor, events
+
+
+def _systeminfo(roaming_monitor, addr, numbers):
+    roaming_monitor.process_systeminfo(Frame.from_values("request", "systeminfo", {"senderdata/address": numbers}), addr)
+
+
+def _login(roaming_monitor, addr, number, status="1"):
+    values = {"logindata/status": [status], "senderdata/address": [number]}
+    roaming_monitor.process_login(Frame.from_values("request", "login", values), addr)
+
+
+def test_overlapping_cells_steady_state():
+    roaming_monitor, events = _monitor()
+    for _ in range(10):
+        _systeminfo(roaming_monitor, A, ["100", "101"])
+        _systeminfo(roaming_monitor, B, ["100"])
+    assert events == [(ADD, "100", A, None), (ADD, "101", A, None)]
+    assert roaming_monitor.get_addr("100") == A
+    assert [presence.number for presence in roaming_monitor.query(addr=B)] == []
+
+
+def test_overlapping_cells_take_over():
+    roaming_monitor, events = _monitor()
+    _systeminfo(roaming_monitor, A, ["100"])
+    _systeminfo(roaming_monitor, B, ["100"])
+    _systeminfo(roaming_monitor, A, [])
+    assert roaming_monitor.get_addr("100") == B
+    _systeminfo(roaming_monitor, A, [])
+    _systeminfo(roaming_monitor, B, [])
+    assert roaming_monitor.get_addr("100") is None
+    assert events == [(ADD, "100", A, None), (MOVE, "100", B, A), (REMOVE, "100", None, B)]
+
+
+def test_login_elsewhere_while_listed():
+    roaming_monitor, events = _monitor()
+    _systeminfo(roaming_monitor, A, ["100"])
+    _login(roaming_monitor, B, "100")
+    _systeminfo(roaming_monitor, A, ["100"])
+    _systeminfo(roaming_monitor, B, ["100"])
+    assert roaming_monitor.get_addr("100") == B
+    # A still lists it and takes it back once B drops it.
+    _systeminfo(roaming_monitor, B, [])
+    assert roaming_monitor.get_addr("100") == A
+    assert events == [(ADD, "100", A, None), (MOVE, "100", B, A), (MOVE, "100", A, B)]
@@ -0,0 +1,99 @@
+import time
+
+from roaming import RoamingMonitor
+from rssi import RssiMonitor
+from snom_messaging import UdpServer
+
+A = ("192.168.1.10", 1300)
+B = ("192.168.1.11", 1300)
+
+# Frames as they were recorded from a M700, see benchmark.py
+_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="{}">
+<externalid>0595015157</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>2019-12-29 23:40:32</datetime>
+<timestamp>5e092b60</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+"""
+
+_SENDER = "<senderdata>\n<address>{0}</address>\n<name>no{0}</name>\n<location>M700</location>\n</senderdata>\n</request>\n\0"
+
+
+def _systeminfo(numbers):
+    addresses = "".join("<address>{0}</address>\n<name>no{0}</name>\n".format(number) for number in numbers)
+    return (_HEADER.format("systeminfo") + "<senderdata>\n" + addresses + "</senderdata>\n</request>\n\0").encode("UTF-8")
+
+
+def _login(number):
+    return (_HEADER.format("login") + "<logindata>\n<status>1</status>\n</logindata>\n" + _SENDER.format(number)).encode("UTF-8")
+
+
+def _alarm(number, rfpi, rssi):
+    return (
+        _HEADER.format("alarm")
+        + "<alarmdata>\n<type>16</type>\n</alarmdata>\n"
+        + "<rssidata>\n<rfpi>{}</rfpi>\n<rssi>{}</rssi>\n</rssidata>\n".format(rfpi, rssi)
+        + _SENDER.format(number)
+    ).encode("UTF-8")
+
+
+def _replay(frames):
+    """
+    Feeds (addr, datagram) pairs into a server with a RoamingMonitor and a
+    RssiMonitor. Returns both monitors and the BaseStation get_addr() chose
+    for handset 99 after every frame.
+    """
+    server = UdpServer()
+    roaming_monitor = RoamingMonitor(server)
+    rssi_monitor = RssiMonitor(server, roaming_monitor, window=8, margin=10)
+    chosen = []
+    for addr, data in frames:
+        server.datagram_received(data, addr)
+        chosen.append(roaming_monitor.get_addr("99"))
+    return roaming_monitor, rssi_monitor, chosen
+
+
+def test_follows_best_rssi_with_margin():
+    frames = [(A, _systeminfo(["99"])), (B, _systeminfo([]))]
+    # B is better, but not by the margin
+    frames += [(A, _alarm("99", "1333a39f00", 150)), (B, _alarm("99", "1333a3a000", 155))]
+    # B is clearly better
+    frames += [(B, _alarm("99", "1333a3a000", 200))] * 2
+    # A gets better again, the samples of B are still recent
+    frames += [(A, _alarm("99", "1333a39f00", 230))] * 4
+    roaming_monitor, rssi_monitor, chosen = _replay(frames)
+
+    assert chosen[:4] == [A, A, A, A]
+    assert chosen[4:6] == [B, B]
+    # Means of A: 190, 203.3, 210, 214 against 185 of B (registered on A)
+    assert chosen[6:] == [A, A, A, A]
+    assert roaming_monitor.get_presence("99").rssi == 230
+    assert rssi_monitor.stats() == {"handsets": 1, "basestations": 2}
+
+
+def test_registered_base_wins_within_margin():
+    frames = [(A, _systeminfo([])), (B, _systeminfo([])), (B, _login("99"))]
+    frames += [(B, _alarm("99", "1333a3a000", 152)), (A, _alarm("99", "1333a39f00", 160)), (A, _alarm("99", "1333a39f00", 161))]
+    # The mean of A reaches 152 + 10
+    frames += [(A, _alarm("99", "1333a39f00", 175))]
+    _, _, chosen = _replay(frames)
+    assert chosen[2:] == [B, B, B, B, A]
+
+
+def test_samples_stay_at_window():
+    frames = [(A, _systeminfo(["99"])), (B, _systeminfo([]))]
+    frames += [(A, _alarm("99", "1333a39f00", 150))] * 20
+    frames += [(B, _alarm("99", "1333a3a000", 170))] * 8
+    _, rssi_monitor, chosen = _replay(frames)
+
+    samples = rssi_monitor._samples["99"]
+    assert len(samples.times) == len(samples.values) == len(samples.addrs) == 8
+    # The samples of A are all replaced by those of B.
+    assert samples.addrs == [B] * 8
+    assert chosen[-1] == B
+    # Samples older than max_age are ignored.
+    assert rssi_monitor.best_addr("99", A, now=time.time() + 61) is None
@@ -0,0 +1,73 @@
+import asyncio
+from unittest.mock import ANY
+
+from messagesystem import MessageSystem
+from roaming import RoamingMonitor
+from snom_messaging import UdpServer
+from submission import SubmissionClient, SubmissionServer
+
+
+async def _submit_watched(path, messages, count):
+    """
+    Submits messages with watch to a new server and returns the results and
+    the first `count` status events.
+    """
+    server = UdpServer()
+    message_system = MessageSystem(server, RoamingMonitor(server), groups={"group": ["102", "103"]})
+    submission_server = SubmissionServer(message_system, path)
+    await submission_server.start()
+    try:
+        async with SubmissionClient(path) as client:
+            results = await client.submit(messages, watch=True)
+            events = []
+
+            async def collect():
+                async for event in client.events():
+                    events.append(event)
+                    if len(events) == count:
+                        break
+
+            await asyncio.wait_for(collect(), 2)
+    finally:
+        await submission_server.stop()
+        message_system.close()
+    return results, events
+
+
+def test_watcher_sees_queued(tmp_path):
+    results, events = asyncio.run(_submit_watched(str(tmp_path / "submit.sock"), [{"to": "102", "text": "Hello"}], 1))
+    assert events == [{"id": results[0]["id"], "to": "102", "status": "queued"}]
+
+
+def test_watcher_sees_queued_broadcast(tmp_path):
+    results, events = asyncio.run(_submit_watched(str(tmp_path / "submit.sock"), [{"to": "group", "text": "Hello"}], 2))
+    assert results[0]["recipients"] == 2
+    assert sorted(event["to"] for event in events) == ["102", "103"]
+    assert all(event["status"] == "queued" and event["broadcast"] == results[0]["broadcast"] for event in events)
+
+
+def test_stop_with_connected_client(tmp_path):
+    async def run():
+        path = str(tmp_path / "submit.sock")
+        server = UdpServer()
+        message_system = MessageSystem(server, RoamingMonitor(server))
+        submission_server = SubmissionServer(message_system, path)
+        await submission_server.start()
+        try:
+            async with SubmissionClient(path) as client:
+                await client.submit([{"to": "102", "text": "Hello"}], watch=True)
+                # Since Python 3.13 wait_closed() waits for the connections as well.
+                await asyncio.wait_for(submission_server.stop(), 2)
+                # The client sees the connection end.
+                events = []
+
+                async def collect():
+                    async for event in client.events():
+                        events.append(event)
+
+                await asyncio.wait_for(collect(), 2)
+                return events
+        finally:
+            message_system.close()
+
+    assert asyncio.run(run()) == [{"id": ANY, "to": "102", "status": "queued"}]
@@ -0,0 +1,54 @@
+import math
+import time
+
+
+class TimerWheel:
+    """
+    This class is a hashed timer wheel.
+
+    Items are put into one of `slots` buckets by their deadline, rounded up
+    to `tick` seconds. advance() returns the items of all buckets that became
+    due since the last call, without looking at any other bucket. Items with
+    a deadline further out than slots * tick seconds stay in their bucket
+    for another turn of the wheel.
+
+    Items can not be removed or rescheduled. To postpone an item cheaply, the
+    caller keeps the actual deadline with the item, checks it when the item
+    comes out and schedules it again if it is not due yet.
+    """
+
+    def __init__(self, tick=1.0, slots=256, now=None):
+        self._tick = tick
+        self._slots = [[] for _ in range(slots)]
+        # Number of the last tick advance() has processed.
+        self._current = math.floor((time.time() if now is None else now) / tick)
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots)
+
+    def schedule(self, item, deadline):
+        """
+        Adds an item that is due at deadline.
+        """
+        tick = max(math.ceil(deadline / self._tick), self._current + 1)
+        self._slots[tick % len(self._slots)].append((deadline, item))
+
+    def advance(self, now):
+        """
+        Returns a list of (deadline, item) tuples of all items that became due
+        up to now.
+        """
+        target = math.floor(now / self._tick)
+        due = []
+        for tick in range(self._current + 1, min(target, self._current + len(self._slots)) + 1):
+            slot = self._slots[tick % len(self._slots)]
+            if slot:
+                later = [entry for entry in slot if entry[0] > now]
+                if later:
+                    due.extend(entry for entry in slot if entry[0] <= now)
+                    slot[:] = later
+                else:
+                    due.extend(slot)
+                    slot.clear()
+        self._current = max(self._current, target)
+        return due
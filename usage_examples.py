@@ -5,10 +5,10 @@ Example of programmatic usage of MessageSender.
 This script shows how to integrate message sending into other applications.
 """
 
+import asyncio
 import logging
-import time
 
-from send_message import MessageSender
+from send_message import AsyncMessageSender, MessageSender
 
 
 def system_notifications_example():
@@ -31,21 +31,22 @@ def system_notifications_example():
 
     print(f"Sending notification to {len(extensions)} extensions...")
 
-    successes = 0
-    for ext in extensions:
-        success, msg_id, error = sender.send_message(
-            to_ext=ext, message_text=message, from_name="IT System", from_ext="support", from_location="server"
-        )
+    # All notifications are sent at once, the sender limits how many are in flight.
+    results = sender.send_messages(
+        [
+            dict(to_ext=ext, message_text=message, from_name="IT System", from_ext="support", from_location="server")
+            for ext in extensions
+        ]
+    )
 
+    successes = 0
+    for ext, (success, msg_id, error) in zip(extensions, results):
         if success:
             print(f"✅ Notification sent to {ext} (ID: {msg_id})")
             successes += 1
         else:
             print(f"❌ Send error to {ext}: {error}")
 
-        # Pause between sends to avoid system overload
-        time.sleep(0.5)
-
     print(f"\nResult: {successes}/{len(extensions)} notifications sent")
     return successes == len(extensions)
 
@@ -66,15 +67,22 @@ def urgent_alert_example():
 
     print("🚨 Sending emergency alert...")
 
-    for ext in emergency_extensions:
-        success, msg_id, error = sender.send_message(
-            to_ext=ext, message_text=alert_msg, from_name="SECURITY", from_ext="911", from_location="central"
-        )
-
-        if success:
-            print(f"🚨 Alert sent to {ext}")
-        else:
-            print(f"❌ CRITICAL ERROR: unable to send alert to {ext}")
+    # A single broadcast: The server renders the alert once and paces it per BaseStation.
+    # Instead of a list of extensions this can also be a group configured on the server.
+    # Priority 2 sends it ahead of the other queued messages.
+    success, msg_id, error = sender.send_message(
+        to_ext=emergency_extensions,
+        message_text=alert_msg,
+        from_name="SECURITY",
+        from_ext="911",
+        from_location="central",
+        priority=2,
+    )
+
+    if success:
+        print(f"🚨 Alert sent to {len(emergency_extensions)} extensions (ID: {msg_id})")
+    else:
+        print(f"❌ CRITICAL ERROR: unable to send alert: {error}")
 
 
 def custom_reminders_example():
@@ -95,16 +103,16 @@ def custom_reminders_example():
 
     print("📅 Sending custom reminders...")
 
-    for ext, message in reminders.items():
-        success, msg_id, error = sender.send_message(to_ext=ext, message_text=f"REMINDER: {message}", from_name="Secretary", from_ext="200")
+    results = sender.send_messages(
+        [dict(to_ext=ext, message_text=f"REMINDER: {message}", from_name="Secretary", from_ext="200") for ext, message in reminders.items()]
+    )
 
+    for ext, (success, msg_id, error) in zip(reminders, results):
         if success:
             print(f"📅 Reminder sent to {ext}")
         else:
             print(f"❌ Error sending reminder to {ext}: {error}")
 
-        time.sleep(0.3)
-
 
 def system_status_example():
     """
@@ -140,6 +148,25 @@ def system_status_example():
             print("✅ Normal system status notified")
 
 
+def asyncio_example():
+    """
+    Example: Sending messages from an asyncio application.
+    """
+    print("\n=== Example: asyncio ===")
+
+    async def notify(extensions):
+        # One sender (and socket) is shared by all tasks of the application.
+        async with AsyncMessageSender("localhost", 1300) as sender:
+            tasks = [sender.send_message(to_ext=ext, message_text="Lunch is ready", from_name="Canteen") for ext in extensions]
+            for ext, (success, msg_id, error) in zip(extensions, await asyncio.gather(*tasks)):
+                if success:
+                    print(f"🍽️  Sent to {ext} (ID: {msg_id})")
+                else:
+                    print(f"❌ Error sending to {ext}: {error}")
+
+    asyncio.run(notify(["101", "102", "103"]))
+
+
 def main():
     """
     Runs all examples.
@@ -152,6 +179,7 @@ def main():
         urgent_alert_example()
         custom_reminders_example()
         system_status_example()
+        asyncio_example()
 
         print("\n✅ All examples completed!")
 